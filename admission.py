@@ -0,0 +1,197 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+# ==========================================
+# 聊天請求的准入控制 (Admission Control)
+# ==========================================
+# /stream-chat 原本沒有併發上限，尖峰時幾百個 prompt 一起塞進 vLLM，所有人的首字延遲一起崩潰。
+#   - AdmissionController：同時處理上限 + 有界的等待佇列 (FIFO)
+#       * 有空位 -> 直接進入
+#       * 沒空位 -> 排隊，等待期間可透過 SSE progress 事件回報排隊位置
+#       * 佇列已滿 -> 呼叫端立即回 503 + Retry-After
+#   - TokenBucketLimiter：每位使用者 (JWT sub，沒有登入則用 IP) 的 token bucket 頻率限制
+#   - SharedTokenBucketLimiter：同上，但桶子存在共享的 state_store，多個 worker 共用 (STATE_STORE=sql)
+# AdmissionController 是「每個 worker 一份」(asyncio 單一 event loop 內使用)；
+# 多 worker 時以 per_worker_limit 把全域上限平均分給各 worker。
+
+
+class AdmissionTicket:
+    def __init__(self, controller):
+        self.controller = controller
+        self.admitted = False
+        self.released = False
+        self.enqueued_at = time.perf_counter()
+        self.waited_ms = 0.0
+        self._future = None
+
+    @property
+    def position(self):
+        """目前排第幾位 (1 起算)；已進入則為 0"""
+        if self.admitted:
+            return 0
+        try:
+            return self.controller._waiters.index(self) + 1
+        except ValueError:
+            return 0
+
+    async def wait(self, timeout, update_interval=2.0):
+        """
+        等待輪到自己；這是一個 async generator，等待期間每當排隊位置改變
+        (或每 update_interval 秒) 就 yield 目前位置。逾時會離開佇列並拋出 asyncio.TimeoutError。
+        """
+        if self.admitted:
+            return
+        deadline = time.perf_counter() + timeout
+        last_position = None
+        try:
+            while not self.admitted:
+                position = self.position
+                if position != last_position:
+                    last_position = position
+                    yield position
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self.controller._stats["timed_out"] += 1
+                    raise asyncio.TimeoutError()
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._future), timeout=min(update_interval, remaining))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if not self.admitted:
+                self.controller._abandon(self)
+            self.waited_ms = (time.perf_counter() - self.enqueued_at) * 1000
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent=8, max_queue=32):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self._active = 0
+        self._waiters = deque()
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0}
+
+    def try_enter(self):
+        """立即判斷：回傳 ticket (可能需要排隊)，佇列已滿則回傳 None"""
+        ticket = AdmissionTicket(self)
+        if self.max_concurrent <= 0 or (self._active < self.max_concurrent and not self._waiters):
+            self._admit(ticket)
+            return ticket
+        if len(self._waiters) >= self.max_queue:
+            self._stats["rejected"] += 1
+            return None
+        ticket._future = asyncio.get_running_loop().create_future()
+        self._waiters.append(ticket)
+        self._stats["queued"] += 1
+        return ticket
+
+    def _admit(self, ticket):
+        ticket.admitted = True
+        self._active += 1
+        self._stats["admitted"] += 1
+        if ticket._future is not None and not ticket._future.done():
+            ticket._future.set_result(True)
+
+    def _release(self, ticket):
+        if ticket.admitted:
+            self._active -= 1
+        else:
+            self._abandon(ticket)
+        while self._waiters and (self.max_concurrent <= 0 or self._active < self.max_concurrent):
+            self._admit(self._waiters.popleft())
+
+    def _abandon(self, ticket):
+        # 逾時或客戶端在排隊期間斷線
+        try:
+            self._waiters.remove(ticket)
+        except ValueError:
+            pass
+
+    def stats(self):
+        return dict(self._stats, active=self._active, waiting=len(self._waiters),
+                    max_concurrent=self.max_concurrent, max_queue=self.max_queue)
+
+
+class TokenBucketLimiter:
+    """
+    rate_per_minute：每分鐘補充的 token 數；burst：桶子容量 (允許的瞬間連發數)。
+    rate_per_minute <= 0 表示不限制。
+    """
+    def __init__(self, rate_per_minute=20, burst=5, max_keys=10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets = {}   # key -> (tokens, last_time)
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def try_acquire(self, key):
+        """回傳 (是否允許, 建議等待秒數)"""
+        if self.rate <= 0:
+            return True, 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                allowed, retry_after = True, 0
+            else:
+                self._buckets[key] = (tokens, now)
+                self.limited += 1
+                allowed, retry_after = False, (1 - tokens) / self.rate
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return allowed, retry_after
+
+    def _prune(self, now):
+        # 已經補滿的桶子等同沒有紀錄，可以丟掉
+        full = [k for k, (t, last) in self._buckets.items() if t + (now - last) * self.rate >= self.burst]
+        for k in full:
+            del self._buckets[k]
+
+    def stats(self):
+        with self._lock:
+            return {"tracked_keys": len(self._buckets), "limited": self.limited,
+                    "rate_per_minute": self.rate * 60, "burst": self.burst}
+
+
+class SharedTokenBucketLimiter:
+    """
+    與 TokenBucketLimiter 相同的介面，但桶子存在 state_store (take_token)，多個 worker 共用同一份額度。
+    每次判斷都要查一次資料庫，呼叫端應放到執行緒池執行 (blocking = True)。
+    """
+    blocking = True
+
+    def __init__(self, state_store, rate_per_minute=20, burst=5, key_prefix="chat:"):
+        self.state_store = state_store
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self.key_prefix = key_prefix
+        self.limited = 0
+
+    def try_acquire(self, key):
+        """回傳 (是否允許, 建議等待秒數)"""
+        if self.rate <= 0:
+            return True, 0
+        allowed, retry_after = self.state_store.take_token(self.key_prefix + key, self.rate, self.burst)
+        if not allowed:
+            self.limited += 1
+        return allowed, retry_after
+
+    def stats(self):
+        return {"limited": self.limited, "rate_per_minute": self.rate * 60, "burst": self.burst}
+
+
+def per_worker_limit(limit, workers):
+    """把全域上限平均分給各 worker (0 = 不限制維持不變；每個 worker 至少 1)"""
+    if limit <= 0 or workers <= 1:
+        return limit
+    return max(1, limit // workers)
@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# ==========================================
+# Semantic Answer Cache
+# ==========================================
+# 大量流量是同一題的不同問法。若新問題的向量與快取中的問題夠接近，
+# 而且檢索到的 chunk ID 集合完全一樣 (代表 context 相同)，就直接重播上次的回答，
+# 不再佔用 vLLM。
+#
+# 失效條件：
+#   - TTL 到期
+#   - 知識庫異動 (/upload 完成、DELETE /files) 時呼叫 invalidate_all()
+#   - 超過筆數或記憶體上限時，以 LRU 順序淘汰
+
+
+class SemanticAnswerCache:
+    def __init__(self, similarity_threshold=0.95, ttl_seconds=3600, max_entries=256, max_bytes=32 * 1024 * 1024):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()   # entry_id -> entry dict (LRU 順序)
+        self._by_context = {}           # (variant, chunk_ids) -> set(entry_id)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._bytes = 0
+        # 知識庫版本號：invalidate_all() 時 +1，生成途中知識庫被改過的回答不會寫入
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(vec):
+        arr = np.asarray(vec, dtype=np.float32)
+        norm = np.linalg.norm(arr)
+        return arr / norm if norm > 0 else arr
+
+    def lookup(self, query_vec, chunk_ids, variant):
+        """
+        找出相同 context (variant + chunk_ids) 下最相近的快取問題。
+        命中回傳 (answer, similarity)，未命中回傳 None。
+        """
+        q = self._normalize(query_vec)
+        now = time.time()
+        with self._lock:
+            candidate_ids = self._by_context.get((variant, chunk_ids))
+            best_id, best_sim = None, -1.0
+            for entry_id in list(candidate_ids or ()):
+                entry = self._entries[entry_id]
+                if now - entry["created_at"] > self.ttl_seconds:
+                    self._remove(entry_id)
+                    self.expirations += 1
+                    continue
+                sim = float(np.dot(q, entry["vec"]))
+                if sim > best_sim:
+                    best_id, best_sim = entry_id, sim
+
+            if best_id is not None and best_sim >= self.similarity_threshold:
+                self._entries.move_to_end(best_id)
+                self.hits += 1
+                return self._entries[best_id]["answer"], best_sim
+            self.misses += 1
+            return None
+
+    def put(self, query, query_vec, chunk_ids, variant, answer, generation):
+        """寫入一筆回答；若生成途中知識庫已異動 (generation 不同) 則忽略"""
+        if not answer:
+            return
+        size = len(answer.encode("utf-8")) + len(query.encode("utf-8")) + 4 * len(query_vec)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            key = (variant, chunk_ids)
+            self._entries[entry_id] = {
+                "query": query,
+                "vec": self._normalize(query_vec),
+                "key": key,
+                "answer": answer,
+                "size": size,
+                "created_at": time.time(),
+            }
+            self._by_context.setdefault(key, set()).add(entry_id)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                oldest_id = next(iter(self._entries))
+                self._remove(oldest_id)
+                self.evictions += 1
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        self._bytes -= entry["size"]
+        ids = self._by_context.get(entry["key"])
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_context[entry["key"]]
+
+    def invalidate_all(self):
+        """知識庫異動時呼叫：清空所有快取並更新版本號"""
+        with self._lock:
+            self._entries.clear()
+            self._by_context.clear()
+            self._bytes = 0
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "similarity_threshold": self.similarity_threshold,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
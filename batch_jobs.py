@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+# ==========================================
+# 批次問答工作 (Batch Question Jobs)
+# ==========================================
+# 分析人員常一次丟 50 ~ 200 題 (例如年報檢核清單)，逐題走 /stream-chat 時：
+# 每題各自 encode 一次、各自查一次 Chroma，生成也是一題等一題，vLLM 大部分時間是閒著的。
+#   - 所有問題一次 encode、一次多查詢 collection.query，再以 split_query_results 拆回每題的單查詢格式
+#   - 生成以固定併發數送進 vLLM (rag_server 端以 Semaphore 控制)
+#   - BatchJob：進度計數 + 逐題完成即寫入 JSONL (一行一題，完成順序，以 index 對應原題號)
+# 進度以 JSON 存在 state_store (name = "batch:<job_id>")，多個 worker 都查得到；結果檔在本機磁碟。
+
+
+def split_query_results(results):
+    """把多查詢的 collection.query 結果拆成每題一份 (格式與單一查詢相同：每個欄位外面包一層 list)"""
+    count = len(results.get('ids') or [])
+    per_query = []
+    for i in range(count):
+        per_query.append({
+            key: [results[key][i]] if results.get(key) is not None else None
+            for key in ('ids', 'documents', 'metadatas', 'distances')
+        })
+    return per_query
+
+
+class BatchJob:
+    def __init__(self, job_id, total, output_path, owner=None):
+        self.job_id = job_id
+        self.total = total
+        self.output_path = output_path
+        self.owner = owner
+        self.status = "queued"
+        self.done = 0
+        self.failed = 0
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        # 先建立空檔，執行中也能下載目前已完成的部分
+        open(output_path, "w", encoding="utf-8").close()
+
+    @property
+    def state_key(self):
+        return f"batch:{self.job_id}"
+
+    def start(self):
+        self.status = "running"
+        self.started_at = time.time()
+
+    def record(self, result):
+        """寫入一題的結果 (含 error 欄位的視為失敗)"""
+        line = json.dumps(result, ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.output_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.done += 1
+            if result.get("error"):
+                self.failed += 1
+
+    def finish(self, error=None):
+        self.finished_at = time.time()
+        self.error = error
+        self.status = "error" if error else "completed"
+
+    def progress(self):
+        now = self.finished_at or time.time()
+        elapsed = now - self.started_at if self.started_at else 0.0
+        return {
+            "job_id": self.job_id,
+            "owner": self.owner,
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "error": self.error,
+            "created_at": datetime.fromtimestamp(self.created_at).isoformat(timespec="seconds"),
+            "elapsed_s": round(elapsed, 1),
+            "questions_per_min": round(self.done / elapsed * 60, 1) if elapsed > 0 else 0.0,
+            "output": self.output_path,
+        }
+
+    def save(self, state_store):
+        state_store.set_job(self.state_key, self.status, json.dumps(self.progress(), ensure_ascii=False))
+
+
+def load_job_status(state_store, job_id):
+    """回傳 (status, 進度 dict)；找不到時回傳 (None, None)"""
+    job = state_store.get_job(f"batch:{job_id}")
+    if not job:
+        return None, None
+    try:
+        progress = json.loads(job["message"])
+    except (TypeError, ValueError):
+        progress = {"message": job["message"]}
+    return job["status"], progress
@@ -0,0 +1,120 @@
+"""
+Embedding 後端比較：PyTorch (SentenceTransformer) vs ONNX (int8 / fp16 / fp32)。
+
+用法：
+    python embedding_backends.py export --quantize int8 --output ./onnx_embedding
+    python benchmarks/bench_embedding_backends.py --onnx ./onnx_embedding/model_int8.onnx [--threads 4]
+
+1. 一致性：同一批文字分別用兩個後端 encode，計算逐筆 cosine 相似度 (min / mean)，
+   並檢查以 PyTorch 向量與 ONNX 向量做檢索時 top-k 的重疊率。
+2. 速度：單筆查詢延遲 (p50 / p95) 與批次吞吐量 (texts/s)。
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_backends import SentenceTransformerBackend, OnnxEmbeddingBackend
+
+
+SAMPLE_QUERIES = [
+    "臺南市今年度的社會福利預算是多少？",
+    "青年創業補助的申請資格為何",
+    "113年度觀光旅遊局的施政成果有哪些亮點",
+    "幫我寫一篇關於長照政策的致詞稿",
+    "交通局停車場興建計畫的執行率",
+    "What is the budget for public housing?",
+    "防災演練辦理幾場、參與人數多少人",
+    "環保局資源回收的績效指標",
+]
+
+SAMPLE_PASSAGES = [
+    "【來源文件：臺南市113年度施政計畫】 [社會局] 推動長期照顧服務 2.0，布建社區整體照顧服務體系，預算 12.5 億元。",
+    "【來源文件：青年創業補助要點】 第三條 申請人應設籍本市滿一年，年齡二十歲以上四十五歲以下。",
+    "【來源文件：觀光旅遊局年度成果】 舉辦臺南400系列活動，吸引觀光人次達 1,200 萬人次，較前一年成長 18%。",
+    "【來源文件：交通局預算書】 [停車場興建] 安平區立體停車場工程，總經費 3.2 億元，截至 6 月底執行率 65%。",
+    "【來源文件：消防局業務報告】 全年辦理防災演練 48 場次，參與民眾 15,300 人。",
+    "【來源文件：環保局績效報告】 資源回收率達 58.3%，垃圾妥善處理率 100%。",
+    "Public housing program: 2,400 units planned, with a total budget of NT$ 9.8 billion.",
+    "【來源文件：都發局】 [都市更新] 推動危老重建，核定案件 132 件。",
+]
+
+
+def cosine_rows(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+def topk_overlap(q_ref, p_ref, q_new, p_new, k):
+    ref = np.argsort(-(q_ref @ p_ref.T), axis=1)[:, :k]
+    new = np.argsort(-(q_new @ p_new.T), axis=1)[:, :k]
+    return float(np.mean([len(set(r) & set(n)) / k for r, n in zip(ref, new)]))
+
+
+def bench_latency(backend, texts, repeat):
+    backend.encode(texts[:1])  # warm-up
+    timings = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        backend.encode([texts[i % len(texts)]])
+        timings.append((time.perf_counter() - t0) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def bench_throughput(backend, texts, rounds):
+    batch = texts * rounds
+    t0 = time.perf_counter()
+    backend.encode(batch)
+    return len(batch) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL_PATH", "jinaai/jina-embeddings-v3"))
+    parser.add_argument("--onnx", nargs="+", default=["./onnx_embedding/model_int8.onnx"])
+    parser.add_argument("--device", default="cpu", help="PyTorch 基準的 device")
+    parser.add_argument("--threads", type=int, default=0, help="onnxruntime intra-op 執行緒數 (0 = 自動)")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=8, help="吞吐量測試時樣本重複次數")
+    parser.add_argument("--min-cosine", type=float, default=0.99, help="低於此值視為不一致")
+    args = parser.parse_args()
+
+    backends = [("torch-" + args.device, SentenceTransformerBackend(args.model, device=args.device))]
+    for path in args.onnx:
+        backends.append(("onnx-" + os.path.basename(path), OnnxEmbeddingBackend(path, num_threads=args.threads)))
+
+    ref_name, ref = backends[0]
+    ref_q = np.asarray(ref.encode(SAMPLE_QUERIES), dtype=np.float32)
+    ref_p = np.asarray(ref.encode(SAMPLE_PASSAGES), dtype=np.float32)
+
+    failed = False
+    print(f"\n=== 一致性 (基準: {ref_name}) ===")
+    for name, backend in backends[1:]:
+        q = np.asarray(backend.encode(SAMPLE_QUERIES), dtype=np.float32)
+        p = np.asarray(backend.encode(SAMPLE_PASSAGES), dtype=np.float32)
+        cos = np.concatenate([cosine_rows(ref_q, q), cosine_rows(ref_p, p)])
+        overlap = topk_overlap(ref_q, ref_p, q, p, k=3)
+        ok = cos.min() >= args.min_cosine
+        failed |= not ok
+        print(f"{name:<28} cosine min={cos.min():.4f} mean={cos.mean():.4f}  top3 重疊率={overlap:.2%}  {'OK' if ok else 'MISMATCH'}")
+
+    print("\n=== 速度 ===")
+    print(f"{'backend':<28} {'單筆 p50(ms)':>12} {'單筆 p95(ms)':>12} {'吞吐(texts/s)':>14}")
+    texts = SAMPLE_QUERIES + SAMPLE_PASSAGES
+    for name, backend in backends:
+        p50, p95 = bench_latency(backend, SAMPLE_QUERIES, args.repeat)
+        tput = bench_throughput(backend, texts, args.rounds)
+        print(f"{name:<28} {p50:>12.1f} {p95:>12.1f} {tput:>14.1f}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Prompt 樣板的 prefix cache 命中率比較 (v1 舊版排列 vs v2 固定前綴)。
+
+用法：
+    python benchmarks/bench_prompt_prefix.py [--requests 40] [--block-size 16]
+
+啟動一個本機的 OpenAI 相容替身伺服器 (/v1/chat/completions，串流回應)，
+以 Gemma 的 chat template 規則把 messages 轉成 token 序列，並模擬 vLLM automatic
+prefix caching：token 以 block 為單位、以「前綴鏈 hash」記錄，新請求從頭開始連續命中的
+block 數 x block size 即為可重用 (不必重新 prefill) 的 token 數。
+
+安裝了 transformers 且能載入 CONTEXT_TOKENIZER_PATH 時使用真正的 tokenizer，
+否則以「一個字元一個 token」近似 (只影響絕對數字，不影響兩種排列的相對比較)。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import AsyncOpenAI
+
+import prompt_templates
+from context_packer import get_token_counter
+
+
+SAMPLE_PASSAGES = [
+    "【來源文件：臺南市113年度施政計畫】 [社會局] 推動長期照顧服務 2.0，布建社區整體照顧服務體系，預算 12.5 億元。",
+    "【來源文件：青年創業補助要點】 第三條 申請人應設籍本市滿一年，年齡二十歲以上四十五歲以下。",
+    "【來源文件：觀光旅遊局年度成果】 舉辦臺南400系列活動，吸引觀光人次達 1,200 萬人次，較前一年成長 18%。",
+    "【來源文件：交通局預算書】 [停車場興建] 安平區立體停車場工程，總經費 3.2 億元，截至 6 月底執行率 65%。",
+    "【來源文件：消防局業務報告】 全年辦理防災演練 48 場次，參與民眾 15,300 人。",
+    "【來源文件：環保局績效報告】 資源回收率達 58.3%，垃圾妥善處理率 100%。",
+    "【來源文件：都發局】 [都市更新] 推動危老重建，核定案件 132 件。",
+    "【來源文件：經發局】 [產業園區] 沙崙智慧綠能科學城進駐廠商 35 家，投資金額 210 億元。",
+]
+
+SAMPLE_QUERIES = [
+    ("qa", "長照服務的預算是多少？"),
+    ("qa", "停車場興建計畫的執行率"),
+    ("qa", "防災演練辦理幾場"),
+    ("qa", "資源回收的績效指標"),
+    ("speech", "幫我寫一篇關於觀光成果的致詞稿"),
+    ("speech", "產業園區招商成果演講稿"),
+]
+
+
+# ==========================================
+# OpenAI 相容替身伺服器 + prefix cache 模擬
+# ==========================================
+class PrefixCacheSimulator:
+    def __init__(self, tokenize, block_size=16):
+        self.tokenize = tokenize
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.blocks = set()
+            self.requests = 0
+            self.prompt_tokens = 0
+            self.cached_tokens = 0
+
+    def process(self, tokens):
+        bs = self.block_size
+        hits = 0
+        chain = None
+        missed = False
+        with self.lock:
+            for start in range(0, len(tokens) - len(tokens) % bs, bs):
+                chain = hash((chain, tuple(tokens[start:start + bs])))
+                if not missed and chain in self.blocks:
+                    hits += bs
+                else:
+                    missed = True
+                    self.blocks.add(chain)
+            self.requests += 1
+            self.prompt_tokens += len(tokens)
+            self.cached_tokens += hits
+        return hits
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "hit_rate": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            }
+
+
+def render_gemma_chat(messages):
+    """Gemma chat template：system 內容併入第一個 user turn 的開頭"""
+    system = "".join(m["content"] for m in messages if m["role"] == "system")
+    text = "<bos>"
+    first_user = True
+    for m in messages:
+        if m["role"] == "system":
+            continue
+        role = "model" if m["role"] == "assistant" else "user"
+        content = m["content"]
+        if role == "user" and first_user and system:
+            content = f"{system}\n\n{content}"
+            first_user = False
+        text += f"<start_of_turn>{role}\n{content}<end_of_turn>\n"
+    return text + "<start_of_turn>model\n"
+
+
+def make_handler(simulator):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = json.dumps(simulator.stats()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if self.path.endswith("/reset"):
+                simulator.reset()
+                self.send_response(204)
+                self.end_headers()
+                return
+            tokens = simulator.tokenize(render_gemma_chat(payload["messages"]))
+            cached = simulator.process(tokens)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for piece in ["模擬", "回答", f"(prompt={len(tokens)}, cached={cached})"]:
+                chunk = {
+                    "id": "bench", "object": "chat.completion.chunk", "created": 0, "model": payload["model"],
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            self.close_connection = True
+
+    return Handler
+
+
+def start_server(simulator):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(simulator))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ==========================================
+# 測試流程
+# ==========================================
+async def run_version(base_url, version, workload):
+    client = AsyncOpenAI(base_url=base_url, api_key="EMPTY")
+    for intent, query, context in workload:
+        template = prompt_templates.get_template(intent, version)
+        stream = await client.chat.completions.create(
+            model="bench", messages=template.build_messages(context, query), stream=True
+        )
+        async for _ in stream:
+            pass
+    await client.close()
+
+
+def build_workload(n, seed):
+    rng = random.Random(seed)
+    workload = []
+    for _ in range(n):
+        intent, query = rng.choice(SAMPLE_QUERIES)
+        passages = rng.sample(SAMPLE_PASSAGES, rng.randint(3, len(SAMPLE_PASSAGES)))
+        workload.append((intent, query, "\n\n".join(passages)))
+    return workload
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    counter = get_token_counter()
+    if counter.tokenizer is not None:
+        tokenize = lambda text: counter.tokenizer.encode(text, add_special_tokens=False)
+    else:
+        tokenize = list
+    print(f"tokenizer: {counter.name if counter.tokenizer is not None else '字元近似'}")
+
+    simulator = PrefixCacheSimulator(tokenize, block_size=args.block_size)
+    server = start_server(simulator)
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    workload = build_workload(args.requests, args.seed)
+
+    print(f"\n{'version':<8} {'requests':>8} {'prompt tokens':>14} {'cached tokens':>14} {'命中率':>8} {'平均共用/請求':>12}")
+    for version in sorted({v for _, v in prompt_templates.PROMPT_TEMPLATES}):
+        simulator.reset()
+        asyncio.run(run_version(base_url, version, workload))
+        st = simulator.stats()
+        print(f"{version:<8} {st['requests']:>8} {st['prompt_tokens']:>14} {st['cached_tokens']:>14} "
+              f"{st['hit_rate']:>8.1%} {st['cached_tokens'] / st['requests']:>12.1f}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+advanced_reranker 微基準測試：逐筆 (dict + 兩次全排序) vs NumPy 版。
+
+用法：
+    python benchmarks/bench_reranker.py [--sizes 150 500 2000] [--repeat 50]
+
+會先驗證兩個版本的輸出完全相同 (順序、分數、欄位)，再比較耗時。
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import query_rag_v3 as my_rag
+
+
+# ==========================================
+# 參考實作：向量化之前的逐筆版本 (作為正確性基準)
+# ==========================================
+def calculate_keyword_score(query_keywords, text):
+    if not text: return 0
+    score = 0
+    for kw in query_keywords:
+        if kw in text:
+            score += (len(kw) ** 2) 
+    
+    # 數據意圖加分
+    if any(k in ["多少", "金額", "經費", "預算", "費用"] for k in query_keywords):
+        digit_count = sum(c.isdigit() for c in text)
+        if digit_count > 0: score += 5.0
+        if any(u in text for u in ["元", "億", "萬", "人"]): score += 5.0
+    return score
+
+def reference_reranker(query, documents, metadatas, distances, top_n=30, decay_rate=0.95, keywords=[], ids=None):
+    temp_scores = []
+    is_asking_result = any(k in query for k in ["成果", "績效", "亮點", "成效", "產出"])
+    
+    # 1. 基礎計分
+    for i, (doc, meta, dist) in enumerate(zip(documents, metadatas, distances)):
+        
+        # 防呆檢查：若資料庫回傳 dist 為 None
+        if dist is None:
+            sim_score = 0.0
+            safe_dist = 1.0
+        else:
+            sim_score = 1 - dist 
+            safe_dist = dist
+            
+        norm_vector = max(0, min(1, sim_score))
+        
+        # 關鍵字加分 (確保 doc 也不為 None)
+        safe_doc = doc if doc else ""
+        kw_score = calculate_keyword_score(keywords, safe_doc)
+        norm_kw = min(1.0, kw_score / 15.0) 
+        
+        # 綜合分數 (關鍵字權重 0.3, 向量 0.7)
+        base_score = (norm_vector * 0.7) + (norm_kw * 0.3)
+        
+        safe_meta = meta if meta else {}
+        doc_name = safe_meta.get("doc_name", "unknown")
+
+        if is_asking_result:
+            if any(x in doc_name for x in ["績效", "成果", "結案", "報告"]):
+                base_score += 0.15  # 加分：讓報告書浮上來
+            elif any(x in doc_name for x in ["計畫書", "手冊", "格式"]):
+                base_score -= 0.05  # 扣分：這些通常是行政流程文件
+
+        temp_scores.append({
+            "index": i,
+            "id": ids[i] if ids else None,
+            "doc": safe_doc,
+            "meta": safe_meta,
+            "distance": safe_dist,
+            "base_score": base_score,
+            "doc_name": doc_name
+        })
+
+    # 2. 多樣性過濾 (Diversity Filter)
+    # 先依照分數高低排序
+    temp_scores.sort(key=lambda x: x["base_score"], reverse=True)
+
+    final_results = []
+    seen_docs = {}
+    
+    # 設定：同一份文件最多允許幾個 Chunk 排在最前面？
+    MAX_CHUNKS_HEAD = 3 
+    
+    deferred_queue = [] # 被降權的候補區
+
+    for item in temp_scores:
+        d_name = item['doc_name']
+        current_count = seen_docs.get(d_name, 0)
+        
+        if current_count < MAX_CHUNKS_HEAD:
+            # 名額內：保持原分，直接錄取
+            item['final_score'] = item['base_score']
+            final_results.append(item)
+            seen_docs[d_name] = current_count + 1
+        else:
+            # 超額：進入候補區，並給予懲罰 (Penalty)
+            item['final_score'] = item['base_score'] * 0.5 
+            deferred_queue.append(item)
+    
+    # 將降權後的項目加回來
+    final_results.extend(deferred_queue)
+    
+    # 再次根據 final_score 排序
+    final_results.sort(key=lambda x: x['final_score'], reverse=True)
+    for res in final_results:
+        res['score'] = res['final_score']
+    # 取前 N 名
+    return final_results[:top_n]
+
+
+# ==========================================
+# 合成候選資料
+# ==========================================
+VOCAB = list("預算執行率元億萬人計畫成果績效報告年度產值金額廠商輔導家數成長投資") + ["112", "113", "3,000", "%"]
+DOC_NAMES = ["112年績效報告", "113年成果報告", "計畫書", "作業手冊", "填寫格式", "會議紀錄", "公告"] + [f"文件{i}" for i in range(40)]
+KEYWORDS = ["預算", "執行率", "112年", "金額", "億元", "成長率"]
+
+
+def make_candidates(n, seed=0):
+    rng = random.Random(seed)
+    documents, metadatas, distances, ids = [], [], [], []
+    for i in range(n):
+        documents.append("".join(rng.choice(VOCAB) for _ in range(rng.randint(50, 800))) if rng.random() > 0.01 else None)
+        metadatas.append({"doc_name": rng.choice(DOC_NAMES), "source_doc": "x"} if rng.random() > 0.01 else None)
+        # 約 1/3 來自關鍵字搜尋 (沒有距離)，並刻意製造同分
+        r = rng.random()
+        distances.append(None if r < 0.33 else round(rng.uniform(0.1, 1.2), 2))
+        ids.append(f"id_{i}")
+    return documents, metadatas, distances, ids
+
+
+def same_results(a, b):
+    if len(a) != len(b):
+        return False
+    fields = ["index", "id", "doc", "meta", "distance", "base_score", "doc_name", "final_score", "score"]
+    return all(x[f] == y[f] for x, y in zip(a, b) for f in fields)
+
+
+def time_it(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[150, 500, 2000])
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--top-n", type=int, default=60)
+    args = parser.parse_args()
+
+    print(f"{'候選數':>8} {'逐筆版(ms)':>12} {'NumPy版(ms)':>12} {'加速':>8}")
+    for n in args.sizes:
+        for query in ["112年預算執行率多少", "請問計畫的執行成果與績效亮點"]:
+            docs, metas, dists, ids = make_candidates(n, seed=n)
+            kwargs = dict(top_n=args.top_n, decay_rate=0.98, keywords=KEYWORDS + ["多少"], ids=ids)
+            ref = reference_reranker(query, docs, metas, dists, **kwargs)
+            new = my_rag.advanced_reranker(query, docs, metas, dists, **kwargs)
+            if not same_results(ref, new):
+                print(f"結果不一致！n={n} query={query}")
+                sys.exit(1)
+
+        query = "112年預算執行率多少"
+        docs, metas, dists, ids = make_candidates(n, seed=n)
+        kwargs = dict(top_n=args.top_n, decay_rate=0.98, keywords=KEYWORDS + ["多少"], ids=ids)
+        t_ref = time_it(lambda: reference_reranker(query, docs, metas, dists, **kwargs), args.repeat)
+        t_new = time_it(lambda: my_rag.advanced_reranker(query, docs, metas, dists, **kwargs), args.repeat)
+        print(f"{n:>8} {t_ref:>12.2f} {t_new:>12.2f} {t_ref / t_new:>7.2f}x")
+
+    print("兩個版本輸出完全一致。")
+
+
+if __name__ == "__main__":
+    main()
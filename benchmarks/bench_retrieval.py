@@ -0,0 +1,329 @@
+"""
+離線檢索基準測試：合成語料 -> graph_chunker_v6 -> VectorDBBuilder (暫存 Chroma 目錄)，
+再以固定的問題集重播檢索流程，輸出各階段 p50 / p95 / p99 (毫秒)。
+
+用法：
+    python benchmarks/bench_retrieval.py [--sizes 20 80 320] [--repeat 5]
+    python benchmarks/bench_retrieval.py --output bench_retrieval.json             # 存下這次的結果
+    python benchmarks/bench_retrieval.py --baseline bench_retrieval.json --max-regression 0.25
+                                                                                  # 與基準比較，p95 變慢超過 25% 則 exit 1
+
+階段 (與 rag_server 的檢索流程相同，但不呼叫 LLM：每題的核心關鍵字固定寫在問題集裡)：
+    keyword_expansion  expand_keywords_by_intent
+    embedding          問題向量 (預設為可重現的 hash 向量；--embedding-model 可改用真正的模型在 CPU 上跑)
+    vector_search      collection.query
+    keyword_scan       n-gram 倒排索引 (VectorDBBuilder.keyword_search)
+    bm25               BM25 稀疏檢索 (第一次查詢時建索引，暖機時已付掉)
+    fusion             向量 + BM25 以 RRF 融合，再補上關鍵字結果
+    rerank             advanced_reranker
+    merge              group_and_merge_results
+    context            選擇 prompt 樣板 + 依 token 預算打包 Context
+語料以固定 seed 產生，同一台機器上多次執行的結果可以直接比較。
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import build_vectordb_v3 as db_builder
+import graph_chunker_v6 as chunker
+import query_rag_v3 as my_rag
+from bm25_retriever import BM25_TOP_K, VECTOR_N_RESULTS, fuse_candidates
+from context_packer import (CONTEXT_TOKEN_MARGIN, LLM_CONTEXT_WINDOW, context_blocks, context_token_budget,
+                            get_token_counter, pack_context)
+from prompt_templates import get_template, select_intent
+
+
+STAGES = ["keyword_expansion", "embedding", "vector_search", "keyword_scan", "bm25",
+          "fusion", "rerank", "merge", "context"]
+
+# 檢索 / 打包的設定 (VECTOR_N_RESULTS、FUSED_TOP_K、LLM_CONTEXT_WINDOW 等) 與融合、打包函式都直接取自
+# rag_server 使用的 bm25_retriever / context_packer，讀同樣的環境變數；生成長度用 ChatRequest.max_tokens 的預設值
+MAX_TOKENS = 4096
+
+
+# ==========================================
+# 可重現的 Embedding 替身
+# ==========================================
+class HashEmbedding:
+    """字元 unigram + bigram 雜湊成固定維度的向量 (L2 正規化)；同樣的文字永遠得到同樣的向量"""
+    name = "hash"
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def encode(self, texts, **kwargs):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            text = text or ""
+            for i, ch in enumerate(text):
+                out[row, zlib.crc32(ch.encode("utf-8")) % self.dim] += 1.0
+                if i + 1 < len(text):
+                    out[row, zlib.crc32(text[i:i + 2].encode("utf-8")) % self.dim] += 0.5
+            norm = np.linalg.norm(out[row])
+            if norm > 0:
+                out[row] /= norm
+        return out
+
+
+# ==========================================
+# 合成語料與問題集
+# ==========================================
+DEPARTMENTS = ["社會局", "交通局", "觀光旅遊局", "經濟發展局", "環境保護局", "教育局", "衛生局", "都市發展局", "消防局", "文化局"]
+PROGRAMS = ["長期照顧服務", "停車場興建", "青年創業補助", "資源回收", "防災演練", "智慧校園", "社區營造",
+            "產業園區招商", "公共住宅", "觀光活動行銷", "托育補助", "道路養護"]
+INDICATORS = ["預算", "執行率", "決算數", "人次", "家數", "成長率", "滿意度", "投資金額"]
+YEARS = ["111", "112", "113"]
+
+QUERY_TEMPLATES = [
+    ("{year}年{program}的預算是多少？", ["{program}", "預算", "{year}年"]),
+    ("{dept}{program}的執行率", ["{dept}", "{program}", "執行率"]),
+    ("請問{program}的執行成果與績效亮點", ["{program}", "成果", "績效", "人次", "成長率"]),
+    ("{program}的申請資格為何", ["{program}", "申請資格"]),
+    ("根據{year}年度報告中{dept}的投資金額", ["{dept}", "投資金額", "{year}年"]),
+    ("幫我寫一篇關於{program}的致詞稿", ["{program}", "成果"]),
+]
+
+
+def make_regulation_doc(rng, program):
+    lines = [f"# 臺南市{program}實施要點", ""]
+    for n in range(1, rng.randint(6, 14)):
+        lines.append(f"第{n}條 為推動{program}，{rng.choice(DEPARTMENTS)}應依下列規定辦理。"
+                     + "".join(f"申請人應檢附{rng.choice(['申請書', '計畫書', '切結書', '證明文件'])}，"
+                               f"補助金額以 {rng.randint(1, 500)} 萬元為上限。" for _ in range(rng.randint(1, 4))))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def make_report_doc(rng, dept, year):
+    lines = [f"# {dept}{year}年度績效報告", ""]
+    for s, numeral in enumerate(["一", "二", "三", "四", "五"][:rng.randint(2, 5)]):
+        program = rng.choice(PROGRAMS)
+        lines.append(f"{numeral}、{program}")
+        lines.append(f"{year}年度推動{program}，" + "".join(
+            f"{rng.choice(INDICATORS)}達 {rng.randint(10, 9999):,} {rng.choice(['萬元', '億元', '人次', '家', '%'])}，"
+            for _ in range(rng.randint(2, 6))) + "較前一年度持續成長。")
+        lines.append("")
+        lines.append("| 計畫名稱 | 預算數(千元) | 決算數(千元) | 執行率 |")
+        lines.append("| --- | --- | --- | --- |")
+        for _ in range(rng.randint(3, 12)):
+            budget = rng.randint(1000, 900000)
+            spent = int(budget * rng.uniform(0.4, 1.0))
+            lines.append(f"| {rng.choice(PROGRAMS)}{rng.choice(['計畫', '工程', '方案'])} | {budget:,} | {spent:,} | {spent / budget:.1%} |")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def make_corpus(n_docs, seed=0):
+    """回傳 [(文件名稱, markdown)]；報告與法規約 2:1"""
+    rng = random.Random(seed)
+    docs = []
+    for i in range(n_docs):
+        if i % 3 == 2:
+            program = rng.choice(PROGRAMS)
+            docs.append((f"{program}實施要點_{i}", make_regulation_doc(rng, program)))
+        else:
+            dept, year = rng.choice(DEPARTMENTS), rng.choice(YEARS)
+            docs.append((f"{dept}{year}年度績效報告_{i}", make_report_doc(rng, dept, year)))
+    return docs
+
+
+def make_queries(n_queries, seed=0):
+    """回傳 [(問題, 核心關鍵字)]；核心關鍵字代替 LLM 提取的結果"""
+    rng = random.Random(seed)
+    queries = []
+    for i in range(n_queries):
+        template, keywords = QUERY_TEMPLATES[i % len(QUERY_TEMPLATES)]
+        values = {"year": rng.choice(YEARS), "dept": rng.choice(DEPARTMENTS), "program": rng.choice(PROGRAMS)}
+        queries.append((template.format(**values), [k.format(**values) for k in keywords]))
+    return queries
+
+
+def build_corpus(db_path, n_docs, seed):
+    """與 main_pipeline_v5 相同：切分成圖譜、ID 加上文件前綴，再交給 VectorDBBuilder 建庫"""
+    builder = db_builder.VectorDBBuilder(db_path=db_path)
+    for doc_index, (doc_name, md_content) in enumerate(make_corpus(n_docs, seed)):
+        graph_data = chunker.parse_markdown_to_graph(md_content, doc_name=doc_name)
+        id_mapping = {}
+        for node in graph_data['nodes']:
+            new_id = f"d{doc_index:05d}_{node['id']}"
+            id_mapping[node['id']] = new_id
+            node['id'] = new_id
+        for edge in graph_data['edges']:
+            edge['source'] = id_mapping.get(edge['source'], edge['source'])
+            edge['target'] = id_mapping.get(edge['target'], edge['target'])
+        builder.ingest_graph_data(graph_data)
+    return builder
+
+
+# ==========================================
+# 檢索流程重播
+# ==========================================
+def run_query(builder, embedder, token_counter, query, core_keywords, timings):
+    def timed(stage, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        timings[stage].append((time.perf_counter() - t0) * 1000)
+        return result
+
+    expanded = timed("keyword_expansion", my_rag.expand_keywords_by_intent, query, core_keywords)[:8]
+    query_vec = timed("embedding", embedder.encode, [query])
+    vector_results = timed("vector_search", builder.collection.query,
+                           query_embeddings=np.asarray(query_vec).tolist(), n_results=VECTOR_N_RESULTS,
+                           include=['documents', 'metadatas', 'distances'])
+    kw_results = timed("keyword_scan", builder.keyword_search, expanded, limit_per_keyword=50)
+    bm25_results = timed("bm25", builder.bm25_search, query, top_k=BM25_TOP_K)
+
+    candidates_map = timed("fusion", fuse_candidates, vector_results, bm25_results, kw_results)
+    reranked = timed("rerank", my_rag.advanced_reranker, query,
+                     [v["doc"] for v in candidates_map.values()],
+                     [v["meta"] for v in candidates_map.values()],
+                     [v["distance"] for v in candidates_map.values()],
+                     top_n=60, decay_rate=0.98, keywords=core_keywords, ids=list(candidates_map.keys()),
+                     rrf_scores=[v.get("rrf_score") for v in candidates_map.values()])
+    merged = timed("merge", my_rag.group_and_merge_results, reranked)
+    return timed("context", assemble_context, query, merged, token_counter)
+
+
+def assemble_context(query, results, token_counter):
+    """與 rag_server.build_prompt_context 的 Step 6 相同 (不含 Context 壓縮)：選樣板、切片段、背包打包"""
+    prompt_template = get_template(select_intent(my_rag.detect_query_intents(query)))
+    blocks, block_scores, block_tokens = context_blocks(results, token_counter)
+    budget = context_token_budget(
+        LLM_CONTEXT_WINDOW, MAX_TOKENS,
+        prompt_template.static_token_count(token_counter) + token_counter.count(query),
+        margin=CONTEXT_TOKEN_MARGIN
+    )
+    selected, _ = pack_context(block_scores, block_tokens, budget)
+    return "".join(blocks[i] for i in selected)
+
+
+def percentiles(samples):
+    arr = np.asarray(samples, dtype=np.float64)
+    return {f"p{p}": round(float(np.percentile(arr, p)), 3) for p in (50, 95, 99)}
+
+
+def bench_size(n_docs, queries, embedder, args):
+    db_path = tempfile.mkdtemp(prefix=f"bench_retrieval_{n_docs}_")
+    try:
+        t0 = time.perf_counter()
+        # 建庫過程的 print / tqdm 很多，統一收掉
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            builder = build_corpus(db_path, n_docs, args.seed)
+        build_s = time.perf_counter() - t0
+        token_counter = get_token_counter()
+
+        # 暖機 (BM25 索引在第一次查詢時建立)，不列入統計
+        warm = {stage: [] for stage in STAGES}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for query, keywords in queries:
+                run_query(builder, embedder, token_counter, query, keywords, warm)
+
+        timings = {stage: [] for stage in STAGES}
+        totals = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(args.repeat):
+                for query, keywords in queries:
+                    t_query = time.perf_counter()
+                    run_query(builder, embedder, token_counter, query, keywords, timings)
+                    totals.append((time.perf_counter() - t_query) * 1000)
+
+        report = {stage: percentiles(samples) for stage, samples in timings.items()}
+        report["total"] = percentiles(totals)
+        return {"docs": n_docs, "chunks": builder.collection.count(), "build_s": round(build_s, 2), "stages_ms": report}
+    finally:
+        shutil.rmtree(db_path, ignore_errors=True)
+
+
+def print_report(result, baseline=None):
+    print(f"\n=== 文件數 {result['docs']}，chunk 數 {result['chunks']}，建庫 {result['build_s']:.1f}s ===")
+    header = f"{'階段':<18} {'p50(ms)':>10} {'p95(ms)':>10} {'p99(ms)':>10}"
+    if baseline:
+        header += f" {'p95 vs 基準':>12}"
+    print(header)
+    for stage, stats in result["stages_ms"].items():
+        line = f"{stage:<18} {stats['p50']:>10.3f} {stats['p95']:>10.3f} {stats['p99']:>10.3f}"
+        base = (baseline or {}).get(stage)
+        if base and base["p95"] > 0:
+            line += f" {stats['p95'] / base['p95'] - 1:>+11.1%}"
+        print(line)
+
+
+def find_regressions(result, baseline, max_regression, min_delta_ms):
+    """p95 比基準慢超過 max_regression (比例) 且差距超過 min_delta_ms 的階段 (排除計時雜訊)"""
+    regressions = []
+    for stage, stats in result["stages_ms"].items():
+        base = baseline.get(stage)
+        if not base:
+            continue
+        delta = stats["p95"] - base["p95"]
+        if delta > min_delta_ms and base["p95"] > 0 and delta / base["p95"] > max_regression:
+            regressions.append((result["docs"], stage, base["p95"], stats["p95"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 80, 320], help="語料文件數 (每個大小各建一次庫)")
+    parser.add_argument("--queries", type=int, default=24)
+    parser.add_argument("--repeat", type=int, default=5, help="問題集重播次數")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--embedding-model", default=None,
+                        help="改用真正的 Embedding 模型 (CPU)；預設為可重現的 hash 向量")
+    parser.add_argument("--output", default=None, help="把結果存成 JSON (可作為之後的 --baseline)")
+    parser.add_argument("--baseline", default=None, help="與先前 --output 的結果比較 p95")
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    parser.add_argument("--min-delta-ms", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.embedding_model:
+        from embedding_backends import load_embedding_backend
+        embedder = load_embedding_backend(args.embedding_model, device="cpu")
+    else:
+        embedder = HashEmbedding()
+    # VectorDBBuilder 內部會自己載入模型，這裡換成同一個 embedder (建庫與查詢用同一套向量)
+    db_builder.load_embedding_backend = lambda model_path: embedder
+
+    queries = make_queries(args.queries, args.seed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = {r["docs"]: r["stages_ms"] for r in json.load(f)["results"]}
+
+    print(f"Embedding: {getattr(embedder, 'name', args.embedding_model)}，問題 {len(queries)} 題 x {args.repeat} 次")
+    results = []
+    regressions = []
+    for n_docs in args.sizes:
+        result = bench_size(n_docs, queries, embedder, args)
+        results.append(result)
+        base = (baseline or {}).get(n_docs)
+        print_report(result, base)
+        if base:
+            regressions += find_regressions(result, base, args.max_regression, args.min_delta_ms)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"embedding": getattr(embedder, "name", args.embedding_model), "queries": len(queries),
+                       "repeat": args.repeat, "seed": args.seed, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\n結果已寫入 {args.output}")
+
+    if regressions:
+        print("\n以下階段的 p95 比基準慢：")
+        for n_docs, stage, before, after in regressions:
+            print(f"  文件數 {n_docs} {stage}: {before:.3f} -> {after:.3f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
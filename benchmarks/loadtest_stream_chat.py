@@ -0,0 +1,424 @@
+"""
+/stream-chat 端到端壓力測試：本機 OpenAI 相容的 vLLM 替身 + 併發 SSE 客戶端。
+沒有 GPU 的筆電也能量測「一個 backend 能同時撐住多少條串流」，以及修改 rag_server 併發相關程式前後的差異。
+
+用法 (三個終端機)：
+    # 1. vLLM 替身：首字延遲 300ms、每條串流 30 tokens/s、每個回答 200 tokens，最多同時生成 64 條 (模擬 vLLM max-num-seqs)
+    python benchmarks/loadtest_stream_chat.py mock --port 8000 --ttft-ms 300 --tokens-per-sec 30 --output-tokens 200 --max-num-seqs 64
+
+    # 2. backend 指向替身 (壓測時關掉每位使用者的頻率限制，准入上限依要測的設定調整)
+    VLLM_API_BASE=http://localhost:8000/v1 CHAT_RATE_PER_MINUTE=0 MAX_CONCURRENT_CHATS=32 python rag_server.py
+
+    # 3. 開 50 條併發串流，共送 200 個請求
+    python benchmarks/loadtest_stream_chat.py run --url http://localhost:8001 --concurrency 50 --requests 200 \\
+        --mock-url http://localhost:8000
+
+輸出：
+    - TTFT (送出請求到收到第一段回答)、檢索完成時間 (search_results 事件)、每條串流的 tokens/s、整體 tokens/s
+    - 錯誤率 (HTTP 狀態碼 / SSE error 事件 / 連線例外分開統計)、排隊過的請求數
+    - backend event loop 延遲：壓測期間每隔 --probe-interval 秒打一次 /health (只回傳常數的 async 端點)，
+      回應時間即為「event loop 被卡住多久」的近似；另外也量客戶端自己的 event loop 延遲，
+      客戶端延遲偏高時代表壓測程式本身是瓶頸，數字不可信
+替身伺服器每個 token 輸出一個中文字，所以客戶端以字數計算的 tokens/s 與替身的設定可以直接對照。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+SAMPLE_QUESTIONS = [
+    "臺南市今年度的社會福利預算是多少？",
+    "青年創業補助的申請資格為何",
+    "113年度觀光旅遊局的施政成果有哪些亮點",
+    "交通局停車場興建計畫的執行率",
+    "防災演練辦理幾場、參與人數多少人",
+    "環保局資源回收的績效指標",
+    "長照服務的預算與執行狀況",
+    "產業園區招商的投資金額",
+]
+
+TOKEN_TEXT = "根據資料顯示本市相關計畫之預算執行率穩定成長各項指標均達成年度目標"
+
+
+# ==========================================
+# OpenAI 相容的 vLLM 替身
+# ==========================================
+class MockStats:
+    def __init__(self):
+        self.requests = 0
+        self.streams = 0
+        self.active = 0
+        self.max_active = 0
+        self.waiting = 0
+        self.aborted = 0
+        self.completion_tokens = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def make_mock_app(args):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+
+    app = FastAPI()
+    stats = MockStats()
+    # 模擬 vLLM 的 max-num-seqs：超過的請求在替身內排隊，TTFT 會跟著變長
+    slots = asyncio.Semaphore(args.max_num_seqs) if args.max_num_seqs > 0 else None
+    rng = random.Random(args.seed)
+
+    def n_tokens(payload):
+        return max(1, min(payload.get("max_tokens") or args.output_tokens, args.output_tokens))
+
+    def ttft():
+        jitter = rng.uniform(-args.jitter, args.jitter) if args.jitter else 0.0
+        return max(0.0, args.ttft_ms / 1000 * (1 + jitter))
+
+    def chunk(payload, content=None, finish_reason=None, usage=None):
+        body = {
+            "id": "loadtest", "object": "chat.completion.chunk", "created": int(time.time()), "model": payload.get("model"),
+            "choices": [] if usage else [{"index": 0, "delta": {"content": content} if content else {}, "finish_reason": finish_reason}],
+        }
+        if usage:
+            body["usage"] = usage
+        return f"data: {json.dumps(body, ensure_ascii=False)}\n\n"
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": args.model, "object": "model"}]}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats.as_dict()
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        payload = await request.json()
+        stats.requests += 1
+        if not payload.get("stream"):
+            # 非串流 (關鍵字提取)：回傳固定的關鍵字，只模擬首字延遲
+            await asyncio.sleep(ttft())
+            return {
+                "id": "loadtest", "object": "chat.completion", "created": int(time.time()), "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "預算, 執行率, 計畫"}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 5, "total_tokens": 5},
+            }
+
+        include_usage = (payload.get("stream_options") or {}).get("include_usage")
+        total = n_tokens(payload)
+
+        async def generate():
+            stats.streams += 1
+            stats.waiting += 1
+            acquired = active = False
+            sent = 0
+            try:
+                if slots is not None:
+                    await slots.acquire()
+                    acquired = True
+                stats.waiting -= 1
+                stats.active += 1
+                active = True
+                stats.max_active = max(stats.max_active, stats.active)
+                await asyncio.sleep(ttft())
+                # 以絕對時間排程每個 token，避免 sleep 誤差累積
+                started = time.perf_counter()
+                for i in range(total):
+                    delay = started + i / args.tokens_per_sec - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    yield chunk(payload, TOKEN_TEXT[i % len(TOKEN_TEXT)])
+                    sent += 1
+                yield chunk(payload, finish_reason="stop")
+                if include_usage:
+                    yield chunk(payload, usage={"prompt_tokens": 0, "completion_tokens": sent, "total_tokens": sent})
+                yield "data: [DONE]\n\n"
+            finally:
+                # backend 中途關閉連線 (客戶端斷線) 時會走到這裡
+                if active:
+                    stats.active -= 1
+                else:
+                    stats.waiting -= 1
+                if sent < total:
+                    stats.aborted += 1
+                stats.completion_tokens += sent
+                if acquired:
+                    slots.release()
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+def run_mock(args):
+    import uvicorn
+    print(f"vLLM 替身：http://{args.host}:{args.port}/v1 (TTFT {args.ttft_ms}ms、{args.tokens_per_sec} tokens/s、"
+          f"{args.output_tokens} tokens/回答、max-num-seqs {args.max_num_seqs or '不限'})")
+    uvicorn.run(make_mock_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+# ==========================================
+# 併發 SSE 客戶端
+# ==========================================
+class StreamResult:
+    def __init__(self):
+        self.status = None
+        self.error = None
+        self.queued = False
+        self.search_ms = None
+        self.ttft_ms = None
+        self.total_ms = None
+        self.chars = 0
+        self.first_at = None
+        self.last_at = None
+
+    @property
+    def ok(self):
+        return self.status == 200 and self.error is None
+
+    def tokens_per_sec(self):
+        if self.first_at is None or self.last_at is None or self.last_at <= self.first_at or self.chars < 2:
+            return None
+        return (self.chars - 1) / (self.last_at - self.first_at)
+
+
+async def login(client, url, username, password):
+    resp = await client.post(f"{url}/token", data={"username": username, "password": password})
+    resp.raise_for_status()
+    return resp.json()["access_token"]
+
+
+async def run_stream(client, url, headers, question, args):
+    result = StreamResult()
+    body = {"message": question, "session_id": uuid.uuid4().hex,
+            "temperature": args.temperature, "max_tokens": args.max_tokens}
+    started = time.perf_counter()
+    try:
+        async with client.stream("POST", f"{url}/stream-chat", json=body, headers=headers) as resp:
+            result.status = resp.status_code
+            if resp.status_code != 200:
+                await resp.aread()
+                result.error = f"HTTP {resp.status_code}"
+                return result
+            async for line in resp.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[6:]
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                now = time.perf_counter()
+                kind = event.get("type")
+                if kind == "chunk":
+                    if result.first_at is None:
+                        result.first_at = now
+                        result.ttft_ms = (now - started) * 1000
+                    result.last_at = now
+                    result.chars += len(event.get("content") or "")
+                elif kind == "search_results":
+                    result.search_ms = (now - started) * 1000
+                elif kind == "progress" and "排隊" in (event.get("content") or ""):
+                    result.queued = True
+                elif kind == "error":
+                    result.error = f"SSE error: {event.get('error')}"
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        result.total_ms = (time.perf_counter() - started) * 1000
+    return result
+
+
+async def probe_health(client, url, interval, samples, stop):
+    """backend event loop 延遲的近似：/health 的回應時間"""
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        try:
+            await client.get(f"{url}/health")
+            samples.append((time.perf_counter() - t0) * 1000)
+        except Exception:
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def measure_own_lag(interval, samples, stop):
+    """客戶端自己的 event loop 延遲：sleep(interval) 實際多睡了多久"""
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, (time.perf_counter() - t0 - interval) * 1000))
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    arr = np.asarray(values, dtype=np.float64)
+    return {"p50": round(float(np.percentile(arr, 50)), 1), "p95": round(float(np.percentile(arr, 95)), 1),
+            "p99": round(float(np.percentile(arr, 99)), 1), "max": round(float(arr.max()), 1)}
+
+
+async def run_load(args):
+    import httpx
+
+    questions = SAMPLE_QUESTIONS
+    if args.questions:
+        with open(args.questions, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    limits = httpx.Limits(max_connections=args.concurrency + 8, max_keepalive_connections=args.concurrency + 8)
+    timeout = httpx.Timeout(args.timeout, connect=10.0)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client, \
+            httpx.AsyncClient(timeout=httpx.Timeout(10.0)) as probe_client:
+        token = await login(client, args.url, args.username, args.password)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        results = []
+        next_index = 0
+        rng = random.Random(args.seed)
+
+        async def worker(worker_id):
+            nonlocal next_index
+            # 逐步加壓：各 worker 在 ramp-up 期間平均錯開啟動
+            if args.ramp_up > 0:
+                await asyncio.sleep(args.ramp_up * worker_id / args.concurrency)
+            while next_index < args.requests:
+                next_index += 1
+                results.append(await run_stream(client, args.url, headers, rng.choice(questions), args))
+
+        stop = asyncio.Event()
+        health_ms, own_lag_ms = [], []
+        monitors = [
+            asyncio.create_task(probe_health(probe_client, args.url, args.probe_interval, health_ms, stop)),
+            asyncio.create_task(measure_own_lag(args.probe_interval, own_lag_ms, stop)),
+        ]
+        print(f"開始壓測：{args.concurrency} 條併發串流，共 {args.requests} 個請求 -> {args.url}")
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*monitors)
+
+        mock_stats = None
+        if args.mock_url:
+            try:
+                mock_stats = (await probe_client.get(f"{args.mock_url.rstrip('/')}/stats")).json()
+            except Exception as e:
+                print(f"無法取得替身伺服器統計: {e}")
+
+    ok = [r for r in results if r.ok]
+    status_counts = {}
+    for r in results:
+        if not r.ok:
+            # 依類別計數 (例外訊息常帶位址、時間，直接當 key 會變成一堆只出現一次的項目)；完整訊息只留在 sample_errors
+            if r.status is None:
+                key = "exception"
+            elif r.status != 200:
+                key = f"HTTP {r.status}"
+            else:
+                key = "SSE error" if r.error.startswith("SSE error") else "exception"
+            status_counts[key] = status_counts.get(key, 0) + 1
+    total_chars = sum(r.chars for r in ok)
+    return {
+        "concurrency": args.concurrency,
+        "requests": len(results),
+        "elapsed_s": round(elapsed, 2),
+        "ok": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors": status_counts,
+        "sample_errors": [r.error for r in results if not r.ok][:5],
+        "queued": sum(r.queued for r in results),
+        "requests_per_sec": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "aggregate_tokens_per_sec": round(total_chars / elapsed, 1) if elapsed else 0.0,
+        "ttft_ms": summarize([r.ttft_ms for r in ok]),
+        "search_ms": summarize([r.search_ms for r in ok]),
+        "total_ms": summarize([r.total_ms for r in ok]),
+        "stream_tokens_per_sec": summarize([r.tokens_per_sec() for r in ok]),
+        "backend_loop_lag_ms": summarize(health_ms),
+        "client_loop_lag_ms": summarize(own_lag_ms),
+        "mock": mock_stats,
+    }
+
+
+def print_report(report):
+    print(f"\n=== {report['concurrency']} 條併發，{report['requests']} 個請求，耗時 {report['elapsed_s']}s ===")
+    print(f"成功 {report['ok']}，錯誤率 {report['error_rate']:.1%}，排隊過 {report['queued']} 個，"
+          f"{report['requests_per_sec']} req/s，整體 {report['aggregate_tokens_per_sec']} tokens/s")
+    if report["errors"]:
+        print(f"錯誤分類：{report['errors']}")
+        for error in report["sample_errors"]:
+            print(f"  例：{error}")
+        if any(key == "HTTP 429" for key in report["errors"]):
+            print("  (429：backend 的每位使用者頻率限制，壓測時請以 CHAT_RATE_PER_MINUTE=0 啟動)")
+    print(f"\n{'指標':<28} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for key, label in [("ttft_ms", "TTFT (ms)"), ("search_ms", "檢索完成 (ms)"), ("total_ms", "整段回答 (ms)"),
+                       ("stream_tokens_per_sec", "每條串流 tokens/s"), ("backend_loop_lag_ms", "backend loop 延遲 (ms)"),
+                       ("client_loop_lag_ms", "客戶端 loop 延遲 (ms)")]:
+        stats = report[key]
+        if stats:
+            print(f"{label:<28} {stats['p50']:>9} {stats['p95']:>9} {stats['p99']:>9} {stats['max']:>9}")
+    client_lag = report["client_loop_lag_ms"]
+    if client_lag and client_lag["p95"] > 50:
+        print("\n警告：客戶端 event loop 延遲偏高，壓測程式本身可能是瓶頸 (請降低併發數或分多台執行)")
+    if report["mock"]:
+        print(f"\n替身伺服器：{report['mock']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    mock = sub.add_parser("mock", help="啟動 OpenAI 相容的 vLLM 替身伺服器")
+    mock.add_argument("--host", default="127.0.0.1")
+    mock.add_argument("--port", type=int, default=8000)
+    mock.add_argument("--model", default=os.getenv("VLLM_MODEL", "ISTA-DASLab/gemma-3-27b-it-GPTQ-4b-128g"))
+    mock.add_argument("--ttft-ms", type=float, default=300, help="首字延遲 (毫秒)")
+    mock.add_argument("--jitter", type=float, default=0.2, help="首字延遲的隨機浮動比例 (0.2 = ±20%%)")
+    mock.add_argument("--tokens-per-sec", type=float, default=30, help="每條串流的生成速度")
+    mock.add_argument("--output-tokens", type=int, default=200, help="每個回答的 token 數 (不超過請求的 max_tokens)")
+    mock.add_argument("--max-num-seqs", type=int, default=64, help="同時生成的串流上限 (0 = 不限)")
+    mock.add_argument("--seed", type=int, default=0)
+
+    run = sub.add_parser("run", help="對 backend 開 N 條併發的 /stream-chat 串流")
+    run.add_argument("--url", default="http://localhost:8001")
+    run.add_argument("--username", default="root")
+    run.add_argument("--password", default=os.getenv("MYSQL_ROOT_PASSWORD", "root"))
+    run.add_argument("--concurrency", type=int, default=20)
+    run.add_argument("--requests", type=int, default=100)
+    run.add_argument("--ramp-up", type=float, default=0.0, help="在幾秒內逐步開到全部併發數")
+    run.add_argument("--questions", default=None, help="問題檔 (一行一題)；預設使用內建問題")
+    # 回答快取只對 temperature=0 生效，預設用 0.7 讓每個請求都真的走到生成
+    run.add_argument("--temperature", type=float, default=0.7)
+    run.add_argument("--max-tokens", type=int, default=512)
+    run.add_argument("--timeout", type=float, default=300.0, help="單一串流的讀取逾時 (秒)")
+    run.add_argument("--probe-interval", type=float, default=0.1, help="event loop 延遲的取樣間隔 (秒)")
+    run.add_argument("--mock-url", default=None, help="替身伺服器位址 (結束時一併列出替身的統計)")
+    run.add_argument("--output", default=None, help="把結果存成 JSON")
+    run.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == "mock":
+        run_mock(args)
+        return
+
+    report = asyncio.run(run_load(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n結果已寫入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
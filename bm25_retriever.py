@@ -0,0 +1,225 @@
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+# ==========================================
+# BM25 稀疏檢索 + Reciprocal Rank Fusion
+# ==========================================
+# calculate_keyword_score 只看「有沒有出現」，不考慮詞頻 (TF) 與文件頻率 (DF)。
+# 這裡對所有 chunk 建立 BM25 索引，分詞方式針對中文：
+#   - 連續的中日韓文字：切成字元 bigram (單一字元時保留 unigram)
+#   - 英文 / 數字：整個 token (小寫)
+# 語料統計 (N、DF、平均長度) 會隨寫入/刪除即時更新，不必整批重建；
+# 刪除 / 覆蓋留下的墓碑 slot 超過 COMPACT_RATIO 時重新編號，記憶體與查詢時間不會隨重複建庫一直長大。
+# 檢索結果再與向量搜尋結果用 RRF 融合。
+
+# 混合檢索：向量取前 VECTOR_N_RESULTS 筆、BM25 取前 BM25_TOP_K 筆，以 RRF 融合後保留前 FUSED_TOP_K 筆
+# (rag_server 與 benchmarks/bench_retrieval.py 共用這組設定)
+VECTOR_N_RESULTS = int(os.getenv("VECTOR_N_RESULTS", "100"))
+BM25_TOP_K = int(os.getenv("BM25_TOP_K", "50"))
+FUSED_TOP_K = int(os.getenv("FUSED_TOP_K", "120"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# 墓碑 slot 佔比超過此值時壓縮 (重新編號並清掉 postings 中殘留的 slot)
+COMPACT_RATIO = 0.25
+
+_TOKEN_RE = re.compile(r'([㐀-鿿豈-﫿]+)|([a-z0-9]+(?:\.[0-9]+)?%?)')
+
+
+def tokenize(text):
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKC", text).casefold()
+    tokens = []
+    for cjk, word in _TOKEN_RE.findall(text):
+        if cjk:
+            if len(cjk) == 1:
+                tokens.append(cjk)
+            else:
+                tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+class BM25Index:
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._ids = []              # slot -> chunk id (刪除後為 None)
+            self._id_to_slot = {}
+            self._doc_len = []          # slot -> token 數
+            self._postings = {}         # term -> {slot: tf}
+            self._total_len = 0
+            self._deleted = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._id_to_slot)
+
+    def add(self, ids, texts):
+        with self._lock:
+            for doc_id, text in zip(ids, texts):
+                if doc_id in self._id_to_slot:
+                    self._remove_one(doc_id)
+                tokens = tokenize(text)
+                slot = len(self._ids)
+                self._ids.append(doc_id)
+                self._id_to_slot[doc_id] = slot
+                self._doc_len.append(len(tokens))
+                self._total_len += len(tokens)
+                for term, tf in Counter(tokens).items():
+                    self._postings.setdefault(term, {})[slot] = tf
+            self._maybe_compact()
+
+    def remove(self, ids, texts):
+        """刪除 chunk；需要原文才能把 DF 扣回來"""
+        with self._lock:
+            for doc_id, text in zip(ids, texts):
+                if doc_id not in self._id_to_slot:
+                    continue
+                slot = self._id_to_slot[doc_id]
+                for term in set(tokenize(text)):
+                    posting = self._postings.get(term)
+                    if posting is not None:
+                        posting.pop(slot, None)
+                        if not posting:
+                            del self._postings[term]
+                self._remove_one(doc_id)
+            self._maybe_compact()
+
+    def _remove_one(self, doc_id):
+        slot = self._id_to_slot.pop(doc_id)
+        self._ids[slot] = None
+        self._total_len -= self._doc_len[slot]
+        self._doc_len[slot] = 0
+        self._deleted += 1
+        # add() 覆蓋舊 id 時不知道舊文字，postings 中殘留的 slot 在查詢時略過 (也不計入 DF)，
+        # 等 compact() 時再清掉；呼叫端有舊文字時應先 remove() 再 add()
+
+    def _maybe_compact(self):
+        if self._ids and self._deleted / len(self._ids) > COMPACT_RATIO:
+            self.compact()
+
+    def compact(self):
+        """丟掉墓碑 slot 並重新編號 (postings 中殘留的舊 slot 一併清除)"""
+        with self._lock:
+            new_slot = {}
+            ids, doc_len = [], []
+            for slot, doc_id in enumerate(self._ids):
+                if doc_id is not None:
+                    new_slot[slot] = len(ids)
+                    ids.append(doc_id)
+                    doc_len.append(self._doc_len[slot])
+            postings = {}
+            for term, posting in self._postings.items():
+                remapped = {new_slot[slot]: tf for slot, tf in posting.items() if slot in new_slot}
+                if remapped:
+                    postings[term] = remapped
+            self._ids = ids
+            self._id_to_slot = {doc_id: slot for slot, doc_id in enumerate(ids)}
+            self._doc_len = doc_len
+            self._postings = postings
+            self._deleted = 0
+
+    def search(self, query, top_k=50):
+        """回傳 [(chunk_id, bm25_score), ...]，分數由高到低"""
+        with self._lock:
+            n_docs = len(self._id_to_slot)
+            if not n_docs:
+                return []
+            avgdl = self._total_len / n_docs
+            k1, b = self.k1, self.b
+            scores = {}
+            for term, qtf in Counter(tokenize(query)).items():
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                # add() 覆蓋舊 id 時殘留的 slot 不算進 DF，否則重複建庫會讓 IDF 越來越低
+                live = [(slot, tf) for slot, tf in posting.items() if self._ids[slot] is not None]
+                if not live:
+                    continue
+                df = len(live)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                for slot, tf in live:
+                    denom = tf + k1 * (1 - b + b * self._doc_len[slot] / avgdl)
+                    scores[slot] = scores.get(slot, 0.0) + qtf * idf * tf * (k1 + 1) / denom
+
+            ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:top_k]
+            return [(self._ids[slot], score) for slot, score in ranked]
+
+    def rebuild_from_collection(self, collection, batch_size=1000):
+        with self._lock:
+            self.clear()
+            total = collection.count()
+            for offset in range(0, total, batch_size):
+                batch = collection.get(limit=batch_size, offset=offset, include=['documents'])
+                self.add(batch['ids'], batch['documents'])
+        print(f"[BM25] 已由向量資料庫建立索引: {len(self)} 筆")
+
+
+def reciprocal_rank_fusion(ranked_lists, k=60, top_n=None):
+    """
+    Reciprocal Rank Fusion：score(d) = sum(1 / (k + rank_i(d)))，rank 從 1 起算。
+    ranked_lists: 多個依相關度排好的 id 列表。
+    回傳 [(id, rrf_score), ...]，同分時依第一次出現的順序。
+    """
+    scores = {}
+    for ranked in ranked_lists:
+        for rank, doc_id in enumerate(ranked, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    fused = sorted(scores.items(), key=lambda x: -x[1])
+    return fused[:top_n] if top_n else fused
+
+
+def fuse_candidates(vector_results, bm25_results=None, kw_results=None, k=RRF_K, top_n=FUSED_TOP_K):
+    """
+    合併三路檢索的候選：向量 (collection.query 格式) 與 BM25 先以 RRF 融合取前 top_n，
+    再依序補上關鍵字強制搜尋的結果 (已依匹配強度排序)。
+    回傳 {id: {"doc", "meta", "distance", "source"[, "rrf_score"]}}，依融合後的順序。
+    """
+    pool = {}
+    vector_ids = []
+    if vector_results and vector_results['documents']:
+        vector_ids = vector_results['ids'][0]
+        for i, doc_id in enumerate(vector_ids):
+            pool[doc_id] = {
+                "doc": vector_results['documents'][0][i],
+                "meta": vector_results['metadatas'][0][i],
+                "distance": vector_results['distances'][0][i],
+                "source": "vector"
+            }
+    bm25_ids = []
+    if bm25_results and bm25_results['ids']:
+        bm25_ids = bm25_results['ids']
+        for i, doc_id in enumerate(bm25_ids):
+            if doc_id not in pool:
+                pool[doc_id] = {
+                    "doc": bm25_results['documents'][i],
+                    "meta": bm25_results['metadatas'][i],
+                    "distance": None,
+                    "source": "bm25"
+                }
+
+    candidates_map = {}
+    for doc_id, rrf_score in reciprocal_rank_fusion([vector_ids, bm25_ids], k=k, top_n=top_n):
+        candidates_map[doc_id] = dict(pool[doc_id], rrf_score=rrf_score)
+
+    if kw_results and kw_results['ids']:
+        for i, doc_id in enumerate(kw_results['ids']):
+            if doc_id not in candidates_map:
+                candidates_map[doc_id] = {
+                    "doc": kw_results['documents'][i],
+                    "meta": kw_results['metadatas'][i],
+                    "distance": None,
+                    "source": "keyword"
+                }
+    return candidates_map
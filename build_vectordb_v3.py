@@ -2,15 +2,28 @@ import json
 import os
 import chromadb
 from chromadb import Documents, EmbeddingFunction, Embeddings
-from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 import torch
+import numpy as np
+
+from ngram_index import NgramIndex
+from bm25_retriever import BM25Index
+from embedding_backends import load_embedding_backend
+from context_packer import get_token_counter
+import threading
 
 # --- 設定區 ---
 JSON_PATH = "graph_data_final.json"
 MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH", "jinaai/jina-embeddings-v3")
 DB_PATH = os.getenv("CHROMA_DB_PATH", "./chroma_db")
 COLLECTION_NAME = "regulations_rag"
+# 關鍵字搜尋用的 n-gram 倒排索引 (存放在 ChromaDB 目錄下，重置資料庫時一起清掉)
+# 設定 CHROMA_HOST 時改連 Chroma 伺服器 (HttpClient)；多個行程 (uvicorn worker) 共用向量資料庫時必須使用，
+# 嵌入式 PersistentClient 不支援多行程同時開啟同一個目錄
+CHROMA_HOST = os.getenv("CHROMA_HOST", "")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+NGRAM_INDEX_SIZES = tuple(int(n) for n in os.getenv("NGRAM_INDEX_SIZES", "1,2").split(",") if n.strip())
+NGRAM_INDEX_PERSIST = os.getenv("NGRAM_INDEX_PERSIST", "1") == "1"
 
 def split_text_by_window(text, chunk_size=800, overlap=100):
     """
@@ -41,10 +54,15 @@ def split_text_by_window(text, chunk_size=800, overlap=100):
 
 class LocalJinaEmbeddingFunction(EmbeddingFunction):
     def __init__(self, model_path):
-        self.model = SentenceTransformer(model_path, trust_remote_code=True, device='cuda')
+        # 後端由 EMBEDDING_BACKEND / EMBEDDING_DEVICE 決定 (torch GPU/CPU 或量化 ONNX CPU)
+        self.model = load_embedding_backend(model_path)
+        # 由 rag_server 設定 EmbeddingScheduler 後，建庫走節流的 ingest 車道，與查詢共用模型
+        self.scheduler = None
 
     def __call__(self, input: Documents) -> Embeddings:
-        embeddings = self.model.encode(input).tolist()
+        if self.scheduler is not None:
+            return self.scheduler.encode(input, lane="ingest").tolist()
+        embeddings = np.asarray(self.model.encode(input)).tolist()
         return embeddings
 
 def build_parent_map(graph_data):
@@ -141,8 +159,12 @@ def find_root_doc(node_id, parent_map, nodes_by_id):
 
 class VectorDBBuilder:
     def __init__(self, db_path=DB_PATH, model_path=MODEL_PATH, collection_name=COLLECTION_NAME):
-        print(f"初始化 ChromaDB: {db_path}")
-        self.client = chromadb.PersistentClient(path=db_path)
+        if CHROMA_HOST:
+            print(f"連線 Chroma 伺服器: {CHROMA_HOST}:{CHROMA_PORT}")
+            self.client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+        else:
+            print(f"初始化 ChromaDB: {db_path}")
+            self.client = chromadb.PersistentClient(path=db_path)
         
         print(f"正在載入 Embedding 模型: {model_path}")
         self.ef = LocalJinaEmbeddingFunction(model_path)
@@ -153,6 +175,26 @@ class VectorDBBuilder:
             embedding_function=self.ef
         )
 
+        # 關鍵字倒排索引：先嘗試 mmap 載入，筆數對不上就從 Chroma 重建
+        ngram_dir = os.path.join(db_path, "ngram_index") if NGRAM_INDEX_PERSIST else None
+        self.ngram_index = NgramIndex(ngram_sizes=NGRAM_INDEX_SIZES, persist_dir=ngram_dir)
+        if not self.ngram_index.load() or len(self.ngram_index) != self.collection.count():
+            print("建立關鍵字 n-gram 索引...")
+            self.ngram_index.rebuild_from_collection(self.collection)
+
+        # BM25 索引：第一次查詢時才由 Chroma 建立 (純建庫腳本不需要付這個成本)
+        self.bm25_index = BM25Index()
+        self._bm25_ready = False
+        self._bm25_lock = threading.Lock()
+
+    def reload_indexes(self):
+        """其他行程 (worker) 更新過知識庫：重新載入 n-gram 索引，BM25 於下次查詢時重建"""
+        if not self.ngram_index.load() or len(self.ngram_index) != self.collection.count():
+            self.ngram_index.rebuild_from_collection(self.collection)
+        with self._bm25_lock:
+            self.bm25_index.clear()
+            self._bm25_ready = False
+
     def reset_collection(self):
         """如果想要清空資料庫，呼叫此函式"""
         try:
@@ -161,6 +203,9 @@ class VectorDBBuilder:
                 name=self.collection.name,
                 embedding_function=self.ef
             )
+            self.ngram_index.clear()
+            self.ngram_index.save()
+            self.bm25_index.clear()
             print("資料庫已清空")
         except:
             pass
@@ -244,20 +289,87 @@ class VectorDBBuilder:
                         meta['title'] = node['properties'].get('title', '')[:50]
                     metadatas.append(meta)
             
+        # 預先計算每個 chunk 的 token 數，查詢時打包 context 不必再跑 tokenizer
+        token_counter = get_token_counter()
+        for doc, meta in zip(documents, metadatas):
+            meta["token_count"] = token_counter.count(doc)
+            meta["token_counter"] = token_counter.name
+
         batch_size = 10
         total = len(documents)
         print(f"準備寫入 {total} 筆資料...")
         
         for i in tqdm(range(0, total, batch_size), desc="向量建庫進度"):
             end = min(i + batch_size, total)
-            self.collection.add(
+            if self._bm25_ready:
+                # 重新建庫同一份文件：先用舊文字把 BM25 的 DF 扣回來，再加入新內容
+                old = self.collection.get(ids=ids[i:end], include=['documents'])
+                if old['ids']:
+                    self.bm25_index.remove(old['ids'], old['documents'])
+            # 同一個 id 重新建庫時 add 不會覆蓋舊內容 (n-gram / BM25 卻已換成新文字)，改用 upsert 讓三者一致
+            self.collection.upsert(
                 ids=ids[i:end],
                 documents=documents[i:end],
                 metadatas=metadatas[i:end]
             )
+            self.ngram_index.add(ids[i:end], documents[i:end])
+            if self._bm25_ready:
+                self.bm25_index.add(ids[i:end], documents[i:end])
 
+        self.ngram_index.save()
         print(f"已寫入 {total} 筆資料")
 
+    def delete_documents(self, ids):
+        """從向量資料庫與關鍵字索引同步刪除 chunk"""
+        if not ids: return
+        if self._bm25_ready:
+            # BM25 需要原文才能扣回 DF，刪除前先取出
+            old = self.collection.get(ids=ids, include=['documents'])
+            self.bm25_index.remove(old['ids'], old['documents'])
+        self.collection.delete(ids=ids)
+        self.ngram_index.remove(ids)
+        self.ngram_index.save()
+
+    def keyword_search(self, keywords, limit_per_keyword=50):
+        """
+        多關鍵字一次查詢 (取代逐一呼叫 where_document={"$contains": kw})。
+        回傳格式同 collection.get，並依匹配強度排序，另附 scores / matched_keywords。
+        """
+        hits = self.ngram_index.search(keywords, limit_per_keyword=limit_per_keyword)
+        result = self.get_by_ids([h[0] for h in hits])
+        matched = {doc_id: (score, kws) for doc_id, score, kws in hits}
+        result["scores"] = [matched[doc_id][0] for doc_id in result["ids"]]
+        result["matched_keywords"] = [matched[doc_id][1] for doc_id in result["ids"]]
+        return result
+
+    def bm25_search(self, query, top_k=50):
+        """BM25 稀疏檢索，回傳格式同 collection.get，依 BM25 分數排序並附 scores"""
+        if not self._bm25_ready:
+            with self._bm25_lock:
+                if not self._bm25_ready:
+                    self.bm25_index.rebuild_from_collection(self.collection)
+                    self._bm25_ready = True
+        hits = self.bm25_index.search(query, top_k=top_k)
+        result = self.get_by_ids([doc_id for doc_id, _ in hits])
+        scores = dict(hits)
+        result["scores"] = [scores[doc_id] for doc_id in result["ids"]]
+        return result
+
+    def get_by_ids(self, ids):
+        """依給定順序取回 chunk (collection.get 不保證回傳順序)"""
+        result = {"ids": [], "documents": [], "metadatas": []}
+        if not ids:
+            return result
+        fetched = self.collection.get(ids=list(ids), include=['documents', 'metadatas'])
+        by_id = {doc_id: i for i, doc_id in enumerate(fetched['ids'])}
+        for doc_id in ids:
+            i = by_id.get(doc_id)
+            if i is None: continue
+            result["ids"].append(doc_id)
+            result["documents"].append(fetched['documents'][i])
+            result["metadatas"].append(fetched['metadatas'][i])
+        return result
+
 
 if __name__ == "__main__":
 
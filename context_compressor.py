@@ -0,0 +1,128 @@
+import re
+import time
+
+import numpy as np
+
+from pattern_matcher import MultiPatternMatcher
+
+# ==========================================
+# 抽取式 Context 壓縮 (選用)
+# ==========================================
+# 重排序勝出的 chunk 多半是 800 字的視窗，真正提到問題實體或數字的常常只有一兩句，
+# 其餘內容一樣要付 prefill 成本。這一層在 group_and_merge_results 之後、組 context 之前：
+#   - 一般 chunk 依句子切分 (。！？；與換行)，MergedTable 依表格列 (換行) 切分
+#   - 保留命中問題關鍵字 / 數字的片段，或與問題 embedding 相似度 >= 門檻的片段
+#   - 第一個片段 (來源標籤、上層標題) 與 MergedTable 的表頭一律保留
+#   - 沒有任何片段命中時維持原文 (重排序選中它一定有原因)
+#   - 被省略的地方以「…」標示，讓 LLM 知道內容不連續
+
+_SENTENCE_RE = re.compile(r'[^。！？；!?;\n]+[。！？；!?;]*')
+_NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)*%?')
+OMISSION = "…"
+
+
+def split_spans(text, is_table=False):
+    """表格依列切分；一般文字依句子切分 (保留句尾標點)"""
+    if is_table:
+        return [line for line in text.split("\n") if line.strip()]
+    return [m.group().strip() for m in _SENTENCE_RE.finditer(text) if m.group().strip()]
+
+
+class ContextCompressor:
+    def __init__(self, encode_fn=None, similarity_threshold=0.55, min_chars=300, neighbors=0):
+        """
+        encode_fn: list[str] -> 向量 (None 或 similarity_threshold <= 0 時只用關鍵字比對)
+        min_chars: 短於此長度的 chunk 不壓縮
+        neighbors: 命中片段前後各多保留幾個片段
+        """
+        self.encode_fn = encode_fn
+        self.similarity_threshold = similarity_threshold
+        self.min_chars = min_chars
+        self.neighbors = neighbors
+
+    def compress(self, query, keywords, results):
+        """
+        回傳 (新的結果列表, 統計資訊)。
+        被壓縮的項目會換成新的 dict：doc 為壓縮後內容、original_doc 保留原文，
+        meta 拿掉建庫時快取的 token_count (內容已變，要重新計算)。
+        """
+        start = time.perf_counter()
+        terms = [k for k in keywords if k] + _NUMBER_RE.findall(query)
+        matcher = MultiPatternMatcher(terms)
+        use_embedding = self.encode_fn is not None and self.similarity_threshold > 0
+
+        # 先切分並做關鍵字比對，需要算相似度的片段集中成一批 encode
+        plans = []
+        pending = []
+        for res in results:
+            doc = res['doc']
+            is_table = res['meta'].get('type') == 'MergedTable'
+            if len(doc) < self.min_chars:
+                plans.append(None)
+                continue
+            spans = split_spans(doc, is_table=is_table)
+            if len(spans) <= 1:
+                plans.append(None)
+                continue
+            keep = [bool(matcher.contains_any(s)) for s in spans]
+            keep[0] = True  # 來源標籤 / 表頭
+            if use_embedding:
+                for j in range(1, len(spans)):
+                    if not keep[j]:
+                        pending.append((len(plans), j, spans[j]))
+            plans.append((spans, keep, is_table))
+
+        if pending:
+            vectors = np.asarray(self.encode_fn([query] + [p[2] for p in pending]), dtype=np.float32)
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+            sims = vectors[1:] @ vectors[0]
+            for (plan_idx, j, _), sim in zip(pending, sims):
+                if sim >= self.similarity_threshold:
+                    plans[plan_idx][1][j] = True
+
+        compressed = []
+        chars_before = chars_after = n_compressed = 0
+        for res, plan in zip(results, plans):
+            chars_before += len(res['doc'])
+            if plan is None:
+                compressed.append(res)
+                chars_after += len(res['doc'])
+                continue
+            spans, keep, is_table = plan
+            # 只有開頭片段被保留 = 沒有任何命中，維持原文
+            if not any(keep[1:]) or all(keep):
+                compressed.append(res)
+                chars_after += len(res['doc'])
+                continue
+
+            selected = set()
+            for j, k in enumerate(keep):
+                if k:
+                    selected.update(range(max(0, j - self.neighbors), min(len(spans), j + self.neighbors + 1)))
+
+            parts = []
+            prev = -1
+            for j in sorted(selected):
+                if j != prev + 1:
+                    parts.append(OMISSION)
+                parts.append(spans[j])
+                prev = j
+            if prev != len(spans) - 1:
+                parts.append(OMISSION)
+            new_doc = ("\n" if is_table else "").join(parts)
+
+            meta = {k: v for k, v in res['meta'].items() if k != "token_count"}
+            compressed.append(dict(res, doc=new_doc, original_doc=res['doc'], meta=meta))
+            chars_after += len(new_doc)
+            n_compressed += 1
+
+        info = {
+            "chunks": len(results),
+            "compressed_chunks": n_compressed,
+            "chars_before": chars_before,
+            "chars_after": chars_after,
+            "ratio": round(chars_after / chars_before, 3) if chars_before else 1.0,
+            "embedded_spans": len(pending),
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+        return compressed, info
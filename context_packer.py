@@ -0,0 +1,145 @@
+import functools
+import os
+import re
+
+import numpy as np
+
+# ==========================================
+# Token 感知的 Context 打包器
+# ==========================================
+# 原本 Step 6 用字元數對 MAX_CONTEXT_CHARS 做貪婪選取，放不下就 continue：
+#   - 中文與表格在 Gemma tokenizer 下的 token 數和字元數差很多，prompt 可能爆掉也可能塞不滿
+#   - 貪婪法遇到一塊大 chunk 放不下時，不會回頭考慮「幾塊小的加起來更有價值」
+# 這裡改成：
+#   - 每個 chunk 的 token 數在建庫時就算好存進 metadata (token_count / token_counter)
+#   - 預算 = 模型 context window - max_tokens - prompt 其餘部分 - 安全邊際
+#   - 以「分數 / token」的 0/1 背包問題 (動態規劃) 選出總分最高、又不超過預算的組合
+
+CONTEXT_TOKENIZER_PATH = os.getenv("CONTEXT_TOKENIZER_PATH", os.getenv("VLLM_MODEL", "ISTA-DASLab/gemma-3-27b-it-GPTQ-4b-128g"))
+# 背包 DP 的 token 粒度：權重一律無條件進位到此倍數，保證不會超過預算
+CONTEXT_PACK_GRANULARITY = int(os.getenv("CONTEXT_PACK_GRANULARITY", "16"))
+
+# Context 預算：LLM_CONTEXT_WINDOW 需與 vLLM 的 --max-model-len 一致
+LLM_CONTEXT_WINDOW = int(os.getenv("LLM_CONTEXT_WINDOW", "25000"))
+CONTEXT_TOKEN_MARGIN = int(os.getenv("CONTEXT_TOKEN_MARGIN", "256"))
+CONTEXT_SEPARATOR_TOKENS = 2  # 每段之間的 "\n\n"
+
+_CJK_RE = re.compile(r'[　-〿㐀-鿿豈-﫿＀-￯]')
+
+
+class TokenCounter:
+    """
+    使用 LLM 的 tokenizer 計算 token 數 (含 LRU 快取)。
+    tokenizer 無法載入時退回保守估計：中日韓字元 1 字 1 token，其他字元每 3 字 1 token。
+    """
+    def __init__(self, tokenizer_path=CONTEXT_TOKENIZER_PATH, cache_size=8192):
+        self.tokenizer = None
+        self.name = "heuristic"
+        if tokenizer_path:
+            try:
+                from transformers import AutoTokenizer
+                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+                self.name = tokenizer_path
+            except Exception as e:
+                print(f"[ContextPacker] 無法載入 tokenizer ({tokenizer_path})，改用估計值: {e}")
+        self.count = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text):
+        if not text:
+            return 0
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        cjk = len(_CJK_RE.findall(text))
+        return cjk + -(-(len(text) - cjk) // 3)
+
+
+_token_counter = None
+
+def get_token_counter():
+    """行程層級共用一個 TokenCounter (建庫與查詢用同一個，metadata 快取才對得上)"""
+    global _token_counter
+    if _token_counter is None:
+        _token_counter = TokenCounter()
+    return _token_counter
+
+
+def chunk_token_count(doc, meta, counter):
+    """優先使用建庫時存進 metadata 的 token 數；tokenizer 不同或是合併後的表格就現場計算"""
+    if (
+        meta.get("token_counter") == counter.name
+        and "token_count" in meta
+        and meta.get("type") != "MergedTable"
+    ):
+        return int(meta["token_count"])
+    return counter.count(doc)
+
+
+def context_blocks(results, counter, separator_tokens=CONTEXT_SEPARATOR_TOKENS):
+    """
+    把重排序後的結果轉成待打包的 context 片段 (加上來源文件標頭；合併表格本身已帶標頭)。
+    回傳 (blocks, scores, token_counts)；有 Cross-Encoder 分數 (pack_score) 時以它作為背包的價值。
+    """
+    blocks, scores, token_counts = [], [], []
+    for res in results:
+        meta = res['meta']
+        doc_content = res['doc']
+        node_type = meta.get('type', meta.get('label', '未知'))
+        header = "" if node_type == 'MergedTable' else f"【來源文件：{meta.get('source_doc', '未知')}】\n"
+        blocks.append(f"{header}{doc_content}\n\n")
+        scores.append(res.get('pack_score', res['score']))
+        token_counts.append(counter.count(header) + chunk_token_count(doc_content, meta, counter) + separator_tokens)
+    return blocks, scores, token_counts
+
+
+def context_token_budget(context_window, max_tokens, reserved_tokens, margin=256):
+    """context 可用的 token 數 = 模型 context window - 生成長度 - prompt 其餘部分 - 安全邊際"""
+    return max(0, context_window - max_tokens - reserved_tokens - margin)
+
+
+def knapsack_select(values, weights, budget, granularity=CONTEXT_PACK_GRANULARITY):
+    """
+    0/1 背包：在 sum(weights) <= budget 下讓 sum(values) 最大。
+    權重先除以 granularity 無條件進位 (DP 表格縮小 granularity 倍，且不會超出預算)。
+    回傳被選中的索引 (依原順序)。
+    """
+    n = len(values)
+    if n == 0 or budget <= 0:
+        return []
+    granularity = max(1, granularity)
+    cap = budget // granularity
+    w = [-(-int(wt) // granularity) for wt in weights]
+    # 加上極小值：分數 <= 0 的片段在預算還有剩時仍會被放進去，避免塞不滿
+    v = np.asarray([max(float(x), 0.0) + 1e-6 for x in values], dtype=np.float64)
+
+    # 全部放得下就不用跑 DP
+    if sum(w) <= cap:
+        return list(range(n))
+
+    dp = np.zeros(cap + 1, dtype=np.float64)
+    take = np.zeros((n, cap + 1), dtype=bool)
+    for i in range(n):
+        wi = w[i]
+        if wi > cap:
+            continue
+        # dp 由後往前更新的向量化版本：candidate[c] = dp[c - wi] + v[i]
+        candidate = dp[:cap + 1 - wi] + v[i]
+        better = candidate > dp[wi:]
+        take[i, wi:] = better
+        dp[wi:] = np.where(better, candidate, dp[wi:])
+
+    selected = []
+    c = int(np.argmax(dp))
+    for i in range(n - 1, -1, -1):
+        if take[i, c]:
+            selected.append(i)
+            c -= w[i]
+    return sorted(selected)
+
+
+def pack_context(scores, token_counts, budget, granularity=CONTEXT_PACK_GRANULARITY):
+    """
+    scores / token_counts: 依重排序順序排列的各 context 片段分數與 token 數
+    回傳 (被選中的索引, 使用的 token 數)；被選中的片段維持原本的相關度順序
+    """
+    selected = knapsack_select(scores, token_counts, budget, granularity=granularity)
+    return selected, sum(token_counts[i] for i in selected)
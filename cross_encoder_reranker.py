@@ -0,0 +1,87 @@
+import math
+import time
+
+# ==========================================
+# CPU Cross-Encoder 精排 (選用)
+# ==========================================
+# advanced_reranker + group_and_merge_results 之後，候選只是「大致」排好，
+# 再把多達 MAX_CONTEXT_CHARS 的內容塞進 prompt，vLLM 的 prefill 時間就被拉長。
+# 這一層用 cross-encoder 對前 top_k 筆 (query, chunk) 重新打分：
+#   - 成對資料分批送進模型 (batch_size)
+#   - 每批結束檢查耗時，預估下一批會超過 latency budget 就提早停止
+#   - 有打到分的依 cross-encoder 分數排序，沒打到分的維持原順序接在後面
+#   - 最後只保留前 keep 筆，讓 context 更短更精準
+#   - 每筆附上 pack_score (sigmoid(ce_score)，0~1)，Context 背包打包以它作為價值；
+#     沒打到分的取不超過最低已打分者的值，維持「打過分的排在前面」
+
+
+class CrossEncoderReranker:
+    def __init__(self, model_path, batch_size=8, max_length=512, num_threads=None):
+        from sentence_transformers import CrossEncoder
+        if num_threads:
+            # torch 的 intra-op 執行緒數是整個行程共用的：同一行程內的 Embedding 模型 (torch 後端) 也會被限制。
+            # 只有明確設定 CROSS_ENCODER_THREADS 時才改，預設維持 torch 自己的值。
+            import torch
+            print(f"[Cross-Encoder] torch.set_num_threads({num_threads})：同一行程的 Embedding 模型也會使用此執行緒數")
+            torch.set_num_threads(num_threads)
+        print(f"正在載入 Cross-Encoder 模型 (CPU): {model_path}")
+        self.model = CrossEncoder(model_path, max_length=max_length, device='cpu')
+        self.model_path = model_path
+        self.batch_size = batch_size
+        # 送進模型前先截斷文字 (中文約 1 字 1 token)，避免超長 chunk 拖慢整批
+        self.max_chars = max_length
+
+    def rerank(self, query, results, top_k=30, keep=None, budget_ms=300):
+        """
+        回傳 (新的結果列表, 統計資訊)。
+        results 需已依原本分數排序；每筆會加上 "ce_score" (未打分者為 None)。
+        """
+        start = time.perf_counter()
+        head = results[:top_k]
+        tail = results[top_k:]
+        scored = []
+        batch_ms = []
+        stopped_early = False
+
+        for offset in range(0, len(head), self.batch_size):
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            # 以前幾批的平均耗時估計下一批，預估會超時就停
+            if batch_ms and elapsed_ms + sum(batch_ms) / len(batch_ms) > budget_ms:
+                stopped_early = True
+                break
+            batch = head[offset:offset + self.batch_size]
+            t0 = time.perf_counter()
+            scores = self.model.predict(
+                [(query, item['doc'][:self.max_chars]) for item in batch],
+                batch_size=len(batch),
+                show_progress_bar=False
+            )
+            batch_ms.append((time.perf_counter() - t0) * 1000)
+            scored.extend(zip(batch, (float(s) for s in scores)))
+
+        # 有分數的依分數排序 (stable)，沒分數的維持原順序接在後面
+        scored.sort(key=lambda x: x[1], reverse=True)
+        reranked = []
+        floor = None
+        for item, ce_score in scored:
+            item['ce_score'] = ce_score
+            item['pack_score'] = 1.0 / (1.0 + math.exp(-ce_score))
+            floor = item['pack_score']
+            reranked.append(item)
+        for item in head[len(scored):] + tail:
+            item['ce_score'] = None
+            item['pack_score'] = item['score'] if floor is None else min(item['score'], floor)
+            reranked.append(item)
+
+        if keep:
+            reranked = reranked[:keep]
+
+        info = {
+            "model": self.model_path,
+            "candidates": len(head),
+            "scored": len(scored),
+            "kept": len(reranked),
+            "stopped_early": stopped_early,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+        return reranked, info
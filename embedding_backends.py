@@ -0,0 +1,227 @@
+import json
+import os
+import argparse
+
+import numpy as np
+
+# ==========================================
+# 可抽換的 Embedding 後端
+# ==========================================
+# 原本 LocalJinaEmbeddingFunction 寫死 device='cuda'，沒有 GPU 的 backend 副本只能用
+# 全精度 PyTorch 在 CPU 上跑，查詢 encode 很慢。這裡提供兩種後端 (皆有 .encode(texts) -> ndarray)：
+#   - torch：SentenceTransformer (device 可選 auto / cuda / cpu)
+#   - onnx ：匯出成 ONNX 後以 onnxruntime 在 CPU 執行，可選 int8 動態量化或 fp16，並可控制執行緒數
+#
+# ONNX 模型用本檔的 export 指令產生 (會一併存 tokenizer 與 pooling 設定)：
+#   python embedding_backends.py export --model jinaai/jina-embeddings-v3 --output ./onnx_embedding --quantize int8
+# 與 PyTorch 向量的一致性與速度比較：benchmarks/bench_embedding_backends.py
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_DEVICE = os.getenv("EMBEDDING_DEVICE", "auto")
+EMBEDDING_ONNX_PATH = os.getenv("EMBEDDING_ONNX_PATH", "./onnx_embedding/model_int8.onnx")
+ONNX_NUM_THREADS = int(os.getenv("ONNX_NUM_THREADS", "0"))
+EMBEDDING_MAX_LENGTH = int(os.getenv("EMBEDDING_MAX_LENGTH", "8192"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+
+ONNX_CONFIG_NAME = "embedding_config.json"
+
+
+def resolve_device(device):
+    if device and device != "auto":
+        return device
+    try:
+        import torch
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    except ImportError:
+        return "cpu"
+
+
+class SentenceTransformerBackend:
+    name = "torch"
+
+    def __init__(self, model_path, device="auto"):
+        from sentence_transformers import SentenceTransformer
+        self.device = resolve_device(device)
+        print(f"[Embedding] 使用 PyTorch 後端 ({self.device}): {model_path}")
+        self.model = SentenceTransformer(model_path, trust_remote_code=True, device=self.device)
+
+    def encode(self, texts):
+        return self.model.encode(list(texts), batch_size=EMBEDDING_BATCH_SIZE, show_progress_bar=False)
+
+
+class OnnxEmbeddingBackend:
+    """
+    onnxruntime CPU 推論。pooling (mean / cls) 與是否 L2 正規化由匯出時寫入的
+    embedding_config.json 決定，確保與 SentenceTransformer 的輸出一致。
+    """
+    name = "onnx"
+
+    def __init__(self, onnx_path, num_threads=0, max_length=EMBEDDING_MAX_LENGTH, batch_size=EMBEDDING_BATCH_SIZE):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_dir = os.path.dirname(os.path.abspath(onnx_path))
+        config_path = os.path.join(model_dir, ONNX_CONFIG_NAME)
+        config = {}
+        if os.path.exists(config_path):
+            with open(config_path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+        self.pooling = config.get("pooling", "mean")
+        self.normalize = config.get("normalize", True)
+        self.max_length = min(max_length, config.get("max_length", max_length))
+        self.batch_size = batch_size
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            opts.intra_op_num_threads = num_threads
+            opts.inter_op_num_threads = 1
+        print(f"[Embedding] 使用 ONNX 後端 (CPU, threads={num_threads or 'auto'}): {onnx_path}")
+        self.session = ort.InferenceSession(onnx_path, sess_options=opts, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir, trust_remote_code=True)
+
+    def encode(self, texts):
+        texts = list(texts)
+        outputs = []
+        # 依長度排序後分批，減少 padding 浪費，最後再還原順序
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:start + self.batch_size]
+            outputs.append(self._encode_batch([texts[i] for i in idx]))
+        if not outputs:
+            return np.empty((0, 0), dtype=np.float32)
+        stacked = np.concatenate(outputs)
+        result = np.empty_like(stacked)
+        result[order] = stacked
+        return result
+
+    def _encode_batch(self, texts):
+        enc = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+        feeds = {k: v.astype(np.int64) for k, v in enc.items() if k in self.input_names}
+        hidden = self.session.run(None, feeds)[0].astype(np.float32)
+        mask = enc["attention_mask"].astype(np.float32)
+
+        if self.pooling == "cls":
+            emb = hidden[:, 0]
+        else:
+            emb = (hidden * mask[:, :, None]).sum(axis=1) / np.clip(mask.sum(axis=1, keepdims=True), 1e-9, None)
+        if self.normalize:
+            emb = emb / np.clip(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12, None)
+        return emb
+
+
+def load_embedding_backend(model_path, backend=None, device=None):
+    """依環境變數 (或參數) 建立 Embedding 後端"""
+    backend = (backend or EMBEDDING_BACKEND).lower()
+    if backend == "onnx":
+        return OnnxEmbeddingBackend(EMBEDDING_ONNX_PATH, num_threads=ONNX_NUM_THREADS)
+    if backend == "torch":
+        return SentenceTransformerBackend(model_path, device=device or EMBEDDING_DEVICE)
+    raise ValueError(f"不支援的 EMBEDDING_BACKEND: {backend} (可用: torch / onnx)")
+
+
+# ==========================================
+# 匯出 / 量化
+# ==========================================
+def _pooling_config(st_model):
+    """從 SentenceTransformer 的模組讀出 pooling 與 normalize 設定"""
+    pooling, normalize = "mean", False
+    for module in st_model:
+        cls_name = type(module).__name__
+        if cls_name == "Pooling":
+            mode = module.get_pooling_mode_str()
+            pooling = "cls" if mode == "cls" else "mean"
+        elif cls_name == "Normalize":
+            normalize = True
+    return pooling, normalize
+
+
+def export_onnx(model_path, output_dir, quantize="int8", opset=17):
+    """
+    將 SentenceTransformer 的 transformer 主體匯出成 ONNX (輸出 token embeddings)，
+    pooling / normalize 在 OnnxEmbeddingBackend 中以 numpy 完成。
+    quantize: none / int8 (動態量化，CPU 最快) / fp16
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    os.makedirs(output_dir, exist_ok=True)
+    st_model = SentenceTransformer(model_path, trust_remote_code=True, device="cpu")
+    st_model.eval()
+    transformer = st_model[0]
+    hf_model = transformer.auto_model
+    tokenizer = transformer.tokenizer
+    pooling, normalize = _pooling_config(st_model)
+
+    class _TokenEmbeddings(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    sample = tokenizer(["範例文字 sample text"], return_tensors="pt")
+    fp32_path = os.path.join(output_dir, "model.onnx")
+    print(f"匯出 ONNX: {fp32_path}")
+    with torch.no_grad():
+        torch.onnx.export(
+            _TokenEmbeddings(hf_model),
+            (sample["input_ids"], sample["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["token_embeddings"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "seq"},
+                "attention_mask": {0: "batch", 1: "seq"},
+                "token_embeddings": {0: "batch", 1: "seq"},
+            },
+            opset_version=opset,
+        )
+
+    tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, ONNX_CONFIG_NAME), "w", encoding="utf-8") as f:
+        json.dump({
+            "source_model": model_path,
+            "pooling": pooling,
+            "normalize": normalize,
+            "max_length": st_model.max_seq_length or EMBEDDING_MAX_LENGTH,
+        }, f, ensure_ascii=False, indent=2)
+
+    output_path = fp32_path
+    if quantize == "int8":
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        output_path = os.path.join(output_dir, "model_int8.onnx")
+        print(f"int8 動態量化: {output_path}")
+        quantize_dynamic(fp32_path, output_path, weight_type=QuantType.QInt8)
+    elif quantize == "fp16":
+        import onnx
+        from onnxconverter_common import float16
+        output_path = os.path.join(output_dir, "model_fp16.onnx")
+        print(f"轉換 fp16: {output_path}")
+        fp16_model = float16.convert_float_to_float16(onnx.load(fp32_path), keep_io_types=True)
+        onnx.save(fp16_model, output_path)
+    elif quantize != "none":
+        raise ValueError(f"不支援的量化方式: {quantize}")
+
+    print(f"完成！請設定 EMBEDDING_BACKEND=onnx、EMBEDDING_ONNX_PATH={output_path}")
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding 模型 ONNX 匯出工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    exp = sub.add_parser("export", help="匯出 (並量化) ONNX 模型")
+    exp.add_argument("--model", default=os.getenv("EMBEDDING_MODEL_PATH", "jinaai/jina-embeddings-v3"))
+    exp.add_argument("--output", default="./onnx_embedding")
+    exp.add_argument("--quantize", choices=["none", "int8", "fp16"], default="int8")
+    exp.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_onnx(args.model, args.output, quantize=args.quantize, opset=args.opset)
+
+
+if __name__ == "__main__":
+    main()
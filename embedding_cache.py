@@ -0,0 +1,101 @@
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+# ==========================================
+# Query Embedding LRU Cache
+# ==========================================
+# 使用者常常重複問一樣的問題 (例如「112年預算執行率」)，
+# 同一句話每次都重新 encode 很浪費 GPU/CPU，因此在 encoder 前面加一層 LRU。
+
+_SPACE_RE = re.compile(r'\s+')
+# 兩個非 ASCII 字元 (中文) 中間的空白沒有語意，直接拿掉
+_CJK_GAP_RE = re.compile(r'(?<=[^\x00-\x7f]) (?=[^\x00-\x7f])')
+# "%" 在 Unicode 屬於標點 (Po)，但對數據問題有意義，保留
+_KEEP_PUNCT = {"%"}
+
+def normalize_query(text):
+    """
+    產生快取用的正規化字串：
+    1. NFKC：全形/半形統一 (例如 "１１２" -> "112"、"？" -> "?")
+    2. 英文字母轉小寫
+    3. 標點符號 (Unicode P* 類別) 折疊成空白 (不直接刪除，避免 "1.5" 跟 "15" 撞在一起)；
+       "%" 與 "$" 這類符號保留
+    4. 連續空白合併、中文字之間的空白移除、去頭尾
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = "".join(
+        " " if unicodedata.category(c).startswith("P") and c not in _KEEP_PUNCT else c
+        for c in text
+    )
+    text = _SPACE_RE.sub(" ", text).strip()
+    return _CJK_GAP_RE.sub("", text)
+
+
+class QueryEmbeddingCache:
+    """
+    有容量上限的 LRU 快取。
+    Key = (embedding 模型 ID, 正規化後的問題)，換模型 (EMBEDDING_MODEL_PATH) 時不會拿到舊向量。
+    多個檢索執行緒會同時呼叫，所以用 Lock 保護。
+    """
+    def __init__(self, encode_fn, model_id, max_size=1024):
+        self.encode_fn = encode_fn      # 接收 list[str]，回傳 ndarray / list
+        self.model_id = model_id
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, query):
+        return (self.model_id, normalize_query(query))
+
+    def encode(self, query):
+        """回傳單一問題的向量 (list[float])，命中快取時不呼叫模型"""
+        if self.max_size <= 0:
+            return self._encode_one(query)
+
+        key = self.make_key(query)
+        with self._lock:
+            vec = self._data.get(key)
+            if vec is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return list(vec)
+            self.misses += 1
+
+        # 編碼不持有鎖，避免一個慢請求擋住其他命中的請求
+        vec = self._encode_one(query)
+
+        with self._lock:
+            self._data[key] = tuple(vec)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return vec
+
+    def _encode_one(self, query):
+        vec = self.encode_fn([query])[0]
+        return vec.tolist() if hasattr(vec, "tolist") else list(vec)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "model_id": self.model_id,
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
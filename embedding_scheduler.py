@@ -0,0 +1,194 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# ==========================================
+# Embedding 微批次排程器 (Micro-batcher)
+# ==========================================
+# rag_server 裡聊天查詢與背景建庫共用同一個 SentenceTransformer：
+#   - 同時進來的多個查詢原本各自 encode (batch=1)，GPU 利用率很差
+#   - 大檔案上傳時 collection.add 會一直佔著模型，查詢被餓死
+# 這裡用單一工作執行緒統一呼叫模型：
+#   - query 車道 (高優先)：在 batch_window_ms 內到達的查詢合併成一批
+#   - batch 車道 (批次問答)：整個請求一次 encode (不拆批、不節流)，query 車道為空時優先於建庫處理
+#   - ingest 車道 (節流)：只有 query / batch 車道都為空時才處理，每批最多 ingest_batch_size 筆，
+#     每批之間可再暫停 ingest_pause_ms，讓查詢有機會插隊
+#   - 提供佇列深度、批次大小等統計
+
+LANES = ("query", "batch", "ingest")
+
+
+class _EncodeRequest:
+    __slots__ = ("texts", "offset", "parts", "event", "error", "enqueued_at")
+
+    def __init__(self, texts):
+        self.texts = list(texts)
+        self.offset = 0              # ingest 請求可能被拆成多批處理
+        self.parts = []
+        self.event = threading.Event()
+        self.error = None
+        self.enqueued_at = time.perf_counter()
+
+
+class EmbeddingScheduler:
+    def __init__(self, encode_fn, batch_window_ms=5, max_batch_size=32, ingest_batch_size=16, ingest_pause_ms=0):
+        self.encode_fn = encode_fn
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.ingest_batch_size = ingest_batch_size
+        self.ingest_pause = ingest_pause_ms / 1000
+
+        self._queues = {lane: deque() for lane in LANES}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._stats = {
+            lane: {"requests": 0, "texts": 0, "batches": 0, "max_batch": 0, "wait_ms_total": 0.0, "encode_ms_total": 0.0}
+            for lane in LANES
+        }
+
+        self._worker = threading.Thread(target=self._run, name="embedding-scheduler", daemon=True)
+        self._worker.start()
+
+    # ------------------------------------------
+    # 對外介面 (可從任何執行緒呼叫，會阻塞直到結果回來)
+    # ------------------------------------------
+    def encode(self, texts, lane="query"):
+        if lane not in self._queues:
+            raise ValueError(f"未知的車道: {lane}")
+        req = _EncodeRequest(texts)
+        if not req.texts:
+            return np.empty((0, 0), dtype=np.float32)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("EmbeddingScheduler 已關閉")
+            self._queues[lane].append(req)
+            self._stats[lane]["requests"] += 1
+            self._cond.notify()
+        req.event.wait()
+        if req.error is not None:
+            raise req.error
+        return np.concatenate(req.parts) if len(req.parts) > 1 else req.parts[0]
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join(timeout=5)
+
+    def stats(self):
+        with self._cond:
+            out = {}
+            for lane in LANES:
+                st = self._stats[lane]
+                batches = st["batches"] or 1
+                out[lane] = {
+                    "queue_depth": len(self._queues[lane]),
+                    "queued_texts": sum(len(r.texts) - r.offset for r in self._queues[lane]),
+                    "requests": st["requests"],
+                    "texts": st["texts"],
+                    "batches": st["batches"],
+                    "avg_batch_size": round(st["texts"] / batches, 2),
+                    "max_batch_size": st["max_batch"],
+                    "avg_wait_ms": round(st["wait_ms_total"] / batches, 2),
+                    "avg_encode_ms": round(st["encode_ms_total"] / batches, 2),
+                }
+            return out
+
+    # ------------------------------------------
+    # 工作執行緒
+    # ------------------------------------------
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not any(self._queues.values()):
+                    self._cond.wait()
+                if self._closed and not any(self._queues.values()):
+                    return
+                lane = next(name for name in LANES if self._queues[name])
+
+            if lane == "query":
+                self._run_query_batch()
+            elif lane == "batch":
+                self._run_batch_request()
+            else:
+                self._run_ingest_batch()
+                if self.ingest_pause:
+                    time.sleep(self.ingest_pause)
+
+    def _run_query_batch(self):
+        # 等一個很短的視窗，讓同時到達的查詢可以併成一批
+        deadline = time.perf_counter() + self.batch_window
+        with self._cond:
+            while True:
+                queued = sum(len(r.texts) for r in self._queues["query"])
+                remaining = deadline - time.perf_counter()
+                if queued >= self.max_batch_size or remaining <= 0 or self._closed:
+                    break
+                self._cond.wait(remaining)
+            batch, total = [], 0
+            q = self._queues["query"]
+            while q and (not batch or total + len(q[0].texts) <= self.max_batch_size):
+                req = q.popleft()
+                batch.append(req)
+                total += len(req.texts)
+
+        texts = [t for req in batch for t in req.texts]
+        try:
+            vectors = self._encode("query", texts, batch)
+            pos = 0
+            for req in batch:
+                req.parts.append(vectors[pos:pos + len(req.texts)])
+                pos += len(req.texts)
+        except Exception as e:
+            for req in batch:
+                req.error = e
+        for req in batch:
+            req.event.set()
+
+    def _run_batch_request(self):
+        with self._cond:
+            req = self._queues["batch"].popleft()
+        try:
+            req.parts.append(self._encode("batch", req.texts, [req]))
+        except Exception as e:
+            req.error = e
+        req.event.set()
+
+    def _run_ingest_batch(self):
+        with self._cond:
+            q = self._queues["ingest"]
+            if not q:
+                return
+            req = q[0]
+            start = req.offset
+            end = min(start + self.ingest_batch_size, len(req.texts))
+
+        texts = req.texts[start:end]
+        done = False
+        try:
+            req.parts.append(self._encode("ingest", texts, [req]))
+            req.offset = end
+            done = end >= len(req.texts)
+        except Exception as e:
+            req.error = e
+            done = True
+
+        if done:
+            with self._cond:
+                q.popleft()
+            req.event.set()
+
+    def _encode(self, lane, texts, reqs):
+        t0 = time.perf_counter()
+        vectors = np.asarray(self.encode_fn(texts))
+        encode_ms = (time.perf_counter() - t0) * 1000
+        with self._cond:
+            st = self._stats[lane]
+            st["batches"] += 1
+            st["texts"] += len(texts)
+            st["max_batch"] = max(st["max_batch"], len(texts))
+            st["wait_ms_total"] += max((t0 - r.enqueued_at) * 1000 for r in reqs)
+            st["encode_ms_total"] += encode_ms
+        return vectors
@@ -11,6 +11,7 @@ import build_vectordb_v3 as db_builder # JSON -> ChromaDB
 import pdf_convert                  # PDF -> MD 
 import excel_convert                # Excel/ODS -> MD
 import docx_convert
+from metrics import INGEST_FILES, INGEST_STAGE_SECONDS, stage_timer  # 建庫各階段耗時 (Prometheus)
 
 # --- 設定區 ---
 DATA_DIR = "./data_files"
@@ -29,70 +30,77 @@ def process_single_file(filepath, builder):
     
     # --- 1. 解析階段 (Parsing) ---
     try:
-        # A. 如果是 PDF
-        if file_ext == '.pdf':
-            print("偵測到 PDF，啟動 pdf_convert 引擎...")
-            md_content = pdf_convert.smart_process_pdf(filepath)
-
-        # B. 如果是 Word (Doc/Docx)
-        elif file_ext == '.docx':
-                    print(f"偵測到 DOCX，啟動 docx_convert...")
-                    md_content = docx_convert.parse_docx_to_markdown(filepath)
-
-        # C. 如果是 ODT
-        elif file_ext == '.odt':
-            print("偵測到 ODT 檔，開始解析")
-            md_content = parser.parse_full_document(filepath)
-
-
-        # D. [新增] 如果是 Excel / ODS / CSV
-        elif file_ext in ['.xlsx', '.xls', '.ods', '.csv']:
-            print("偵測到試算表檔案，啟動 excel_convert 引擎...")
-            md_content = excel_convert.excel_to_markdown(filepath)
+        with stage_timer("parse", INGEST_STAGE_SECONDS):
+            # A. 如果是 PDF
+            if file_ext == '.pdf':
+                print("偵測到 PDF，啟動 pdf_convert 引擎...")
+                md_content = pdf_convert.smart_process_pdf(filepath)
+
+            # B. 如果是 Word (Doc/Docx)
+            elif file_ext == '.docx':
+                        print(f"偵測到 DOCX，啟動 docx_convert...")
+                        md_content = docx_convert.parse_docx_to_markdown(filepath)
+
+            # C. 如果是 ODT
+            elif file_ext == '.odt':
+                print("偵測到 ODT 檔，開始解析")
+                md_content = parser.parse_full_document(filepath)
+
+
+            # D. [新增] 如果是 Excel / ODS / CSV
+            elif file_ext in ['.xlsx', '.xls', '.ods', '.csv']:
+                print("偵測到試算表檔案，啟動 excel_convert 引擎...")
+                md_content = excel_convert.excel_to_markdown(filepath)
             
-            # 簡單檢查回傳是否為錯誤訊息
-            if md_content.startswith("錯誤") or md_content.startswith("處理失敗"):
-                print(md_content)
-                return
+                # 簡單檢查回傳是否為錯誤訊息
+                if md_content.startswith("錯誤") or md_content.startswith("處理失敗"):
+                    print(md_content)
+                    INGEST_FILES.labels("error").inc()
+                    return
             
-        else:
-            print(f"不支援的格式: {file_ext}")
-            return
+            else:
+                print(f"不支援的格式: {file_ext}")
+                INGEST_FILES.labels("skipped").inc()
+                return
 
-        # 檢查解析結果
-        if not md_content:
-            print("解析結果為空，跳過後續步驟。")
-            return
+            # 檢查解析結果
+            if not md_content:
+                print("解析結果為空，跳過後續步驟。")
+                INGEST_FILES.labels("skipped").inc()
+                return
 
-        print(f"解析完成 (長度: {len(md_content)} 字)")
+            print(f"解析完成 (長度: {len(md_content)} 字)")
         
-        # 備份 Markdown 
-        md_filename = os.path.join(PROCESSED_DIR, filename + ".md")
-        with open(md_filename, "w", encoding="utf-8") as f:
-            f.write(md_content)
+            # 備份 Markdown 
+            md_filename = os.path.join(PROCESSED_DIR, filename + ".md")
+            with open(md_filename, "w", encoding="utf-8") as f:
+                f.write(md_content)
 
     except Exception as e:
         print(f"解析階段發生錯誤: {e}")
         import traceback
         traceback.print_exc()
+        INGEST_FILES.labels("error").inc()
         return
 
     # --- 2. 切分階段 (Chunking) ---
     try:
-        print("正在進行結構化切分 (Chunking)...")
-        # 去掉副檔名作為文件標題
-        doc_title = os.path.splitext(filename)[0]
-        graph_data = chunker.parse_markdown_to_graph(md_content, doc_name=doc_title)
+        with stage_timer("chunk", INGEST_STAGE_SECONDS):
+            print("正在進行結構化切分 (Chunking)...")
+            # 去掉副檔名作為文件標題
+            doc_title = os.path.splitext(filename)[0]
+            graph_data = chunker.parse_markdown_to_graph(md_content, doc_name=doc_title)
         
-        print(f"切分完成: {len(graph_data['nodes'])} 個節點")
+            print(f"切分完成: {len(graph_data['nodes'])} 個節點")
 
-        # 備份 JSON
-        json_filename = os.path.join(PROCESSED_DIR, filename + ".json")
-        with open(json_filename, "w", encoding="utf-8") as f:
-            json.dump(graph_data, f, ensure_ascii=False, indent=2)
+            # 備份 JSON
+            json_filename = os.path.join(PROCESSED_DIR, filename + ".json")
+            with open(json_filename, "w", encoding="utf-8") as f:
+                json.dump(graph_data, f, ensure_ascii=False, indent=2)
 
     except Exception as e:
         print(f"切分階段發生錯誤: {e}")
+        INGEST_FILES.labels("error").inc()
         return
 
     # --- 3. ID 處理 ---
@@ -116,17 +124,21 @@ def process_single_file(filepath, builder):
 
     except Exception as e:
         print(f"ID 處理失敗: {e}")
+        INGEST_FILES.labels("error").inc()
         return
 
     # --- 4. 建庫階段 (Ingestion) ---
     # 回歸 V3 邏輯：直接交給模組處理，模組內有 batch_size=10 的保護機制
     try:
-        print("正在寫入向量資料庫 (ChromaDB)...")
-        builder.ingest_graph_data(graph_data)
-        print("寫入成功！")
+        with stage_timer("vectordb", INGEST_STAGE_SECONDS):
+            print("正在寫入向量資料庫 (ChromaDB)...")
+            builder.ingest_graph_data(graph_data)
+            print("寫入成功！")
+        INGEST_FILES.labels("ok").inc()
 
     except Exception as e:
         print(f"建庫階段發生錯誤: {e}")
+        INGEST_FILES.labels("error").inc()
 
 def main():
     # 建立必要資料夾
@@ -0,0 +1,186 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+try:
+    import prometheus_client
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+# ==========================================
+# Prometheus 指標
+# ==========================================
+# 回答慢的時候，原本只能翻 print 日誌猜是關鍵字提取、Embedding、Chroma、重排序還是 vLLM。這裡集中定義：
+#   - rag_stage_duration_seconds{stage}：stream_chat 各階段耗時
+#   - rag_llm_*：首字延遲 (TTFT)、token 間隔、生成速度 (tokens/s)、生成 token 數
+#   - rag_ingest_stage_duration_seconds{stage}：上傳建庫各階段 (解析 / 切分 / 寫入向量庫) 耗時
+#   - rag_errors_total{stage}、rag_chat_requests_total{outcome}、rag_cache_lookups_total{cache,result}
+#   - StatsCollector：把既有的 .stats() (快取、Embedding 排程器、准入控制) 在 scrape 時轉成 gauge
+# 沒有安裝 prometheus_client 時所有指標都是 no-op，/metrics 回 503。
+# 多 worker 時設定 PROMETHEUS_MULTIPROC_DIR (每次啟動前清空)，/metrics 會彙整所有 worker 的 histogram / counter；
+# StatsCollector 的 gauge 只反映回應這次 scrape 的 worker。
+# 設定了 current_trace (request_profiler.RequestTrace) 時，各階段耗時也會記到目前這筆請求上 (慢查詢日誌用)。
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.2, 0.5, 1.0)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+INGEST_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+
+if prometheus_client is not None:
+    STAGE_SECONDS = Histogram("rag_stage_duration_seconds", "stream_chat 各階段耗時", ["stage"], buckets=STAGE_BUCKETS)
+    LLM_TTFT_SECONDS = Histogram("rag_llm_ttft_seconds", "送出請求到收到第一個 token 的時間", buckets=TTFT_BUCKETS)
+    LLM_INTER_TOKEN_SECONDS = Histogram("rag_llm_inter_token_seconds", "相鄰兩個 token 的間隔", buckets=INTER_TOKEN_BUCKETS)
+    LLM_TOKENS_PER_SECOND = Histogram("rag_llm_tokens_per_second", "每筆回答第一個 token 之後的生成速度", buckets=TOKENS_PER_SECOND_BUCKETS)
+    LLM_COMPLETION_TOKENS = Counter("rag_llm_completion_tokens", "LLM 生成的 token 數")
+    LLM_TOKENS_SAVED = Counter("rag_llm_tokens_saved", "客戶端斷線中止後不必生成的 token 數 (上限估計)")
+    INGEST_STAGE_SECONDS = Histogram("rag_ingest_stage_duration_seconds", "建庫各階段耗時", ["stage"], buckets=INGEST_BUCKETS)
+    INGEST_FILES = Counter("rag_ingest_files", "處理完成的檔案數", ["result"])
+    ERRORS = Counter("rag_errors", "各階段發生的錯誤數", ["stage"])
+    CHAT_REQUESTS = Counter("rag_chat_requests", "聊天請求結果", ["outcome"])
+    CACHE_LOOKUPS = Counter("rag_cache_lookups", "快取查詢結果", ["cache", "result"])
+else:
+    STAGE_SECONDS = LLM_TTFT_SECONDS = LLM_INTER_TOKEN_SECONDS = LLM_TOKENS_PER_SECOND = _NoopMetric()
+    LLM_COMPLETION_TOKENS = LLM_TOKENS_SAVED = INGEST_STAGE_SECONDS = INGEST_FILES = _NoopMetric()
+    ERRORS = CHAT_REQUESTS = CACHE_LOOKUPS = _NoopMetric()
+
+# 目前請求的 trace；run_blocking 以 copy_context 執行，執行緒池中的階段也記得到
+current_trace = ContextVar("current_trace", default=None)
+
+
+def observe_stage(stage, seconds, histogram=None):
+    (histogram or STAGE_SECONDS).labels(stage).observe(seconds)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_stage(stage, seconds)
+
+
+@contextmanager
+def stage_timer(stage, histogram=None):
+    """記錄區塊耗時；區塊內拋出例外時同時累計 rag_errors_total{stage}"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.labels(stage).inc()
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, histogram)
+
+
+def record_error(stage):
+    ERRORS.labels(stage).inc()
+
+
+def record_chat_request(outcome):
+    CHAT_REQUESTS.labels(outcome).inc()
+
+
+def record_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+async def measure_llm_stream(stream, requested_at):
+    """
+    包住 OpenAI 串流 (放在 coalesce_deltas 之前，量到的是 vLLM 原始的每個 delta)：
+    記錄 TTFT、token 間隔，結束 (含中途取消) 時記錄生成 token 數與 tokens/s。
+    token 數優先採用串流最後的 usage (有開 include_usage 時)，否則以 delta 數估計 (vLLM 一個 delta 約一個 token)。
+    """
+    first_at = last_at = None
+    deltas = 0
+    usage_tokens = None
+    try:
+        async for chunk in stream:
+            usage = getattr(chunk, "usage", None)
+            if usage is not None and getattr(usage, "completion_tokens", None):
+                usage_tokens = usage.completion_tokens
+            if chunk.choices and chunk.choices[0].delta.content:
+                now = time.perf_counter()
+                if first_at is None:
+                    first_at = now
+                    LLM_TTFT_SECONDS.observe(now - requested_at)
+                else:
+                    LLM_INTER_TOKEN_SECONDS.observe(now - last_at)
+                last_at = now
+                deltas += 1
+            yield chunk
+    finally:
+        tokens = usage_tokens or deltas
+        LLM_COMPLETION_TOKENS.inc(tokens)
+        if first_at is not None and last_at > first_at and tokens > 1:
+            LLM_TOKENS_PER_SECOND.observe((tokens - 1) / (last_at - first_at))
+
+
+class StatsCollector:
+    """
+    sources: {名稱: (回傳 dict 的函式, 巢狀 dict 的 label 名稱)}
+    數值欄位輸出成 rag_<名稱>_<欄位> gauge；巢狀一層的 dict (例如排程器的 query / ingest) 以 label 區分。
+    """
+    def __init__(self, sources):
+        self.sources = sources
+
+    def collect(self):
+        for name, (fn, label) in self.sources.items():
+            try:
+                stats = fn()
+            except Exception:
+                continue
+            if not stats:
+                continue
+            families = {}
+            for key, value in stats.items():
+                if isinstance(value, dict):
+                    for sub_key, sub_value in value.items():
+                        if _is_number(sub_value):
+                            family = families.get(sub_key)
+                            if family is None:
+                                family = families[sub_key] = GaugeMetricFamily(
+                                    f"rag_{name}_{sub_key}", f"{name} {sub_key}", labels=[label])
+                            family.add_metric([key], sub_value)
+                elif _is_number(value):
+                    families[key] = GaugeMetricFamily(f"rag_{name}_{key}", f"{name} {key}", value=value)
+            yield from families.values()
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+_collectors = []
+
+
+def register_collector(collector):
+    if prometheus_client is None:
+        return
+    _collectors.append(collector)
+    REGISTRY.register(collector)
+
+
+def render_latest():
+    """回傳 (內容, Content-Type)；沒有安裝 prometheus_client 時回傳 (None, None)"""
+    if prometheus_client is None:
+        return None, None
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        for collector in _collectors:
+            registry.register(collector)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,406 @@
+import json
+import math
+import os
+import tempfile
+import threading
+import uuid
+from array import array
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows：沒有 flock，只能單一行程寫入
+    fcntl = None
+
+import numpy as np
+
+# ==========================================
+# CJK 字元 N-gram 倒排索引
+# ==========================================
+# 取代 ChromaDB 的 where_document={"$contains": kw}。
+# Chroma 的 $contains 是對整張文件表做子字串掃描，文件越多越慢；
+# 這裡改用字元 n-gram 倒排索引先找候選，再用 `kw in text` 精確驗證，
+# 命中的文件一定真的包含關鍵字 (與 $contains 相同)，但只需看候選文件；
+# 常見的短關鍵字每個只驗證到有限筆數為止 (見 search)，不會掃遍整個語料。
+#
+# 結構：
+#   - slot：每個 chunk 一個整數編號 (只增不減，刪除用墓碑標記)
+#   - postings：gram -> 遞增的 slot 陣列 (array('i')，比 set 省記憶體)
+#   - 可選擇持久化到磁碟 (numpy CSR 格式)，重新載入時以 mmap 開啟，不必整份讀進記憶體
+#
+# 持久化後的資料為「base」(mmap、唯讀)，之後的新增/刪除放在記憶體中的「delta」，
+# 下次 save() 時再合併成新的 base。
+# 多個 uvicorn worker 共用同一個 persist_dir：暫存檔名每次唯一，且寫入 / 換上 / 載入整組檔案時
+# 持有 persist_dir/.lock 檔案鎖，不會混到不同版本的陣列。
+# 每個 worker 記下自己尚未存檔的 add / remove (journal)；save() 時若磁碟上已是別的 worker 寫的新版本，
+# 先載入那一版再重放自己的 journal，不會把對方新增的文件蓋掉 (load() 也會重放尚未存檔的變更)。
+
+DEFAULT_NGRAM_SIZES = (1, 2)
+# 墓碑比例超過此值時自動重建 postings
+COMPACT_RATIO = 0.25
+# 每個關鍵字最多驗證到 limit_per_keyword * VERIFY_FACTOR 筆命中 (避免常見的短關鍵字掃遍整個語料)
+VERIFY_FACTOR = 4
+
+
+def extract_ngrams(text, sizes):
+    """取出文字中所有不重複的 n-gram"""
+    grams = set()
+    length = len(text)
+    for n in sizes:
+        for i in range(length - n + 1):
+            grams.add(text[i:i + n])
+    return grams
+
+
+class NgramIndex:
+    def __init__(self, ngram_sizes=DEFAULT_NGRAM_SIZES, persist_dir=None):
+        self.ngram_sizes = tuple(sorted(set(int(n) for n in ngram_sizes)))
+        self.persist_dir = persist_dir
+        self._lock = threading.RLock()
+        self._journal = []          # 上次存檔 / 載入後的變更：("add", ids, texts) / ("remove", ids)
+        self._disk_version = None   # 目前內容是以磁碟上哪一版為底 (meta.json 的 version)
+        self._snapshot = False      # True：目前內容是完整快照 (重建 / 清空)，存檔時直接覆蓋磁碟版本
+        self._reset()
+
+    def _reset(self):
+        self._ids = []              # slot -> chunk id (刪除後為 None)
+        self._id_to_slot = {}
+        self._texts = {}            # delta 區的文字：slot -> text
+        self._postings = {}         # delta 區的 postings：gram -> array('i')
+        self._deleted = 0
+        # mmap base (由 load() 填入)
+        self._base_vocab = {}       # gram -> (start, end)
+        self._base_postings = None
+        self._base_text_blob = None
+        self._base_text_offsets = None
+        self._base_slots = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._id_to_slot)
+
+    # ------------------------------------------
+    # 寫入 / 刪除
+    # ------------------------------------------
+    def add(self, ids, texts):
+        """新增 (或覆蓋) chunk；同一個 id 重複加入時以最新內容為準"""
+        ids, texts = list(ids), [text or "" for text in texts]
+        with self._lock:
+            if self.persist_dir:
+                self._journal.append(("add", ids, texts))
+            self._add(ids, texts)
+
+    def _add(self, ids, texts):
+        with self._lock:
+            for doc_id, text in zip(ids, texts):
+                if doc_id in self._id_to_slot:
+                    self._remove_one(doc_id)
+                text = text or ""
+                slot = len(self._ids)
+                self._ids.append(doc_id)
+                self._id_to_slot[doc_id] = slot
+                self._texts[slot] = text
+                for gram in extract_ngrams(text, self.ngram_sizes):
+                    posting = self._postings.get(gram)
+                    if posting is None:
+                        posting = self._postings[gram] = array('i')
+                    posting.append(slot)
+
+    def remove(self, ids):
+        ids = list(ids)
+        with self._lock:
+            if self.persist_dir:
+                self._journal.append(("remove", ids))
+            self._remove(ids)
+
+    def _remove(self, ids):
+        with self._lock:
+            for doc_id in ids:
+                if doc_id in self._id_to_slot:
+                    self._remove_one(doc_id)
+            if self._ids and self._deleted / len(self._ids) > COMPACT_RATIO:
+                self.compact()
+
+    def _remove_one(self, doc_id):
+        slot = self._id_to_slot.pop(doc_id)
+        self._ids[slot] = None
+        self._texts.pop(slot, None)
+        self._deleted += 1
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            self._journal = []
+            self._snapshot = True
+
+    def compact(self):
+        """丟掉墓碑並重新編號 (所有資料搬回記憶體 delta 區)"""
+        with self._lock:
+            read_text = self._text_reader()
+            live = [(doc_id, read_text(slot)) for slot, doc_id in enumerate(self._ids) if doc_id is not None]
+            self._reset()
+            self._add([doc_id for doc_id, _ in live], [text for _, text in live])
+
+    # ------------------------------------------
+    # 查詢
+    # ------------------------------------------
+    def _text_reader(self):
+        """
+        回傳 slot -> text 的函式，綁定目前這一版的 delta / base 物件 (需在鎖內呼叫)。
+        slot 的文字寫入後不會再改變，compact / load 也是換上新物件而不是修改舊物件，
+        所以拿到的函式可以在鎖外使用 (已刪除的 slot 可能仍讀得到舊文字，呼叫端需自行檢查 id)。
+        """
+        texts = self._texts
+        blob, offsets, base_slots = self._base_text_blob, self._base_text_offsets, self._base_slots
+
+        def read(slot):
+            text = texts.get(slot)
+            if text is None and slot < base_slots:
+                start, end = offsets[slot], offsets[slot + 1]
+                text = bytes(blob[start:end]).decode("utf-8")
+            return text
+        return read
+
+    def _posting(self, gram):
+        """取得某個 gram 的 slot 陣列 (base + delta)"""
+        parts = []
+        span = self._base_vocab.get(gram)
+        if span is not None:
+            parts.append(np.asarray(self._base_postings[span[0]:span[1]], dtype=np.int32))
+        delta = self._postings.get(gram)
+        if delta is not None:
+            parts.append(np.frombuffer(delta, dtype=np.int32))
+        if not parts:
+            return np.empty(0, dtype=np.int32)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def _candidate_slots(self, keyword):
+        """
+        以 n-gram 交集找出可能包含 keyword 的 slot。
+        回傳 (slots, exact)：exact 表示關鍵字本身就是一個 gram，posting 即為答案不必再驗證；
+        關鍵字比最小的 n-gram 還短時回傳 (None, False)。
+        """
+        usable = [n for n in self.ngram_sizes if n <= len(keyword)]
+        if not usable:
+            return None, False
+        n = usable[-1]
+        grams = {keyword[i:i + n] for i in range(len(keyword) - n + 1)}
+        postings = sorted((self._posting(g) for g in grams), key=len)
+        result = postings[0]
+        for p in postings[1:]:
+            if not len(result):
+                break
+            result = np.intersect1d(result, p, assume_unique=True)
+        return result, n == len(keyword)
+
+    def search(self, keywords, limit_per_keyword=50, limit=None, verify_factor=VERIFY_FACTOR):
+        """
+        一次查詢多個關鍵字。
+        每個關鍵字最多取 limit_per_keyword 筆，合併後依「匹配強度」排序：sum(len(kw)^2 * (1 + log(出現次數)))。
+        為了讓「元」、「%」這類幾乎每個 chunk 都有的短關鍵字不拖慢查詢：
+          - 長的關鍵字先查，已被其他關鍵字命中的 chunk 優先驗證
+          - 每個關鍵字最多驗證到 limit_per_keyword * verify_factor 筆命中就停止，只在這些命中中依出現次數排序
+          - 單一字元的關鍵字 (posting 本身就是答案) 不讀原文、不計次數
+        鎖只用來取 posting 與文字讀取函式，驗證 (讀原文、count) 在鎖外進行。
+        回傳 [(chunk_id, score, [命中的關鍵字...]), ...]
+        """
+        unique = sorted(dict.fromkeys(k for k in keywords if k), key=len, reverse=True)
+        with self._lock:
+            ids = self._ids
+            read_text = self._text_reader()
+            candidates = [(kw,) + self._candidate_slots(kw) for kw in unique]
+
+        scores = {}
+        matched = {}
+        max_hits = max(1, limit_per_keyword * verify_factor)
+        for kw, slots, exact in candidates:
+            if slots is None:
+                # 關鍵字比最小的 n-gram 還短，無法用索引查 (不做全表掃描)
+                continue
+            if scores and len(slots):
+                # 已被較長關鍵字命中的 chunk 先驗證，其餘依寫入順序
+                seen = np.fromiter(scores.keys(), dtype=np.int32, count=len(scores))
+                first = np.isin(slots, seen, assume_unique=True)
+                slots = np.concatenate([slots[first], slots[~first]])
+
+            hits = []
+            for slot in slots:
+                slot = int(slot)
+                if ids[slot] is None:
+                    continue
+                if exact and len(kw) == 1:
+                    count = 1
+                else:
+                    text = read_text(slot)
+                    count = text.count(kw) if text else 0
+                if count:
+                    hits.append((count, slot))
+                    if len(hits) >= (limit_per_keyword if exact and len(kw) == 1 else max_hits):
+                        break
+            # 出現次數多的優先，同分時依驗證順序
+            hits.sort(key=lambda x: -x[0])
+            weight = len(kw) ** 2
+            for count, slot in hits[:limit_per_keyword]:
+                scores[slot] = scores.get(slot, 0.0) + weight * (1 + math.log(count))
+                matched.setdefault(slot, []).append(kw)
+
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        if limit:
+            ranked = ranked[:limit]
+        order = {kw: i for i, kw in enumerate(dict.fromkeys(k for k in keywords if k))}
+        return [(ids[slot], score, sorted(matched[slot], key=order.get)) for slot, score in ranked
+                if ids[slot] is not None]
+
+    # ------------------------------------------
+    # 持久化 (numpy CSR + mmap)
+    # ------------------------------------------
+    def save(self):
+        if not self.persist_dir:
+            return
+        os.makedirs(self.persist_dir, exist_ok=True)
+        meta_path = os.path.join(self.persist_dir, "meta.json")
+        # 檔案鎖在外層：檢查磁碟版本、合併、寫入、重新掛上之間，其他 worker 不會插進來寫
+        with self._file_lock():
+            with self._lock:
+                if not self._snapshot and os.path.exists(meta_path):
+                    disk = self._read_files(meta_path)
+                    if disk[0] is not None and disk[0].get("version") != self._disk_version:
+                        # 其他 worker 在我們上次載入後存過檔：以那一版為底，重放本 worker 尚未存檔的變更
+                        print(f"[NgramIndex] 磁碟上的索引已被其他行程更新，合併 {len(self._journal)} 筆未存檔的變更")
+                        self._install(*disk)
+                if self._deleted:
+                    self.compact()
+                version = uuid.uuid4().hex
+                self._write_files(version)
+                self._journal = []
+                self._snapshot = False
+                # 重新以 mmap 掛上剛寫好的 base，釋放記憶體中的 delta
+                self._install(*self._read_files(meta_path))
+
+    def _write_files(self, version):
+        """把目前內容 (base + delta，已無墓碑) 寫成新的一組檔案 (呼叫端持有檔案鎖與 self._lock)"""
+        # 1. 文字：一個 UTF-8 blob + offsets
+        read_text = self._text_reader()
+        encoded = [read_text(slot).encode("utf-8") for slot in range(len(self._ids))]
+        text_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        if encoded:
+            text_offsets[1:] = np.cumsum([len(b) for b in encoded])
+
+        # 2. postings：把 base 與 delta 合併成 CSR
+        vocab = {}
+        chunks = []
+        cursor = 0
+        all_grams = set(self._base_vocab) | set(self._postings)
+        for gram in sorted(all_grams):
+            p = self._posting(gram)
+            if not len(p):
+                continue
+            vocab[gram] = [cursor, cursor + len(p)]
+            chunks.append(p)
+            cursor += len(p)
+        postings = np.concatenate(chunks).astype(np.int32) if chunks else np.empty(0, dtype=np.int32)
+
+        tmp = {}
+        try:
+            for name in ("texts.bin", "text_offsets.npy", "postings.npy", "meta.json"):
+                fd, tmp[name] = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=self.persist_dir)
+                os.close(fd)
+            with open(tmp["texts.bin"], "wb") as f:
+                f.write(b"".join(encoded))
+            with open(tmp["text_offsets.npy"], "wb") as f:
+                np.save(f, text_offsets)
+            with open(tmp["postings.npy"], "wb") as f:
+                np.save(f, postings)
+            with open(tmp["meta.json"], "w", encoding="utf-8") as f:
+                json.dump({"ngram_sizes": list(self.ngram_sizes), "version": version, "ids": self._ids, "vocab": vocab},
+                          f, ensure_ascii=False)
+            # meta.json 最後換上 (沒有檔案鎖的平台上，至少讀到的 meta 一定有對應的完整陣列)
+            for name in ("texts.bin", "text_offsets.npy", "postings.npy", "meta.json"):
+                os.replace(tmp.pop(name), os.path.join(self.persist_dir, name))
+        finally:
+            for path in tmp.values():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def load(self):
+        """
+        從 persist_dir 以 mmap 載入；檔案不存在或 n-gram 設定不同時回傳 False。
+        本行程尚未存檔的變更 (journal) 會重放在載入的版本上，不會因為重新載入而遺失。
+        """
+        if not self.persist_dir:
+            return False
+        meta_path = os.path.join(self.persist_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return False
+        try:
+            with self._file_lock(shared=True):
+                disk = self._read_files(meta_path)
+        except Exception as e:
+            print(f"[NgramIndex] 載入失敗，需重建: {e}")
+            return False
+        if disk[0] is None:
+            return False
+        with self._lock:
+            self._install(*disk)
+        return True
+
+    def _install(self, meta, postings, text_blob, text_offsets):
+        """換上磁碟上的一版作為 base，再重放尚未存檔的變更 (呼叫端持有 self._lock)"""
+        self._reset()
+        self._ids = list(meta["ids"])
+        self._id_to_slot = {doc_id: slot for slot, doc_id in enumerate(self._ids) if doc_id is not None}
+        self._base_vocab = {gram: tuple(span) for gram, span in meta["vocab"].items()}
+        self._base_postings = postings
+        self._base_text_blob = text_blob
+        self._base_text_offsets = text_offsets
+        self._base_slots = len(self._ids)
+        self._disk_version = meta.get("version")
+        self._snapshot = False
+        for entry in self._journal:
+            if entry[0] == "add":
+                self._add(entry[1], entry[2])
+            else:
+                self._remove(entry[1])
+
+    def _read_files(self, meta_path):
+        """讀 meta 並以 mmap 開啟陣列 (呼叫端持有檔案鎖)；n-gram 設定不同時回傳 (None, ...)"""
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if tuple(meta["ngram_sizes"]) != self.ngram_sizes:
+            print(f"[NgramIndex] n-gram 設定不同 ({meta['ngram_sizes']} != {list(self.ngram_sizes)})，需重建")
+            return None, None, None, None
+        text_offsets = np.load(os.path.join(self.persist_dir, "text_offsets.npy"), mmap_mode="r")
+        postings = np.load(os.path.join(self.persist_dir, "postings.npy"), mmap_mode="r")
+        blob_path = os.path.join(self.persist_dir, "texts.bin")
+        if os.path.getsize(blob_path) > 0:
+            text_blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            text_blob = np.empty(0, dtype=np.uint8)
+        return meta, postings, text_blob, text_offsets
+
+    @contextmanager
+    def _file_lock(self, shared=False):
+        """跨行程的檔案鎖 (persist_dir/.lock)；寫入用獨佔鎖，載入用共用鎖"""
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.persist_dir, exist_ok=True)
+        with open(os.path.join(self.persist_dir, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def rebuild_from_collection(self, collection, batch_size=1000):
+        """由 ChromaDB collection 全量重建 (第一次啟用或索引檔遺失時使用；存檔時直接覆蓋磁碟版本)"""
+        with self._lock:
+            self.clear()
+            total = collection.count()
+            for offset in range(0, total, batch_size):
+                batch = collection.get(limit=batch_size, offset=offset, include=['documents'])
+                self._add(batch['ids'], [text or "" for text in batch['documents']])
+        print(f"[NgramIndex] 已由向量資料庫重建索引: {len(self)} 筆")
+        self.save()
@@ -0,0 +1,55 @@
+import re
+import sys
+
+# ==========================================
+# 多字詞比對器 (Multi-pattern Matcher)
+# ==========================================
+# 把一組字詞編譯成單一 regex (依長度由長到短的 alternation)，
+# 由 C 實作的 regex 引擎一次掃過文字，不必每個字詞各掃一次。
+#
+# find_all() 的結果與逐一做 `p in text` 完全相同 (包含互相重疊的字詞)：
+#   - 每個起始位置，alternation 會先試長的字詞，所以拿到的是「該位置最長的命中」
+#   - 同一位置較短的命中一定是最長命中的前綴 -> 事先算好前綴閉包一起加入
+#   - 下一次搜尋從 (起點 + 1) 開始，所以不會漏掉跨越前一個命中的字詞
+# 字詞全部命中後就提早結束。
+#
+# 註：純 Python 實作的 Aho-Corasick 逐字元走訪，在 CPython 上比 C 的子字串搜尋慢一個數量級，
+#     因此這裡用 regex 引擎當作「編譯好的自動機」。
+
+class MultiPatternMatcher:
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(p for p in patterns if p))
+        ordered = sorted(self.patterns, key=len, reverse=True)
+        self._regex = re.compile("|".join(re.escape(p) for p in ordered)) if ordered else None
+        # 前綴閉包：命中 p 時，所有是 p 前綴的字詞也一定命中
+        self._closure = {p: [q for q in self.patterns if p.startswith(q)] for p in self.patterns}
+
+    def contains_any(self, text):
+        """是否至少命中一個字詞 (單次掃描)"""
+        if not self._regex or not text:
+            return False
+        return self._regex.search(text) is not None
+
+    def find_all(self, text):
+        """回傳 text 中出現過的所有字詞 (set)"""
+        found = set()
+        if not self._regex or not text:
+            return found
+        total = len(self.patterns)
+        search = self._regex.search
+        m = search(text)
+        while m:
+            found.update(self._closure[m.group()])
+            if len(found) >= total:
+                break
+            m = search(text, m.start() + 1)
+        return found
+
+
+def _build_digit_regex():
+    """與 str.isdigit() 完全相同的字元集 (包含 ①、² 這類 \\d 不認得的數字)"""
+    extra = [chr(c) for c in range(sys.maxunicode + 1) if chr(c).isdigit() and not chr(c).isdecimal()]
+    return re.compile("[\\d" + "".join(re.escape(c) for c in extra) + "]")
+
+# 行程層級只建一次
+DIGIT_RE = _build_digit_regex()
@@ -0,0 +1,145 @@
+import os
+
+# ==========================================
+# Prompt 樣板 (依意圖選擇、可切換版本)
+# ==========================================
+# vLLM 的 automatic prefix caching 只能重用「從頭開始完全相同」的 token 的 KV cache。
+# 舊版 prompt 把檢索到的 <context> 放在最前面，後面才是固定的角色/規則/格式說明，
+# 導致每個請求從第一段就不同，完全無法共用。
+#   - v1：舊版排列 (單一 user 訊息，context 在規則之前)，保留作為對照與回退
+#   - v2：固定不變的角色、規則、格式放在 system 訊息 (固定前綴)，
+#         會變動的 context 與問題放在最後的 user 訊息
+# Gemma 的 chat template 會把 system 內容併到第一個 user turn 的開頭，前綴一樣固定。
+# 樣板字串一旦上線就不要就地修改 (會讓所有 prefix cache 失效、也無法比較)，請新增版本。
+
+PROMPT_TEMPLATE_VERSION = os.getenv("PROMPT_TEMPLATE_VERSION", "v2")
+# chat template 額外加入的控制 token (<start_of_turn>user 等) 預留數
+CHAT_TEMPLATE_OVERHEAD_TOKENS = 32
+
+
+# --- 一般 QA ---
+QA_ROLE = """<role>
+你是一位隸屬於高層決策單位的「首席情報分析師」。你的任務是基於檢索到的內部資料，提供精確、證據導向的分析報告。
+</role>"""
+
+QA_RULES = """<rules>
+1. **絕對證據原則**：所有回答必須嚴格基於 <context> 內容。若資料中未提及，請直接回答「資料庫中無相關資訊」，禁止自行腦補或使用外部知識。
+2. **數據精確性**：引用數據時（金額、人數、百分比），必須與原文完全一致，保留小數點與單位。
+3. **實體完整性**：提到廠商、機構或專案名稱時，請列出全名，並在首次出現時使用 **粗體** 標示。
+4. **排除無效資訊**：若表格數據為 "-" 或 "NA"，代表無數據，請勿將其視為 "0" 或納入統計。
+5. **時間敏感度**：若資料包含多個年份（如 112年、113年），請務必在回答中標註年份。
+6. **數據邏輯檢核**：若原文表格中包含「總計」或「合計」，請優先引用該數值。若你需要加總多個年份的數字，請務必先進行數學驗算；若驗算結果與原文總數不符，請回答「原文數據與總計有出入」，禁止自行修正或腦補。
+</rules>"""
+
+QA_OUTPUT_FORMAT = """<output_format>
+請直接回答使用者的問題，無需開場白（如"你好"、"根據資料"），並依照以下格式輸出：
+
+### 🎯 核心結論
+(用 2-3 句話直接回答問題的重點結論)
+
+### 📊 詳細分析
+* **[分類標題 1]**：具體說明，包含廠商名單與關鍵數據。
+* **[分類標題 2]**：具體說明，包含廠商名單與關鍵數據。
+(請根據內容自動分類，每個重點一段，條理分明)
+
+### 💡 綜合評估
+(總結該議題的價值、趨勢或缺口)
+</output_format>"""
+
+QA_QUERY = """<user_query>
+{query}
+</user_query>"""
+
+
+# --- 演講稿 ---
+SPEECH_ROLE = """<role>
+你現在是某政府機關或大型企業的「幕僚長」，正在為你的首長撰寫一篇公開場合的致詞稿。
+</role>"""
+
+SPEECH_STYLE_GUIDE = """<style_guide>
+1. **語氣設定**：穩健、自信、大器。這是要「唸出來」的稿子，請使用口語連接詞（如「各位貴賓」、「我們看到」、「這代表著」），避免生硬的公文語句。
+2. **數據轉化**：將冰冷的數據轉化為故事。例如不要說「成長20%」，要說「我們成功創造了兩成的顯著成長」。
+3. **格式禁忌**：**絕對禁止**使用 Markdown 標題符號 (#) 或列點符號 (-/1.)。整篇稿子必須是純文字段落。
+4. **篇幅控制**：約 800 字，適合 3-5 分鐘的演說。
+</style_guide>"""
+
+SPEECH_STRUCTURE = """<structure>
+1. **開場 (15%)**：向在場貴賓（依據問題情境推斷）致意，點出今日主題的重要性與願景。
+2. **本文 (70%)**：
+- 引用 <context> 中的具體成果（如廠商名、產值、獲獎紀錄）作為政績/業績證明。
+- 將分散的數據串聯成一個推動產業發展的故事。
+- **注意**：只能引用資料裡有的事實，不可捏造。
+3. **結語 (15%)**：重申核心價值，並提出對未來的期許 (Call to Action)，以高昂的語氣結尾。
+</structure>"""
+
+SPEECH_QUERY = """<user_instruction>
+演講主題：{query}
+請依據上述架構，撰寫一份完整的逐字演講稿：
+</user_instruction>"""
+
+CONTEXT_BLOCK = """<context>
+{context}
+</context>"""
+
+
+class PromptTemplate:
+    """
+    system：固定前綴 (可為空字串 = 不送 system 訊息)
+    user：含 {context} 與 {query} 的樣板
+    """
+    def __init__(self, intent, version, system, user):
+        self.intent = intent
+        self.version = version
+        self.system = system
+        self.user = user
+
+    @property
+    def key(self):
+        return f"{self.intent}:{self.version}"
+
+    def build_messages(self, context, query):
+        messages = []
+        if self.system:
+            messages.append({"role": "system", "content": self.system})
+        messages.append({"role": "user", "content": self.user.format(context=context, query=query)})
+        return messages
+
+    def static_token_count(self, counter):
+        """context 與問題以外的 token 數 (打包 context 時從預算扣除)"""
+        return (
+            counter.count(self.system)
+            + counter.count(self.user.format(context="", query=""))
+            + CHAT_TEMPLATE_OVERHEAD_TOKENS
+        )
+
+
+def _join(*blocks):
+    return "\n\n".join(blocks)
+
+
+PROMPT_TEMPLATES = {}
+
+def register_template(template):
+    PROMPT_TEMPLATES[(template.intent, template.version)] = template
+
+# v1：舊版排列 (context 在最前面，單一 user 訊息)
+register_template(PromptTemplate("qa", "v1", "", _join(QA_ROLE, CONTEXT_BLOCK, QA_RULES, QA_OUTPUT_FORMAT, QA_QUERY)))
+register_template(PromptTemplate("speech", "v1", "", _join(SPEECH_ROLE, CONTEXT_BLOCK, SPEECH_STYLE_GUIDE, SPEECH_STRUCTURE, SPEECH_QUERY)))
+
+# v2：固定前綴在 system，變動的 context / 問題在最後
+register_template(PromptTemplate("qa", "v2", _join(QA_ROLE, QA_RULES, QA_OUTPUT_FORMAT), _join(CONTEXT_BLOCK, QA_QUERY)))
+register_template(PromptTemplate("speech", "v2", _join(SPEECH_ROLE, SPEECH_STYLE_GUIDE, SPEECH_STRUCTURE), _join(CONTEXT_BLOCK, SPEECH_QUERY)))
+
+
+def get_template(intent, version=None):
+    """依意圖取得樣板；找不到指定版本時退回 v2"""
+    version = version or PROMPT_TEMPLATE_VERSION
+    template = PROMPT_TEMPLATES.get((intent, version)) or PROMPT_TEMPLATES.get((intent, "v2"))
+    if template is None:
+        raise KeyError(f"找不到 prompt 樣板: {intent}:{version}")
+    return template
+
+
+def select_intent(query_intents):
+    """detect_query_intents 的結果 -> 樣板意圖"""
+    return "speech" if "speech" in query_intents else "qa"
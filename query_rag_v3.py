@@ -1,11 +1,14 @@
 import chromadb
-from openai import OpenAI
-from sentence_transformers import SentenceTransformer
+from openai import OpenAI, AsyncOpenAI
 import numpy as np
 import re
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from embedding_cache import QueryEmbeddingCache
+from embedding_backends import load_embedding_backend
+from pattern_matcher import MultiPatternMatcher, DIGIT_RE
 
 # 載入環境變數
 load_dotenv()
@@ -23,13 +26,10 @@ MAX_CONTEXT_CHARS = int(os.getenv("MAX_CONTEXT_CHARS", "20000"))
 
 # 初始化 LLM Client (全域使用)
 llm_client = OpenAI(base_url=API_BASE, api_key=API_KEY)
+# 非同步版本 (給 rag_server 的 event loop 使用，不會卡住其他串流)
+async_llm_client = AsyncOpenAI(base_url=API_BASE, api_key=API_KEY)
 
-def get_keywords_via_llm(query):
-    """
-    【智慧核心 - 通用版】
-    使用 LLM 提取搜尋關鍵字，並賦予其「聯想潛在數據指標」的能力。
-    """
-    system_prompt = """你是一個精準的 RAG 搜尋優化專家。
+KEYWORD_SYSTEM_PROMPT = """你是一個精準的 RAG 搜尋優化專家。
 你的任務是將使用者的模糊問題，轉換為 3-8 個精確的資料庫搜尋關鍵字。
 
 【關鍵策略】：
@@ -51,24 +51,29 @@ def get_keywords_via_llm(query):
 範例輸出：112年, 預算, 執行率, 決算數, 經費, 達成率
 """
 
+def parse_keywords(content):
+    """清洗 LLM 回傳的關鍵字字串"""
+    keywords = [k.strip() for k in re.split(r'[,，、\n]+', content.strip()) if k.strip()]
+    # 移除太短的廢字
+    return [k for k in keywords if len(k) > 1]
+
+
+def get_keywords_via_llm(query):
+    """
+    【智慧核心 - 通用版】
+    使用 LLM 提取搜尋關鍵字，並賦予其「聯想潛在數據指標」的能力。
+    """
     try:
         response = llm_client.chat.completions.create(
             model=LLM_MODEL,
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": KEYWORD_SYSTEM_PROMPT},
                 {"role": "user", "content": query}
             ],
             temperature=0.0, # 稍微給一點創意空間讓它聯想
             max_tokens=100
         )
-        content = response.choices[0].message.content.strip()
-        
-        # 清洗結果
-        keywords = [k.strip() for k in re.split(r'[,，、\n]+', content) if k.strip()]
-        
-        # 移除太短的廢字
-        keywords = [k for k in keywords if len(k) > 1]
-        
+        keywords = parse_keywords(response.choices[0].message.content)
         print(f"擴展關鍵字: {keywords}")
         return keywords
 
@@ -78,6 +83,48 @@ def get_keywords_via_llm(query):
         return [query]
 
 
+async def get_keywords_via_llm_async(query):
+    """get_keywords_via_llm 的非同步版本 (AsyncOpenAI)，等待 LLM 時不會阻塞 event loop"""
+    try:
+        response = await async_llm_client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=[
+                {"role": "system", "content": KEYWORD_SYSTEM_PROMPT},
+                {"role": "user", "content": query}
+            ],
+            temperature=0.0,
+            max_tokens=100
+        )
+        keywords = parse_keywords(response.choices[0].message.content)
+        print(f"擴展關鍵字: {keywords}")
+        return keywords
+
+    except Exception as e:
+        print(f"LLM 提取關鍵字失敗: {e}")
+        return [query]
+
+
+# ==========================================
+# 問題意圖詞庫 (行程啟動時編譯一次，一次掃描問題即可判斷所有意圖)
+# ==========================================
+QUERY_INTENT_VOCABS = {
+    "money": ["金額", "經費", "預算", "產值", "營收"],          # 針對「錢」的問題
+    "result": ["成果", "績效", "亮點", "成效", "產出"],         # 「績效/成果」類問題
+    "speech": ["演講", "致詞", "講稿", "致辭", "發言稿"],       # 演講稿需求
+}
+_INTENT_MATCHER = MultiPatternMatcher([t for terms in QUERY_INTENT_VOCABS.values() for t in terms])
+_TERM_TO_INTENTS = {}
+for _intent, _terms in QUERY_INTENT_VOCABS.items():
+    for _t in _terms:
+        _TERM_TO_INTENTS.setdefault(_t, set()).add(_intent)
+
+def detect_query_intents(query):
+    """回傳問題命中的意圖集合，例如 {"money", "result"}"""
+    intents = set()
+    for term in _INTENT_MATCHER.find_all(query):
+        intents |= _TERM_TO_INTENTS[term]
+    return intents
+
 def expand_keywords_by_intent(query, core_keywords):
     expanded = list(core_keywords)
     
@@ -87,11 +134,15 @@ def expand_keywords_by_intent(query, core_keywords):
         expanded.extend(year_matches)
 
     # 針對「錢」的通用符號擴充 (不限產業)
-    if any(k in query for k in ["金額", "經費", "預算", "產值", "營收"]):
+    if "money" in detect_query_intents(query):
         expanded.extend(["元", "千元", "億元", "%"])
 
     return list(set(expanded))
 
+DATA_INTENT_TERMS = ["多少", "金額", "經費", "預算", "費用"]
+UNIT_TERMS = ["元", "億", "萬", "人"]
+UNIT_MATCHER = MultiPatternMatcher(UNIT_TERMS)
+
 def calculate_keyword_score(query_keywords, text):
     if not text: return 0
     score = 0
@@ -100,90 +151,161 @@ def calculate_keyword_score(query_keywords, text):
             score += (len(kw) ** 2) 
     
     # 數據意圖加分
-    if any(k in ["多少", "金額", "經費", "預算", "費用"] for k in query_keywords):
-        digit_count = sum(c.isdigit() for c in text)
-        if digit_count > 0: score += 5.0
-        if any(u in text for u in ["元", "億", "萬", "人"]): score += 5.0
+    if any(k in DATA_INTENT_TERMS for k in query_keywords):
+        if DIGIT_RE.search(text): score += 5.0
+        if UNIT_MATCHER.contains_any(text): score += 5.0
     return score
 
-def advanced_reranker(query, documents, metadatas, distances, top_n=30, decay_rate=0.95, keywords=[]):
-    temp_scores = []
-    is_asking_result = any(k in query for k in ["成果", "績效", "亮點", "成效", "產出"])
-    
-    # 1. 基礎計分
-    for i, (doc, meta, dist) in enumerate(zip(documents, metadatas, distances)):
-        
-        # 防呆檢查：若資料庫回傳 dist 為 None
-        if dist is None:
-            sim_score = 0.0
-            safe_dist = 1.0
-        else:
-            sim_score = 1 - dist 
-            safe_dist = dist
-            
-        norm_vector = max(0, min(1, sim_score))
-        
-        # 關鍵字加分 (確保 doc 也不為 None)
-        safe_doc = doc if doc else ""
-        kw_score = calculate_keyword_score(keywords, safe_doc)
-        norm_kw = min(1.0, kw_score / 15.0) 
-        
-        # 綜合分數 (關鍵字權重 0.3, 向量 0.7)
-        base_score = (norm_vector * 0.7) + (norm_kw * 0.3)
-        
-        safe_meta = meta if meta else {}
-        doc_name = safe_meta.get("doc_name", "unknown")
+def calculate_keyword_scores(query_keywords, texts):
+    """
+    calculate_keyword_score 的批次版：回傳 ndarray。
+    單位與數字各用一個編譯好的 regex 掃一次；問題關鍵字通常不到 10 個，
+    逐一用 C 實作的子字串搜尋 (`kw in t`) 比 Python 層的自動機走訪更快。
+    """
+    n = len(texts)
+    scores = np.zeros(n, dtype=np.float64)
+    for kw in query_keywords:
+        scores += np.fromiter((kw in t for t in texts), dtype=bool, count=n) * float(len(kw) ** 2)
 
-        if is_asking_result:
-            if any(x in doc_name for x in ["績效", "成果", "結案", "報告"]):
-                base_score += 0.15  # 加分：讓報告書浮上來
-            elif any(x in doc_name for x in ["計畫書", "手冊", "格式"]):
-                base_score -= 0.05  # 扣分：這些通常是行政流程文件
+    # 數據意圖只跟關鍵字有關，整批只判斷一次
+    if any(k in DATA_INTENT_TERMS for k in query_keywords):
+        scores += np.fromiter((DIGIT_RE.search(t) is not None for t in texts), dtype=bool, count=n) * 5.0
+        scores += np.fromiter((UNIT_MATCHER.contains_any(t) for t in texts), dtype=bool, count=n) * 5.0
 
-        temp_scores.append({
-            "index": i,
-            "doc": safe_doc,
-            "meta": safe_meta,
-            "distance": safe_dist,
-            "base_score": base_score,
-            "doc_name": doc_name
-        })
+    non_empty = np.fromiter((bool(t) for t in texts), dtype=bool, count=n)
+    return np.where(non_empty, scores, 0.0)
+
+# 「績效/成果」類問題：文件名稱加減分規則
+RESULT_DOC_MATCHER = MultiPatternMatcher(["績效", "成果", "結案", "報告"])   # 加分：讓報告書浮上來
+ADMIN_DOC_MATCHER = MultiPatternMatcher(["計畫書", "手冊", "格式"])          # 扣分：這些通常是行政流程文件
+
+# 設定：同一份文件最多允許幾個 Chunk 排在最前面？
+MAX_CHUNKS_HEAD = 3
+
+def rrf_similarity(sim_scores, has_dist, rrf):
+    """
+    替沒有向量距離 (只由 BM25 找到) 的候選補上相似度：
+    以有距離的候選建立「RRF 分數 -> 向量相似度」的單調對應 (RRF 越高相似度不會越低)，
+    再依各候選的 RRF 分數內插；完全沒有向量結果時退回 RRF 分數的相對值。
+    """
+    fill = ~has_dist & (rrf > 0)
+    if not fill.any():
+        return sim_scores
+    sim_scores = sim_scores.copy()
+    known = has_dist & (rrf > 0)
+    if known.any():
+        order = np.argsort(rrf[known], kind="stable")
+        xs = rrf[known][order]
+        ys = np.maximum.accumulate(sim_scores[known][order])
+        sim_scores[fill] = np.interp(rrf[fill], xs, ys)
+    else:
+        sim_scores[fill] = rrf[fill] / rrf.max()
+    return sim_scores
+
+def advanced_reranker(query, documents, metadatas, distances, top_n=30, decay_rate=0.95, keywords=[], ids=None, explain=False,
+                      rrf_scores=None):
+    """
+    NumPy 版重排序：分數以陣列批次計算，多樣性懲罰用分組運算，
+    最後只對可能進入前 top_n 的候選做排序 (partial selection)。
+    排序規則與逐筆版本完全相同 (同分時維持原本的穩定排序順序)。
+    rrf_scores：混合檢索的 RRF 分數 (與 documents 對齊，非融合來源為 None)。有給時，只由 BM25 找到、
+    沒有向量距離的候選改用「融合排名相當的向量命中」的相似度，而不是當成 0。
+    explain=True 時每筆結果多一個 score_components (向量相似度、關鍵字分數、文件名加減分、多樣性懲罰)。
+    """
+    n = min(len(documents), len(metadatas), len(distances))
+    if n == 0:
+        return []
+    is_asking_result = "result" in detect_query_intents(query)
+
+    # 1. 基礎計分
+    # 防呆檢查：若資料庫回傳 dist 為 None，相似度視為 0、距離視為 1.0
+    safe_dists = [1.0 if d is None else d for d in distances[:n]]
+    has_dist = np.fromiter((d is not None for d in distances[:n]), dtype=bool, count=n)
+    sim_scores = np.where(has_dist, 1 - np.asarray(safe_dists, dtype=np.float64), 0.0)
+    rrf = None
+    if rrf_scores is not None:
+        rrf = np.asarray([0.0 if r is None else r for r in rrf_scores[:n]], dtype=np.float64)
+        sim_scores = rrf_similarity(sim_scores, has_dist, rrf)
+    norm_vector = np.clip(sim_scores, 0, 1)
+
+    # 關鍵字加分 (確保 doc 也不為 None)
+    safe_docs = [doc if doc else "" for doc in documents[:n]]
+    kw_scores = calculate_keyword_scores(keywords, safe_docs)
+    norm_kw = np.minimum(1.0, kw_scores / 15.0)
+
+    # 綜合分數 (關鍵字權重 0.3, 向量 0.7)
+    base_scores = (norm_vector * 0.7) + (norm_kw * 0.3)
+
+    safe_metas = [meta if meta else {} for meta in metadatas[:n]]
+    doc_names = [meta.get("doc_name", "unknown") for meta in safe_metas]
+    # 文件名稱只有少數幾種，以名稱為單位計算一次，再用 inverse index 展開
+    unique_names, name_codes = np.unique(np.asarray(doc_names, dtype=object), return_inverse=True)
+    name_bonus = None
+    if is_asking_result:
+        name_bonus = np.array([
+            0.15 if RESULT_DOC_MATCHER.contains_any(name)
+            else -0.05 if ADMIN_DOC_MATCHER.contains_any(name)
+            else 0.0
+            for name in unique_names
+        ], dtype=np.float64)
+        base_scores = base_scores + name_bonus[name_codes]
 
     # 2. 多樣性過濾 (Diversity Filter)
-    # 先依照分數高低排序
-    temp_scores.sort(key=lambda x: x["base_score"], reverse=True)
+    # 先依照分數高低排序 (stable：同分維持原順序)
+    order = np.argsort(-base_scores, kind="stable")
+    sorted_codes = name_codes[order]
+    # 每個項目是同一份文件中的第幾名 (分組累計計數)
+    by_group = np.argsort(sorted_codes, kind="stable")
+    grouped = sorted_codes[by_group]
+    starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+    group_start = np.repeat(starts, np.diff(np.r_[starts, n]))
+    occurrence = np.empty(n, dtype=np.int64)
+    occurrence[by_group] = np.arange(n) - group_start
+
+    # 超額的 Chunk 進入候補區並給予懲罰 (Penalty)
+    deferred = occurrence >= MAX_CHUNKS_HEAD
+    sorted_base = base_scores[order]
+    final_scores = np.where(deferred, sorted_base * 0.5, sorted_base)
+
+    # 3. 取前 N 名 (partial selection)
+    # 排序鍵：final_score 由高到低 -> 錄取區在候補區之前 -> 第一次排序的位置
+    k = min(top_n, n)
+    if k <= 0:
+        return []
+    if k < n:
+        threshold = np.partition(final_scores, n - k)[n - k]
+        pool = np.flatnonzero(final_scores >= threshold)
+    else:
+        pool = np.arange(n)
+    pool = pool[np.lexsort((pool, deferred[pool], -final_scores[pool]))][:k]
 
     final_results = []
-    seen_docs = {}
-    
-    # 設定：同一份文件最多允許幾個 Chunk 排在最前面？
-    MAX_CHUNKS_HEAD = 3 
-    
-    deferred_queue = [] # 被降權的候補區
-
-    for item in temp_scores:
-        d_name = item['doc_name']
-        current_count = seen_docs.get(d_name, 0)
-        
-        if current_count < MAX_CHUNKS_HEAD:
-            # 名額內：保持原分，直接錄取
-            item['final_score'] = item['base_score']
-            final_results.append(item)
-            seen_docs[d_name] = current_count + 1
-        else:
-            # 超額：進入候補區，並給予懲罰 (Penalty)
-            item['final_score'] = item['base_score'] * 0.5 
-            deferred_queue.append(item)
-    
-    # 將降權後的項目加回來
-    final_results.extend(deferred_queue)
-    
-    # 再次根據 final_score 排序
-    final_results.sort(key=lambda x: x['final_score'], reverse=True)
-    for res in final_results:
-        res['score'] = res['final_score']
-    # 取前 N 名
-    return final_results[:top_n]
+    for pos in pool:
+        i = int(order[pos])
+        final_score = float(final_scores[pos])
+        final_results.append({
+            "index": i,
+            "id": ids[i] if ids else None,
+            "doc": safe_docs[i],
+            "meta": safe_metas[i],
+            "distance": safe_dists[i],
+            "base_score": float(base_scores[i]),
+            "doc_name": doc_names[i],
+            "final_score": final_score,
+            "score": final_score,
+        })
+        if explain:
+            final_results[-1]["score_components"] = {
+                "vector_similarity": float(norm_vector[i]),
+                "keyword_score": float(kw_scores[i]),
+                "keyword_score_normalized": float(norm_kw[i]),
+                "rrf_score": float(rrf[i]) if rrf is not None else None,
+                "doc_name_bonus": float(name_bonus[name_codes[i]]) if name_bonus is not None else 0.0,
+                "base_score": float(base_scores[i]),
+                "diversity_penalty": float(base_scores[i]) - final_score,
+                "deferred": bool(deferred[pos]),
+            }
+    return final_results
 
 def group_and_merge_results(candidates):
     """
@@ -254,8 +376,15 @@ def group_and_merge_results(candidates):
             "doc": full_content,
             "score": max_score, # 讓合併後的表格排在前面
             "meta": best_meta,
+            "ids": [item.get('id') for item in items],
             "debug_info": f"[Merged {len(items)} Items] MaxScore: {max_score:.3f}"
         }
+        # explain 模式：保留每一列合併前的分數組成
+        if any('score_components' in item for item in items):
+            merged_item["merged_components"] = [
+                dict(item.get('score_components', {}), id=item.get('id'), score=item.get('score'))
+                for item in items
+            ]
         # 標記為合併類型
         merged_item['meta']['type'] = 'MergedTable'
         
@@ -266,9 +395,21 @@ def group_and_merge_results(candidates):
     
     return final_results
 
+def collect_chunk_ids(results):
+    """取出結果中所有 chunk ID (MergedTable 會展開成多筆)"""
+    chunk_ids = set()
+    for r in results:
+        if r.get('ids'):
+            chunk_ids.update(i for i in r['ids'] if i)
+        elif r.get('id'):
+            chunk_ids.add(r['id'])
+    return frozenset(chunk_ids)
+
 def main():
     print(f"正在載入 Embedding 模型: {MODEL_PATH} ...")
-    embed_model = SentenceTransformer(MODEL_PATH, trust_remote_code=True, device='cpu')
+    # CLI 預設在 CPU 執行；EMBEDDING_BACKEND=onnx 時改用量化 ONNX 模型
+    embed_model = load_embedding_backend(MODEL_PATH, device=os.getenv("EMBEDDING_DEVICE", "cpu"))
+    query_embed_cache = QueryEmbeddingCache(embed_model.encode, model_id=MODEL_PATH)
     
     print(f"連接向量資料庫: {DB_PATH}")
     client = chromadb.PersistentClient(path=DB_PATH)
@@ -276,6 +417,8 @@ def main():
     
     print(f"系統準備就緒！連接 vLLM: {LLM_MODEL}")
     print("=" * 50)
+
+    executor = ThreadPoolExecutor(max_workers=4)
     
     while True:
         query = input("\n請輸入問題 (輸入 'q' 離開): ").strip()
@@ -286,18 +429,34 @@ def main():
             
         print("正在搜尋相關文件...")
         
+        # === Step 0 / Step 1 並行：關鍵字提取與向量搜尋互不相依 ===
+        def run_vector_search():
+            query_vec = [query_embed_cache.encode(query)]
+            return collection.query(
+                query_embeddings=query_vec,
+                n_results=100, # 擴大搜尋範圍，確保碎片都有被撈到
+                include=['documents', 'metadatas', 'distances']
+            )
+
+        def run_keyword_search(kw):
+            return collection.get(
+                where_document={"$contains": kw},
+                limit=50,
+                include=['documents', 'metadatas']
+            )
+
+        vector_future = executor.submit(run_vector_search)
+
         # === Step 0: 智慧提取關鍵字 ===
         core_keywords = get_keywords_via_llm(query)
         expanded_keywords = expand_keywords_by_intent(query, core_keywords)
         expanded_keywords = expanded_keywords[:8]
-        
-        # === Step 1: 向量搜尋 ===
-        query_vec = embed_model.encode([query]).tolist()
-        vector_results = collection.query(
-            query_embeddings=query_vec,
-            n_results=100, # 擴大搜尋範圍，確保碎片都有被撈到
-            include=['documents', 'metadatas', 'distances']
-        )
+
+        # === Step 2: 關鍵字強制搜尋 (關鍵字一到就開始，不等向量搜尋) ===
+        kw_futures = [executor.submit(run_keyword_search, kw) for kw in expanded_keywords]
+
+        # === Step 1: 向量搜尋 (等待結果) ===
+        vector_results = vector_future.result()
         
         candidates_map = {}
         if vector_results['documents']:
@@ -309,27 +468,21 @@ def main():
                     "source": "vector"
                 }
 
-        # === Step 2: 關鍵字強制搜尋 ===
-        if expanded_keywords:
-            for kw in expanded_keywords:
-                try:
-                    kw_results = collection.get(
-                        where_document={"$contains": kw},
-                        limit=50,
-                        include=['documents', 'metadatas']
-                    )
-                    
-                    if kw_results['ids']:
-                        for i, doc_id in enumerate(kw_results['ids']):
-                            if doc_id not in candidates_map:
-                                candidates_map[doc_id] = {
-                                    "doc": kw_results['documents'][i],
-                                    "meta": kw_results['metadatas'][i],
-                                    "distance": None, 
-                                    "source": "keyword"
-                                }
-                except Exception as e:
-                    pass # 忽略錯誤
+        for future in kw_futures:
+            try:
+                kw_results = future.result()
+                
+                if kw_results['ids']:
+                    for i, doc_id in enumerate(kw_results['ids']):
+                        if doc_id not in candidates_map:
+                            candidates_map[doc_id] = {
+                                "doc": kw_results['documents'][i],
+                                "meta": kw_results['metadatas'][i],
+                                "distance": None, 
+                                "source": "keyword"
+                            }
+            except Exception as e:
+                pass # 忽略錯誤
 
         combined_docs = [v["doc"] for v in candidates_map.values()]
         combined_metas = [v["meta"] for v in candidates_map.values()]
@@ -398,7 +551,7 @@ def main():
             continue
 
         # === Step 7: 生成回應 (Prompt) ===
-        is_speech_request = any(kw in query for kw in ["演講", "致詞", "講稿", "致辭", "發言稿"])
+        is_speech_request = "speech" in detect_query_intents(query)
 
         if is_speech_request:
             print("偵測到演講稿需求...")
@@ -3,11 +3,19 @@ import re
 import time
 import os
 import shutil
+import asyncio
+import functools
+import contextvars
+import random
+import uuid
+import ipaddress
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, Request, UploadFile, File, HTTPException, BackgroundTasks, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response, FileResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from urllib.parse import unquote
 
 from datetime import datetime, timedelta, timezone
@@ -22,12 +30,30 @@ from sqlalchemy.orm import sessionmaker, Session
 import chromadb
 # from openai import OpenAI
 from openai import AsyncOpenAI
-from sentence_transformers import SentenceTransformer
 import numpy as np
 
 import query_rag_v3 as my_rag
 import main_pipeline_v5 as pipeline
 import build_vectordb_v3 as db_builder
+from embedding_cache import QueryEmbeddingCache
+from answer_cache import SemanticAnswerCache
+from bm25_retriever import VECTOR_N_RESULTS, BM25_TOP_K, fuse_candidates
+from cross_encoder_reranker import CrossEncoderReranker
+from embedding_scheduler import EmbeddingScheduler
+from context_packer import (
+    LLM_CONTEXT_WINDOW, CONTEXT_TOKEN_MARGIN, get_token_counter, context_blocks, context_token_budget, pack_context
+)
+from prompt_templates import get_template, select_intent
+from context_compressor import ContextCompressor
+from sse_frames import ChunkFrameEncoder, DisconnectGuard, ReleasingStreamingResponse, coalesce_deltas
+from state_store import create_state_store, SQLStateStore
+from admission import AdmissionController, SharedTokenBucketLimiter, TokenBucketLimiter, per_worker_limit
+from metrics import (
+    INGEST_STAGE_SECONDS, LLM_COMPLETION_TOKENS, LLM_TOKENS_SAVED, StatsCollector, current_trace, measure_llm_stream, observe_stage,
+    record_cache_lookup, record_chat_request, record_error, register_collector, render_latest, stage_timer
+)
+from request_profiler import RequestTrace, SlowQueryLog, finish_profile, start_profile
+from batch_jobs import BatchJob, load_job_status, split_query_results
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -45,6 +71,13 @@ SECRET_KEY = os.getenv("SECRET_KEY", "secret")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = 480  # Token 有效期 8 小時
 
+# 多 worker 部署：共享狀態 (Session 鎖、上傳進度) 的存放位置
+# memory = 單一行程 (預設)；sql = 存在資料庫，UVICORN_WORKERS > 1 時預設使用
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", "1"))
+STATE_STORE = os.getenv("STATE_STORE", "sql" if UVICORN_WORKERS > 1 else "memory")
+STATE_STORE_URL = os.getenv("STATE_STORE_URL", "")
+SESSION_LOCK_TTL = int(os.getenv("SESSION_LOCK_TTL", "300"))
+
 # 3. 建立資料庫引擎
 #SQLAlchemy 用來跟 MySQL 對話的核心物件
 engine = create_engine(DATABASE_URL)
@@ -75,13 +108,7 @@ class User(Base):
     role = Column(String(20), default="user")              # 角色: root 或 user
 
 # 8. 自動建立資料表
-# 程式啟動時，會去資料庫看有沒有 users 表，沒有就自動建立
-try:
-    Base.metadata.create_all(bind=engine)
-    print("資料庫連線成功，資料表 (users) 已確認。")
-except Exception as e:
-    print(f"資料庫連線失敗: {e}")
-    print("請確認 Docker 的 db 服務是否已啟動且健康 (Healthy)")
+# 改在背景啟動流程 (init_database) 中執行，HTTP 服務不必等資料庫連線
 
 # ==========================================
 # 驗證工具函式 (Helper Functions)
@@ -114,6 +141,7 @@ def get_db():
 # 只要 API 參數裡加上 current_user: User = Depends(get_current_user)
 # 這個函式就會自動檢查 Token 是否有效
 async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    ensure_ready("database")
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -135,15 +163,45 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     return user
 
 
-processing_status = {}
+# 共享狀態：Session 鎖 (有期限的租約)、上傳處理進度、知識庫版本
+state_store = create_state_store(
+    STATE_STORE,
+    engine=(create_engine(STATE_STORE_URL) if STATE_STORE_URL else engine) if STATE_STORE == "sql" else None
+)
+kb_generation_seen = None  # 本 worker 目前索引對應的知識庫版本
+
+def mark_knowledge_base_changed():
+    """知識庫內容已變動：舊回答可能過期，並通知其他 worker 重新載入索引"""
+    global kb_generation_seen
+    answer_cache.invalidate_all()
+    generation = state_store.incr_counter("kb_generation")
+    if kb_generation_seen is not None and generation != kb_generation_seen + 1:
+        # 上次同步後其他 worker 也改過知識庫 (計數器跳號)：只記下新版本號會漏掉對方的變更，這裡也要重新載入
+        print(f"[同步] 知識庫版本 {kb_generation_seen} -> {generation} (含其他 worker 的變更)，重新載入索引")
+        rag_builder.reload_indexes()
+    kb_generation_seen = generation
+
+def sync_knowledge_base():
+    """其他 worker 更新過知識庫時，重新載入本行程的關鍵字 / BM25 索引並清掉回答快取"""
+    global kb_generation_seen
+    generation = state_store.get_counter("kb_generation")
+    if kb_generation_seen is not None and generation != kb_generation_seen:
+        print(f"[同步] 知識庫版本 {kb_generation_seen} -> {generation}，重新載入索引")
+        rag_builder.reload_indexes()
+        answer_cache.invalidate_all()
+    kb_generation_seen = generation
+
 def process_file_background(file_location: str, filename: str):
     """背景處理檔案"""
     try:
-        processing_status[filename] = {"status": "processing", "message": "正在處理中..."}
-        pipeline.process_single_file(file_location, rag_builder)
-        processing_status[filename] = {"status": "completed", "message": "處理完成！"}
+        state_store.set_job(filename, "processing", "正在處理中...")
+        with stage_timer("total", INGEST_STAGE_SECONDS):
+            pipeline.process_single_file(file_location, rag_builder)
+        state_store.set_job(filename, "completed", "處理完成！")
     except Exception as e:
-        processing_status[filename] = {"status": "error", "message": str(e)}
+        state_store.set_job(filename, "error", str(e))
+    finally:
+        mark_knowledge_base_changed()
 
 # 確保資料夾存在
 if not os.path.exists(pipeline.DATA_DIR):
@@ -157,25 +215,709 @@ MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH", "jinaai/jina-embeddings-v3")
 LLM_MODEL = os.getenv("VLLM_MODEL", "ISTA-DASLab/gemma-3-27b-it-GPTQ-4b-128g")
 API_BASE = os.getenv("VLLM_API_BASE", "http://localhost:8000/v1")
 API_KEY = os.getenv("VLLM_API_KEY", "EMPTY")
-MAX_CONTEXT_CHARS = int(os.getenv("MAX_CONTEXT_CHARS", "20000"))
+# 選用的抽取式 Context 壓縮 (SIMILARITY <= 0 時只用關鍵字比對，不額外跑 embedding)
+CONTEXT_COMPRESSION_ENABLED = os.getenv("CONTEXT_COMPRESSION_ENABLED", "0") == "1"
+CONTEXT_COMPRESSION_MIN_CHARS = int(os.getenv("CONTEXT_COMPRESSION_MIN_CHARS", "300"))
+CONTEXT_COMPRESSION_SIMILARITY = float(os.getenv("CONTEXT_COMPRESSION_SIMILARITY", "0.55"))
+CONTEXT_COMPRESSION_NEIGHBORS = int(os.getenv("CONTEXT_COMPRESSION_NEIGHBORS", "0"))
+# 檢索用執行緒池大小 (Embedding / Chroma 這類同步呼叫會丟到這裡，避免卡住 event loop)
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "4"))
+# 問題向量 LRU 快取筆數 (0 = 關閉)
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "1024"))
+# Embedding 微批次排程 (查詢高優先、建庫節流，共用同一個模型)
+EMBED_SCHEDULER_ENABLED = os.getenv("EMBED_SCHEDULER_ENABLED", "1") == "1"
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+EMBED_INGEST_BATCH = int(os.getenv("EMBED_INGEST_BATCH", "16"))
+EMBED_INGEST_PAUSE_MS = float(os.getenv("EMBED_INGEST_PAUSE_MS", "0"))
+# 選用的 CPU Cross-Encoder 精排 (未設定模型路徑 = 關閉)
+CROSS_ENCODER_MODEL_PATH = os.getenv("CROSS_ENCODER_MODEL_PATH", "")
+CROSS_ENCODER_TOP_K = int(os.getenv("CROSS_ENCODER_TOP_K", "30"))
+CROSS_ENCODER_KEEP = int(os.getenv("CROSS_ENCODER_KEEP", "12"))
+CROSS_ENCODER_BUDGET_MS = int(os.getenv("CROSS_ENCODER_BUDGET_MS", "300"))
+CROSS_ENCODER_BATCH_SIZE = int(os.getenv("CROSS_ENCODER_BATCH_SIZE", "8"))
+CROSS_ENCODER_THREADS = int(os.getenv("CROSS_ENCODER_THREADS", "0"))
+# 語意回答快取 (相似問題 + 相同檢索結果 -> 直接重播舊回答)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "256"))
+ANSWER_CACHE_MAX_MB = int(os.getenv("ANSWER_CACHE_MAX_MB", "32"))
+ANSWER_CACHE_REPLAY_CHARS = 32  # 重播時每個 chunk 的字數
+# SSE 串流：LLM delta 累積到 N 字或等待超過 N 毫秒才送出一個 frame (CHARS=0 表示每個 delta 各送一次)
+SSE_COALESCE_CHARS = int(os.getenv("SSE_COALESCE_CHARS", "64"))
+SSE_COALESCE_MS = int(os.getenv("SSE_COALESCE_MS", "40"))
+# 每隔幾秒檢查一次 SSE 客戶端是否已斷線 (斷線即中止檢索與 vLLM 生成)
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+# 准入控制：整個服務的同時生成上限、排隊上限與排隊逾時 (秒)；MAX_CONCURRENT_CHATS=0 表示不限制
+# (多 worker 時平均分給各 worker，見 per_worker_limit)
+MAX_CONCURRENT_CHATS = int(os.getenv("MAX_CONCURRENT_CHATS", "8"))
+CHAT_QUEUE_SIZE = int(os.getenv("CHAT_QUEUE_SIZE", "32"))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "120"))
+CHAT_QUEUE_RETRY_AFTER = int(os.getenv("CHAT_QUEUE_RETRY_AFTER", "10"))
+# 每位使用者 (JWT sub，未帶 Token 則以 IP 計) 的頻率限制：每分鐘 N 次、可瞬間連發 BURST 次；0 表示不限制
+# (STATE_STORE=sql 時桶子存在資料庫，所有 worker 共用)
+CHAT_RATE_PER_MINUTE = float(os.getenv("CHAT_RATE_PER_MINUTE", "20"))
+CHAT_RATE_BURST = int(os.getenv("CHAT_RATE_BURST", "5"))
+# 請求剖析：依比例取樣 (或管理員帶 X-Profile: 1 標頭) 對檢索階段做堆疊取樣，輸出 collapsed stack 檔
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./logs/profiles")
+# 慢查詢日誌：總耗時超過 SLOW_QUERY_MS 毫秒的請求寫入 JSONL (0 = 關閉)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "8000"))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "./logs/slow_queries.jsonl")
+# 批次問答：每批題數上限、同時送進 vLLM 的生成數、同時檢索的題數 (避免擠滿檢索執行緒池)、結果 JSONL 目錄
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "500"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))
+BATCH_RETRIEVAL_CONCURRENCY = int(os.getenv("BATCH_RETRIEVAL_CONCURRENCY", "2"))
+BATCH_OUTPUT_DIR = os.getenv("BATCH_OUTPUT_DIR", "./batch_results")
+# 只有直接連線的來源是這些代理 (IP、CIDR 或主機名稱，逗號分隔) 時才採用 X-Forwarded-For；空白 = 一律不採用
+TRUSTED_PROXIES = [p.strip() for p in os.getenv("TRUSTED_PROXIES", "").split(",") if p.strip()]
+TRUSTED_PROXIES_REFRESH = 60  # 主機名稱重新解析的間隔 (秒)；代理容器重啟後 IP 可能改變
 # LLM_MODEL = "RedHatAI/gemma-3-12b-it-FP8-dynamic"
 
 
-# 1. 連接 LLM 
+# 1. 連接 LLM (只建立 client，不會真的連線)
 print(f"連接 vLLM: {LLM_MODEL}")
 # llm_client = OpenAI(base_url=API_BASE, api_key=API_KEY)
 llm_client = AsyncOpenAI(base_url=API_BASE, api_key=API_KEY)
 
-# 2. 初始化 RAG 建庫引擎 
-print("初始化 RAG 建庫引擎...")
-rag_builder = db_builder.VectorDBBuilder(db_path=DB_PATH, model_path=MODEL_PATH)
+# 語意回答快取 (知識庫異動時整批失效)
+answer_cache = SemanticAnswerCache(
+    similarity_threshold=ANSWER_CACHE_SIMILARITY,
+    ttl_seconds=ANSWER_CACHE_TTL,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    max_bytes=ANSWER_CACHE_MAX_MB * 1024 * 1024
+)
+
+# 聊天請求的准入控制與每位使用者的頻率限制
+# 准入控制是每個 worker 一份，全域上限平均分給各 worker；頻率限制在共享的 state_store 上跨 worker 計算
+chat_admission = AdmissionController(
+    max_concurrent=per_worker_limit(MAX_CONCURRENT_CHATS, UVICORN_WORKERS),
+    max_queue=per_worker_limit(CHAT_QUEUE_SIZE, UVICORN_WORKERS)
+)
+if state_store.name == "sql":
+    chat_rate_limiter = SharedTokenBucketLimiter(state_store, rate_per_minute=CHAT_RATE_PER_MINUTE, burst=CHAT_RATE_BURST)
+else:
+    chat_rate_limiter = TokenBucketLimiter(rate_per_minute=CHAT_RATE_PER_MINUTE, burst=CHAT_RATE_BURST)
+
+# 客戶端中途斷線而中止的請求 (依中止時所在階段分類)
+# tokens_saved 為「max_tokens - 已生成 token 數」的加總，是不必再生成的 token 上限
+chat_cancel_stats = {"cancelled": 0, "queue": 0, "retrieval": 0, "replay": 0, "generation": 0,
+                     "tokens_generated": 0, "tokens_saved": 0}
+
+def record_chat_cancellation(phase, partial_answer, max_tokens):
+    generated = token_counter.count(partial_answer) if token_counter and partial_answer else 0
+    saved = 0 if phase == "replay" else max(0, max_tokens - generated)
+    chat_cancel_stats["cancelled"] += 1
+    chat_cancel_stats[phase] += 1
+    chat_cancel_stats["tokens_generated"] += generated
+    chat_cancel_stats["tokens_saved"] += saved
+    LLM_TOKENS_SAVED.inc(saved)
+    record_chat_request("cancelled")
+    print(f"[斷線] 客戶端已離開 (階段: {phase})，已生成 {generated} tokens，中止後省下最多 {saved} tokens")
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_LOG, SLOW_QUERY_MS)
+
+def decode_bearer_token(http_request: Request):
+    """選用的身分辨識 (/stream-chat 不強制登入)：Authorization 帶有效 JWT 時回傳 payload，否則 None"""
+    auth = http_request.headers.get("authorization", "")
+    if not auth.lower().startswith("bearer "):
+        return None
+    try:
+        return jwt.decode(auth[7:], SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+
+def rate_limit_key(http_request: Request):
+    """頻率限制的對象：有效 JWT 的 sub，否則用來源 IP"""
+    payload = decode_bearer_token(http_request)
+    if payload and payload.get("sub"):
+        return f"user:{payload['sub']}"
+    peer = http_request.client.host if http_request.client else "unknown"
+    if http_request.headers.get("x-forwarded-for") and is_trusted_proxy(peer):
+        # 取最後一段：那是我們的代理 (Next.js rewrite) 附加的來源 IP；前面幾段是客戶端自己可以偽造的
+        return "ip:" + http_request.headers["x-forwarded-for"].split(",")[-1].strip()
+    return f"ip:{peer}"
+
+_trusted_proxy_cache = {"networks": [], "resolved_at": None}
+
+def trusted_proxy_networks():
+    """TRUSTED_PROXIES 解析成網段 (主機名稱以 DNS 解析，每 TRUSTED_PROXIES_REFRESH 秒重新解析一次)"""
+    now = time.monotonic()
+    resolved_at = _trusted_proxy_cache["resolved_at"]
+    if resolved_at is None or now - resolved_at > TRUSTED_PROXIES_REFRESH:
+        networks = []
+        for entry in TRUSTED_PROXIES:
+            try:
+                networks.append(ipaddress.ip_network(entry, strict=False))
+                continue
+            except ValueError:
+                pass
+            try:
+                for info in socket.getaddrinfo(entry, None):
+                    networks.append(ipaddress.ip_network(info[4][0]))
+            except OSError as e:
+                print(f"[頻率限制] 無法解析 TRUSTED_PROXIES 中的 {entry}: {e}")
+        _trusted_proxy_cache.update(networks=networks, resolved_at=now)
+    return _trusted_proxy_cache["networks"]
+
+def is_trusted_proxy(host):
+    if not TRUSTED_PROXIES:
+        return False
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in trusted_proxy_networks())
+
+def should_profile(http_request: Request):
+    """依 PROFILE_SAMPLE_RATE 抽樣；管理員 (JWT role=root) 帶 X-Profile: 1 時一定剖析"""
+    if http_request.headers.get("x-profile") == "1":
+        payload = decode_bearer_token(http_request)
+        if payload and payload.get("role") == "root":
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+# /metrics 在 scrape 時讀取既有的執行期統計 (快取命中、Embedding 排程器、准入控制)
+register_collector(StatsCollector({
+    "query_embedding_cache": (lambda: query_embed_cache.stats() if query_embed_cache else None, "group"),
+    "answer_cache": (answer_cache.stats, "group"),
+    "embedding_scheduler": (lambda: embed_scheduler.stats() if embed_scheduler else None, "lane"),
+    "chat_admission": (chat_admission.stats, "group"),
+    "chat_rate_limit": (chat_rate_limiter.stats, "group"),
+}))
+
+# 2. 以下物件在背景啟動流程 (load_models) 中建立，就緒前為 None
+rag_builder = None
+chroma_client = None
+collection = None
+embed_model = None
+embed_scheduler = None
+query_embed_cache = None
+cross_encoder = None
+token_counter = None
+context_compressor = None
+
+# ==========================================
+# 分階段啟動 (Staged Startup)
+# ==========================================
+# uvicorn 先綁定 port 開始接受連線，資料庫、Embedding 模型、索引在背景執行緒載入。
+#   - /health：liveness，只要行程活著就回 200
+#   - /ready ：readiness，必要元件全部 ready 才回 200，否則 503 並附上各元件狀態
+# 元件狀態：pending -> loading -> ready / error (選用元件未設定時為 disabled，相依的前一階段失敗時為 skipped)
+# 載入失敗的階段以指數退避重試 STARTUP_STAGE_RETRIES 次；必要元件仍失敗時 (STARTUP_EXIT_ON_FAILURE=1)
+# 直接結束行程，交給 Docker (restart: unless-stopped) 重新啟動，而不是永遠停在 not ready。
+REQUIRED_COMPONENTS = ("database", "vectordb", "embedding", "indexes", "tokenizer")
+component_status = {
+    name: {"status": "pending", "message": "", "elapsed_ms": None}
+    for name in ("database", "vectordb", "embedding", "indexes", "tokenizer", "cross_encoder", "llm")
+}
+STARTED_AT = time.time()
+STARTUP_RETRIES = int(os.getenv("STARTUP_RETRIES", "20"))
+STARTUP_RETRY_INTERVAL = float(os.getenv("STARTUP_RETRY_INTERVAL", "3"))
+STARTUP_STAGE_RETRIES = int(os.getenv("STARTUP_STAGE_RETRIES", "3"))
+STARTUP_EXIT_ON_FAILURE = os.getenv("STARTUP_EXIT_ON_FAILURE", "1") == "1"
+
+def _set_component(name, status_value, message=""):
+    component_status[name]["status"] = status_value
+    component_status[name]["message"] = message
+
+def _run_stage(name, func, retries=1):
+    """
+    執行一個啟動階段並記錄狀態與耗時；失敗時以指數退避重試 (最多 retries 次)。
+    必要元件最後仍失敗且 STARTUP_EXIT_ON_FAILURE=1 時結束行程，讓容器被重新啟動。
+    """
+    _set_component(name, "loading")
+    t0 = time.perf_counter()
+    try:
+        for attempt in range(1, max(1, retries) + 1):
+            try:
+                message = func() or ""
+                _set_component(name, "ready", message)
+                return True
+            except Exception as e:
+                print(f"[啟動] {name} 載入失敗 ({attempt}/{retries}): {e}")
+                _set_component(name, "error", str(e))
+                if attempt < retries:
+                    time.sleep(min(60.0, STARTUP_RETRY_INTERVAL * 2 ** (attempt - 1)))
+    finally:
+        component_status[name]["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    if name in REQUIRED_COMPONENTS and STARTUP_EXIT_ON_FAILURE:
+        print(f"[啟動] 必要元件 {name} 無法載入，結束行程以便重新啟動")
+        os._exit(1)
+    return False
+
+def is_ready(*names):
+    return all(component_status[n]["status"] == "ready" for n in (names or REQUIRED_COMPONENTS))
+
+def ensure_ready(*names):
+    """API 進入點呼叫：元件尚未就緒時回 503 (附 Retry-After)"""
+    if not is_ready(*names):
+        pending = [n for n in (names or REQUIRED_COMPONENTS) if component_status[n]["status"] != "ready"]
+        raise HTTPException(
+            status_code=503,
+            detail=f"服務啟動中，尚未就緒: {', '.join(pending)}",
+            headers={"Retry-After": "5"}
+        )
+
+def init_database():
+    """建立資料表與預設帳號 (資料庫容器可能比後端晚就緒，失敗會重試)"""
+    for attempt in range(1, STARTUP_RETRIES + 1):
+        try:
+            Base.metadata.create_all(bind=engine)
+            if isinstance(state_store, SQLStateStore):
+                state_store.create_tables()
+            print("資料庫連線成功，資料表 (users) 已確認。")
+            break
+        except Exception as e:
+            print(f"資料庫連線失敗 ({attempt}/{STARTUP_RETRIES}): {e}")
+            if attempt == STARTUP_RETRIES:
+                print("請確認 Docker 的 db 服務是否已啟動且健康 (Healthy)")
+                raise
+            time.sleep(STARTUP_RETRY_INTERVAL)
+    init_default_users()
+
+def load_vectordb():
+    """初始化 RAG 建庫引擎 (載入 Embedding 模型、開啟 Chroma、載入 n-gram 索引)"""
+    global rag_builder, chroma_client, collection, embed_model, kb_generation_seen
+    print("初始化 RAG 建庫引擎...")
+    # 先記下版本號再載入索引：載入期間其他 worker 的變更，第一次同步時就會發現
+    try:
+        generation = state_store.get_counter("kb_generation")
+    except Exception as e:
+        print(f"[同步] 無法讀取知識庫版本: {e}")
+        generation = None
+    rag_builder = db_builder.VectorDBBuilder(db_path=DB_PATH, model_path=MODEL_PATH)
+    kb_generation_seen = generation
+    # 從 Builder 取得共用物件
+    chroma_client = rag_builder.client
+    collection = rag_builder.collection
+    embed_model = rag_builder.ef.model
+    return f"{collection.count()} 筆 chunk"
+
+def init_embedding():
+    """建立 Embedding 排程器與問題向量快取，並用一次 encode 暖機"""
+    global embed_scheduler, query_embed_cache, context_compressor
+    # Embedding 排程器：同時到達的查詢合併成一批；建庫時的 collection.add 走 ingest 車道
+    query_encode_fn = embed_model.encode
+    if EMBED_SCHEDULER_ENABLED:
+        embed_scheduler = EmbeddingScheduler(
+            embed_model.encode,
+            batch_window_ms=EMBED_BATCH_WINDOW_MS,
+            max_batch_size=EMBED_MAX_BATCH,
+            ingest_batch_size=EMBED_INGEST_BATCH,
+            ingest_pause_ms=EMBED_INGEST_PAUSE_MS
+        )
+        rag_builder.ef.scheduler = embed_scheduler
+        query_encode_fn = functools.partial(embed_scheduler.encode, lane="query")
+
+    # 暖機 (不經過快取，避免統計失真)
+    warm_vec = query_encode_fn(["暖機查詢"])[0]
+
+    # 問題向量快取 (Key 含模型 ID，換 EMBEDDING_MODEL_PATH 不會拿到舊向量)
+    query_embed_cache = QueryEmbeddingCache(query_encode_fn, model_id=MODEL_PATH, max_size=QUERY_EMBED_CACHE_SIZE)
+
+    if CONTEXT_COMPRESSION_ENABLED:
+        context_compressor = ContextCompressor(
+            encode_fn=query_encode_fn,
+            similarity_threshold=CONTEXT_COMPRESSION_SIMILARITY,
+            min_chars=CONTEXT_COMPRESSION_MIN_CHARS,
+            neighbors=CONTEXT_COMPRESSION_NEIGHBORS
+        )
+    return f"dim={len(warm_vec)}"
+
+def warm_up_indexes():
+    """向量查詢、BM25 索引建立與關鍵字索引各跑一次，第一位使用者不必付冷啟動成本"""
+    if collection.count() > 0:
+        vector_search("暖機查詢", n_results=1)
+    bm25_search("暖機查詢", top_k=1)
+    keyword_search(["暖機"], limit_per_keyword=1)
+
+def load_tokenizer():
+    """LLM tokenizer (Context 打包計算 token 數用；載入失敗時退回估計值)"""
+    global token_counter
+    token_counter = get_token_counter()
+    return token_counter.name
+
+def load_cross_encoder():
+    global cross_encoder
+    cross_encoder = CrossEncoderReranker(
+        CROSS_ENCODER_MODEL_PATH,
+        batch_size=CROSS_ENCODER_BATCH_SIZE,
+        num_threads=CROSS_ENCODER_THREADS or None
+    )
+
+def check_llm():
+    """確認 vLLM 可連線 (選用元件：連不上只影響回答，不影響 readiness)"""
+    import httpx
+    headers = {"Authorization": f"Bearer {API_KEY}"}
+    for attempt in range(1, STARTUP_RETRIES + 1):
+        try:
+            resp = httpx.get(f"{API_BASE.rstrip('/')}/models", headers=headers, timeout=5)
+            resp.raise_for_status()
+            return LLM_MODEL
+        except Exception:
+            if attempt == STARTUP_RETRIES:
+                raise
+            time.sleep(STARTUP_RETRY_INTERVAL)
+
+def load_models():
+    """背景啟動流程：模型與索引依序載入，相依的前一階段失敗則標記 skipped (tokenizer / Cross-Encoder 不相依，照常載入)"""
+    if _run_stage("vectordb", load_vectordb, retries=STARTUP_STAGE_RETRIES):
+        if _run_stage("embedding", init_embedding, retries=STARTUP_STAGE_RETRIES):
+            _run_stage("indexes", warm_up_indexes, retries=STARTUP_STAGE_RETRIES)
+        else:
+            _set_component("indexes", "skipped", "embedding 載入失敗")
+    else:
+        for name in ("embedding", "indexes"):
+            _set_component(name, "skipped", "vectordb 載入失敗")
+
+    _run_stage("tokenizer", load_tokenizer, retries=STARTUP_STAGE_RETRIES)
+
+    # 選用的 Cross-Encoder 精排
+    if CROSS_ENCODER_MODEL_PATH:
+        _run_stage("cross_encoder", load_cross_encoder, retries=STARTUP_STAGE_RETRIES)
+    else:
+        _set_component("cross_encoder", "disabled")
+
+    print(f"模型與資料庫載入完成！({time.time() - STARTED_AT:.1f}s)")
+
+# 4. 檢索專用的有界執行緒池
+retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
+async def run_blocking(func, *args, **kwargs):
+    """把同步 (CPU/GPU/IO) 呼叫丟到檢索執行緒池，讓其他 SSE 串流可以繼續送 token"""
+    loop = asyncio.get_running_loop()
+    # 帶上目前的 context (請求 trace)，執行緒內的 stage_timer 才記得到這筆請求
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(retrieval_executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+def vector_search(query, n_results=150):
+    """Step 1: 向量搜尋 (同步版，請透過 run_blocking 呼叫)"""
+    with stage_timer("embedding"):
+        query_vec = [query_embed_cache.encode(query)]
+    with stage_timer("vector_search"):
+        return collection.query(
+            query_embeddings=query_vec,
+            n_results=n_results,
+            include=['documents', 'metadatas', 'distances']
+        )
+
+def batch_vector_search(queries, n_results=150):
+    """
+    批次問答的 Step 1：所有問題一次 encode、一次多查詢 collection.query (請透過 run_blocking 呼叫)。
+    回傳 (每題的向量, 每題的查詢結果 (單一查詢格式))
+    """
+    with stage_timer("embedding"):
+        # 走排程器的 batch 車道：所有問題一次 encode (不拆批、不排在建庫後面)，線上查詢仍可先插隊
+        if embed_scheduler is not None:
+            query_vecs = embed_scheduler.encode(queries, lane="batch")
+        else:
+            query_vecs = embed_model.encode(queries)
+        query_vecs = [v.tolist() if hasattr(v, "tolist") else list(v) for v in query_vecs]
+    with stage_timer("vector_search"):
+        results = collection.query(
+            query_embeddings=query_vecs,
+            n_results=n_results,
+            include=['documents', 'metadatas', 'distances']
+        )
+    return query_vecs, split_query_results(results)
+
+def keyword_search(keywords, limit_per_keyword=50):
+    """Step 2: 關鍵字強制搜尋 (n-gram 倒排索引，一次查多個關鍵字；請透過 run_blocking 呼叫)"""
+    with stage_timer("keyword_search"):
+        return rag_builder.keyword_search(keywords, limit_per_keyword=limit_per_keyword)
+
+def bm25_search(query, top_k=50):
+    """Step 1b: BM25 稀疏檢索 (請透過 run_blocking 呼叫)"""
+    with stage_timer("bm25"):
+        return rag_builder.bm25_search(query, top_k=top_k)
+
+def rerank_and_merge(query, combined_docs, combined_metas, combined_dists, core_keywords, combined_ids=None, explain=False,
+                     combined_rrf=None):
+    """Step 3 + Step 4: 重排序與表格合併 (純 CPU 運算)；combined_rrf 讓只由 BM25 找到的候選也有檢索分數"""
+    with stage_timer("rerank"):
+        reranked_results = my_rag.advanced_reranker(
+            query, combined_docs, combined_metas, combined_dists, 
+            top_n=60,
+            decay_rate=0.98,
+            keywords=core_keywords,
+            ids=combined_ids,
+            explain=explain,
+            rrf_scores=combined_rrf
+        )
+    with stage_timer("merge"):
+        return my_rag.group_and_merge_results(reranked_results)
+
+async def retrieve_candidates(query, keywords=None, vector_results=None):
+    """
+    Step 0 ~ Step 2 以相依圖 (DAG) 方式執行：
+      - Step 0 (LLM 關鍵字)、Step 1 (向量搜尋)、Step 1b (BM25) 同時開始，彼此互不相依
+      - Step 2 (關鍵字搜尋) 在關鍵字一回來就開始，不必等向量搜尋
+      - 全部完成後合併候選：向量與 BM25 先以 RRF 融合取前 FUSED_TOP_K，
+        再補上關鍵字強制搜尋的結果
+    keywords 有值時直接使用 (不呼叫 LLM 提取關鍵字)；vector_results 有值時 (批次問答已一次查好) 不再做向量搜尋。
+    回傳 (core_keywords, candidates_map)
+    """
+    async def vector_branch():
+        if vector_results is not None:
+            return vector_results
+        return await run_blocking(vector_search, query, n_results=VECTOR_N_RESULTS)
+
+    vector_task = asyncio.create_task(vector_branch())
+
+    async def bm25_branch():
+        try:
+            return await run_blocking(bm25_search, query, top_k=BM25_TOP_K)
+        except Exception as e:
+            print(f"BM25 搜尋失敗: {e}")
+            return None
+
+    async def keyword_branch():
+        if keywords is not None:
+            core_keywords = list(keywords)
+        else:
+            with stage_timer("keyword_extraction"):
+                core_keywords = await my_rag.get_keywords_via_llm_async(query)
+        expanded_keywords = my_rag.expand_keywords_by_intent(query, core_keywords)
+        expanded_keywords = expanded_keywords[:8]
+        kw_results = None
+        if expanded_keywords:
+            try:
+                kw_results = await run_blocking(keyword_search, expanded_keywords, limit_per_keyword=50)
+            except Exception as e:
+                print(f"關鍵字搜尋失敗: {e}")
+        return core_keywords, kw_results
+
+    bm25_task = asyncio.create_task(bm25_branch())
+    keyword_task = asyncio.create_task(keyword_branch())
+    tasks = (vector_task, bm25_task, keyword_task)
+    try:
+        vector_results, bm25_results, (core_keywords, kw_results) = await asyncio.gather(*tasks)
+    finally:
+        # 任一分支失敗 (或請求被取消) 時，把其他分支也收掉
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    # 向量 + BM25 以 RRF 融合 (前 FUSED_TOP_K 筆)，再補上關鍵字結果
+    candidates_map = fuse_candidates(vector_results, bm25_results, kw_results)
+    vector_ids = vector_results['ids'][0] if vector_results['documents'] else []
+    bm25_ids = bm25_results['ids'] if bm25_results and bm25_results['ids'] else []
+
+    trace = current_trace.get()
+    if trace is not None:
+        trace.counts.update(
+            vector=len(vector_ids), bm25=len(bm25_ids),
+            keyword=len(kw_results['ids']) if kw_results and kw_results['ids'] else 0,
+            candidates=len(candidates_map)
+        )
+    return core_keywords, candidates_map
+
+async def retrieve_and_rank(query, keywords=None, explain=False, vector_results=None):
+    """
+    Step 0 ~ Step 5.5 (/stream-chat 與 /search 共用)：檢索 -> 重排序 -> 表格合併 -> 年份過濾 -> Cross-Encoder。
+    回傳 (core_keywords, candidates_map, reranked_results)
+    """
+    # === Step 0 ~ 2: 關鍵字提取 / 向量搜尋 / 關鍵字搜尋 (依相依關係並行) ===
+    with stage_timer("retrieval"):
+        core_keywords, candidates_map = await retrieve_candidates(query, keywords=keywords, vector_results=vector_results)
+
+    combined_docs = [v["doc"] for v in candidates_map.values()]
+    combined_metas = [v["meta"] for v in candidates_map.values()]
+    combined_dists = [v["distance"] for v in candidates_map.values()]
+    combined_ids = list(candidates_map.keys())
+    combined_rrf = [v.get("rrf_score") for v in candidates_map.values()]
+    
+    # === Step 3 + 4: 重排序 (Rerank) 與拼圖重組 (Merge) ===
+    reranked_results = await run_blocking(
+        rerank_and_merge, query, combined_docs, combined_metas, combined_dists, core_keywords, combined_ids, explain,
+        combined_rrf
+    )
+    
+    # === Step 5: Scope Guard (年份過濾) ===
+    year_match = re.search(r"\b(1[0-9]{2})\b", query)
+    if year_match and "報告" in query and ("中" in query or "依據" in query or "根據" in query):
+        y = year_match.group(1)
+        reranked_results = [
+            r for r in reranked_results
+            if y in ((r.get("meta", {}) or {}).get("source_doc", ""))
+        ]
+
+    # === Step 5.5: Cross-Encoder 精排 (選用，有 latency budget) ===
+    if cross_encoder and reranked_results:
+        with stage_timer("cross_encoder"):
+            reranked_results, ce_info = await run_blocking(
+                cross_encoder.rerank, query, reranked_results,
+                top_k=CROSS_ENCODER_TOP_K,
+                keep=CROSS_ENCODER_KEEP,
+                budget_ms=CROSS_ENCODER_BUDGET_MS
+            )
+        print(f"[Cross-Encoder] 打分 {ce_info['scored']}/{ce_info['candidates']} 筆，"
+              f"保留 {ce_info['kept']} 筆，耗時 {ce_info['elapsed_ms']}ms"
+              + (" (超出預算提早停止)" if ce_info['stopped_early'] else ""))
+
+    return core_keywords, candidates_map, reranked_results
+
+async def build_prompt_context(query, core_keywords, reranked_results, max_tokens):
+    """
+    Step 5.7 ~ Step 6 (/stream-chat 與批次問答共用)：Context 壓縮 -> 選擇 prompt 樣板 -> 依 token 預算打包 Context。
+    回傳 dict：results (壓縮後的結果)、compression_info、prompt_template、knowledge_context (前端顯示用)、
+    context_str、selected、used_tokens、context_budget、block_count
+    """
+    # === Step 5.7: 抽取式 Context 壓縮 (選用，只保留命中關鍵字 / 語意相近的句子與表格列) ===
+    compression_info = None
+    if context_compressor and reranked_results:
+        with stage_timer("compression"):
+            reranked_results, compression_info = await run_blocking(
+                context_compressor.compress, query, core_keywords, reranked_results
+            )
+        print(f"[Context 壓縮] {compression_info['compressed_chunks']}/{compression_info['chunks']} 段，"
+              f"{compression_info['chars_before']} -> {compression_info['chars_after']} 字 "
+              f"(壓縮比 {compression_info['ratio']:.2f})，耗時 {compression_info['elapsed_ms']}ms")
+
+    # 依意圖選擇 prompt 樣板 (Context 預算要扣掉樣板本身的 token 數)
+    prompt_template = get_template(select_intent(my_rag.detect_query_intents(query)))
+
+    # === Step 6: 構建 Context & 準備回傳前端所需的「搜尋結果」格式 ===
+    # 以 token 為單位的背包打包：預算 = context window - max_tokens - prompt 其餘部分
+    packing_started = time.perf_counter()
+    knowledge_context = [] # 收集給前端顯示用
+    for res in reranked_results:
+        meta = res['meta']
+        doc_name = meta.get('source_doc', '未知')
+        title = meta.get('title', doc_name)
+        knowledge_context.append({
+            "title": title[:30],
+            "content": res.get('original_doc', res['doc'])[:100] + "...",
+            "source": doc_name
+        })
+    blocks, block_scores, block_tokens = context_blocks(reranked_results, token_counter)
+
+    context_budget = context_token_budget(
+        LLM_CONTEXT_WINDOW,
+        max_tokens or 0,
+        prompt_template.static_token_count(token_counter) + token_counter.count(query),
+        margin=CONTEXT_TOKEN_MARGIN
+    )
+    selected, used_tokens = pack_context(block_scores, block_tokens, context_budget)
+    context_str = "".join(blocks[i] for i in selected)
+    observe_stage("context_packing", time.perf_counter() - packing_started)
+
+    return {
+        "results": reranked_results,
+        "compression_info": compression_info,
+        "prompt_template": prompt_template,
+        "knowledge_context": knowledge_context,
+        "context_str": context_str,
+        "selected": selected,
+        "used_tokens": used_tokens,
+        "context_budget": context_budget,
+        "block_count": len(blocks),
+    }
+
+async def answer_batch_question(index, question, query_vec, vector_results, request, retrieval_sem, llm_sem):
+    """批次問答的單一題：檢索 + Context 打包 (受 retrieval_sem 限制) -> 非串流生成 (受 llm_sem 限制)"""
+    started = time.perf_counter()
+    trace = RequestTrace(session_id=f"batch-{index}", query=question)
+    current_trace.set(trace)
+    result = {"index": index, "question": question}
+    try:
+        async with retrieval_sem:
+            core_keywords, _, reranked_results = await retrieve_and_rank(
+                question, keywords=request.keywords, vector_results=vector_results
+            )
+            prompt_ctx = await build_prompt_context(question, core_keywords, reranked_results, request.max_tokens)
+        reranked_results = prompt_ctx["results"]
+        prompt_template = prompt_ctx["prompt_template"]
+        result["keywords"] = core_keywords
+        result["sources"] = [
+            {
+                "source_doc": reranked_results[i]['meta'].get('source_doc', '未知'),
+                "score": reranked_results[i]['score'],
+            }
+            for i in prompt_ctx["selected"]
+        ]
+        messages = prompt_template.build_messages(prompt_ctx["context_str"] or "沒有找到相關資料。", question)
+
+        # 與 /stream-chat 共用語意回答快取 (只對 temperature=0)；批次已經有問題向量，不必再 encode
+        use_answer_cache = ANSWER_CACHE_ENABLED and not request.temperature
+        if use_answer_cache:
+            cache_generation = answer_cache.generation
+            cache_variant = (prompt_template.key, request.max_tokens)
+            cache_chunk_ids = my_rag.collect_chunk_ids(reranked_results)
+            cached = answer_cache.lookup(query_vec, cache_chunk_ids, cache_variant)
+            record_cache_lookup("answer", cached is not None)
+            if cached:
+                result.update(answer=cached[0], cached=True)
+                return result
+
+        async with llm_sem:
+            with stage_timer("generation"):
+                response = await llm_client.chat.completions.create(
+                    model=LLM_MODEL,
+                    messages=messages,
+                    temperature=request.temperature,
+                    max_tokens=request.max_tokens,
+                )
+        answer = response.choices[0].message.content or ""
+        usage = getattr(response, "usage", None)
+        if usage is not None and usage.completion_tokens:
+            LLM_COMPLETION_TOKENS.inc(usage.completion_tokens)
+            result["completion_tokens"] = usage.completion_tokens
+        if use_answer_cache and answer:
+            answer_cache.put(question, query_vec, cache_chunk_ids, cache_variant, answer, cache_generation)
+        result["answer"] = answer
+    except Exception as e:
+        print(f"[批次] 第 {index} 題失敗: {e}")
+        record_error("batch")
+        result["error"] = str(e)
+    finally:
+        result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        result["stages_ms"] = trace.stages
+    return result
 
-# 3. 從 Builder 取得共用物件 
-chroma_client = rag_builder.client
-collection = rag_builder.collection
-embed_model = rag_builder.ef.model 
+async def run_batch_job(job, request):
+    """
+    批次問答背景工作：一次 encode + 一次多查詢向量搜尋 -> 各題檢索 / 生成以有界併發進行，
+    每完成一題就寫入 JSONL 並更新進度。
+    """
+    job.start()
+    await run_blocking(job.save, state_store)
+    questions = request.questions
+    print(f"[批次] 工作 {job.job_id} 開始，共 {len(questions)} 題")
+    try:
+        await run_blocking(sync_knowledge_base)
+        query_vecs, per_query_results = await run_blocking(batch_vector_search, questions, n_results=VECTOR_N_RESULTS)
+
+        retrieval_sem = asyncio.Semaphore(max(1, BATCH_RETRIEVAL_CONCURRENCY))
+        llm_sem = asyncio.Semaphore(max(1, BATCH_LLM_CONCURRENCY))
+        tasks = [
+            asyncio.create_task(answer_batch_question(i, q, query_vecs[i], per_query_results[i], request, retrieval_sem, llm_sem))
+            for i, q in enumerate(questions)
+        ]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                await run_blocking(job.record, result)
+                await run_blocking(job.save, state_store)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        job.finish()
+    except Exception as e:
+        print(f"[批次] 工作 {job.job_id} 失敗: {e}")
+        record_error("batch")
+        job.finish(error=str(e))
+    await run_blocking(job.save, state_store)
+    progress = job.progress()
+    print(f"[批次] 工作 {job.job_id} 結束：{progress['done']}/{progress['total']} 題 "
+          f"(失敗 {progress['failed']})，{progress['elapsed_s']}s，{progress['questions_per_min']} 題/分")
 
-print("模型與資料庫載入完成！")
+# 執行中的批次工作 (保留參考，避免背景 task 被 GC)
+batch_tasks = {}
 
 # --- FastAPI App 設定 ---
 app = FastAPI()
@@ -193,10 +935,29 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = 0.0 
     max_tokens: Optional[int] = 4096   
 
+class SearchRequest(BaseModel):
+    query: str
+    top_k: Optional[int] = 10
+    keywords: Optional[List[str]] = None  # 有值時直接使用，不呼叫 LLM 提取關鍵字 (完全不占用 vLLM)
+    explain: Optional[bool] = False
+
+class BatchChatRequest(BaseModel):
+    questions: List[str]
+    temperature: Optional[float] = 0.0
+    max_tokens: Optional[int] = 4096
+    keywords: Optional[List[str]] = None  # 有值時所有題目共用，不呼叫 LLM 提取關鍵字
+
 # ==========================================
 # 檔案管理 API
 # ==========================================
 @app.on_event("startup")
+def start_background_loading():
+    """只啟動背景執行緒就返回，uvicorn 可以立刻開始接受連線"""
+    import threading
+    threading.Thread(target=_run_stage, args=("database", init_database), name="startup-db", daemon=True).start()
+    threading.Thread(target=load_models, name="startup-models", daemon=True).start()
+    threading.Thread(target=_run_stage, args=("llm", check_llm), name="startup-llm", daemon=True).start()
+
 def init_default_users():
     print("檢查預設使用者帳號...")
     db = SessionLocal()
@@ -235,6 +996,7 @@ def init_default_users():
 
 @app.post("/token")
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    ensure_ready("database")
     # 1. 找使用者
     user = db.query(User).filter(User.username == form_data.username).first()
     
@@ -255,7 +1017,43 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "rag-backend"}
+    """Liveness：行程活著就回 200 (模型是否載入完成請看 /ready)"""
+    return {
+        "status": "healthy",
+        "service": "rag-backend",
+        "ready": is_ready(),
+        "uptime_s": round(time.time() - STARTED_AT, 1),
+    }
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness：必要元件 (資料庫、向量庫、Embedding、索引、tokenizer) 全部 ready 才回 200"""
+    ready = is_ready()
+    body = {"ready": ready, "components": component_status}
+    if not ready:
+        return JSONResponse(status_code=503, content=body, headers={"Retry-After": "5"})
+    return body
+
+@app.get("/stats")
+def get_stats(current_user: User = Depends(get_current_user)):
+    """查詢快取等執行期統計"""
+    return {
+        "startup": component_status,
+        "query_embedding_cache": query_embed_cache.stats() if query_embed_cache else None,
+        "answer_cache": answer_cache.stats(),
+        "embedding_scheduler": embed_scheduler.stats() if embed_scheduler else None,
+        "chat_admission": chat_admission.stats(),
+        "chat_rate_limit": chat_rate_limiter.stats(),
+        "chat_cancellations": chat_cancel_stats,
+    }
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus 指標 (各階段耗時、LLM 首字延遲 / 生成速度、建庫耗時、錯誤與快取)"""
+    body, content_type = render_latest()
+    if body is None:
+        return JSONResponse(status_code=503, content={"detail": "未安裝 prometheus_client"})
+    return Response(content=body, media_type=content_type)
 
 @app.get("/files")
 def list_files(current_user: User = Depends(get_current_user)):
@@ -273,6 +1071,7 @@ def list_files(current_user: User = Depends(get_current_user)):
 @app.delete("/files")
 def delete_file(filename: str = Query(..., description="要刪除的檔案名稱"), current_user: User = Depends(get_current_user)):
     """刪除檔案並從向量資料庫移除"""
+    ensure_ready()
     if current_user.role != "root":
         print(f"[權限不足] 使用者 {current_user.username} 嘗試刪除檔案")
         raise HTTPException(status_code=403, detail="權限不足：只有管理員可以刪除檔案")
@@ -309,7 +1108,8 @@ def delete_file(filename: str = Query(..., description="要刪除的檔案名稱
                 )
             
             if results['ids']:
-                collection.delete(ids=results['ids'])
+                rag_builder.delete_documents(results['ids'])
+                mark_knowledge_base_changed()
                 print(f"[刪除] 已從向量資料庫刪除 {len(results['ids'])} 筆資料")
             else:
                 print(f"[刪除] 向量資料庫中未找到相關資料")
@@ -318,8 +1118,7 @@ def delete_file(filename: str = Query(..., description="要刪除的檔案名稱
             print(f"[刪除] 向量資料庫刪除警告: {db_err}")
         
         # 3. 清除處理狀態記錄
-        if decoded_filename in processing_status:
-            del processing_status[decoded_filename]
+        state_store.delete_job(decoded_filename)
         
         return {"message": f"檔案 {decoded_filename} 已刪除", "filename": decoded_filename}
     
@@ -332,6 +1131,7 @@ def delete_file(filename: str = Query(..., description="要刪除的檔案名稱
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...), background_tasks: BackgroundTasks = BackgroundTasks(), current_user: User = Depends(get_current_user)):
     """上傳檔案並自動觸發 RAG 建庫流程"""
+    ensure_ready()
     try:
         file_location = os.path.join(pipeline.DATA_DIR, file.filename)
         
@@ -341,7 +1141,7 @@ async def upload_file(file: UploadFile = File(...), background_tasks: Background
         print(f"[上傳] 檔案已儲存: {file_location}")
         
         # 2. 設定初始狀態
-        processing_status[file.filename] = {"status": "processing", "message": "檔案已接收，開始處理..."}
+        state_store.set_job(file.filename, "processing", "檔案已接收，開始處理...")
         print(f"[上傳] 設定狀態: {file.filename} -> processing")
         
         # 3. 背景執行 RAG 建庫
@@ -368,10 +1168,11 @@ def get_upload_status(filename: str = Query(..., description="檔案名稱")):
     decoded_filename = unquote(filename)
     print(f"[查詢狀態] 原始: {filename}")
     print(f"[查詢狀態] 解碼後: {decoded_filename}")
-    print(f"[查詢狀態] 目前狀態字典: {list(processing_status.keys())}")
+    print(f"[查詢狀態] 目前狀態字典: {state_store.list_jobs()}")
     
-    if decoded_filename in processing_status:
-        return processing_status[decoded_filename]
+    job = state_store.get_job(decoded_filename)
+    if job:
+        return job
     
     # 如果找不到狀態，檢查檔案是否已存在
     file_path = os.path.join(pipeline.DATA_DIR, decoded_filename)
@@ -381,26 +1182,179 @@ def get_upload_status(filename: str = Query(..., description="檔案名稱")):
     return {"status": "unknown", "message": "找不到此檔案的處理記錄"}
 
 
-active_sessions = set()
+@app.post("/search")
+async def search(request: SearchRequest, current_user: User = Depends(get_current_user)):
+    """
+    只做檢索、不生成回答 (給內部工具與評測用)：回傳排序後的 chunk 與 metadata。
+    explain=true 時附上每筆的分數組成 (向量相似度、關鍵字分數、文件名加減分、多樣性懲罰、RRF、Cross-Encoder)
+    以及各階段耗時。
+    """
+    ensure_ready()
+    trace = RequestTrace(query=request.query)
+    current_trace.set(trace)
+    top_k = max(1, min(request.top_k or 10, 100))
 
+    try:
+        core_keywords, candidates_map, reranked_results = await retrieve_and_rank(
+            request.query, keywords=request.keywords, explain=request.explain
+        )
+    except Exception as e:
+        print(f"檢索失敗: {e}")
+        record_error("search")
+        raise HTTPException(status_code=500, detail=f"檢索失敗: {e}")
+
+    results = []
+    for rank, res in enumerate(reranked_results[:top_k], 1):
+        meta = res['meta']
+        item = {
+            "rank": rank,
+            "id": res.get('id'),
+            "ids": res.get('ids'),
+            "score": res['score'],
+            "source_doc": meta.get('source_doc', '未知'),
+            "type": meta.get('type', meta.get('label', '未知')),
+            "content": res['doc'],
+            "metadata": meta,
+        }
+        if request.explain:
+            member_ids = [i for i in (res.get('ids') or [res.get('id')]) if i in candidates_map]
+            item["retrieval_sources"] = sorted({candidates_map[i]["source"] for i in member_ids})
+            rrf_scores = [candidates_map[i]["rrf_score"] for i in member_ids if candidates_map[i].get("rrf_score") is not None]
+            item["score_components"] = dict(
+                res.get('score_components', {}),
+                rrf_score=max(rrf_scores) if rrf_scores else None,
+                cross_encoder_score=res.get('ce_score'),
+            )
+            if 'merged_components' in res:
+                item["merged_components"] = res['merged_components']
+        results.append(item)
+
+    body = {
+        "query": request.query,
+        "keywords": core_keywords,
+        "candidate_count": len(candidates_map),
+        "results": results,
+    }
+    if request.explain:
+        body["timings_ms"] = dict(trace.stages, total=trace.elapsed_ms())
+        body["counts"] = trace.counts
+    return body
+
+@app.post("/batch-chat")
+async def create_batch_chat(request: BatchChatRequest, current_user: User = Depends(get_current_user)):
+    """
+    批次問答：一次送出多題，立即回傳 job_id；以 GET /batch-chat/{job_id} 查進度，
+    GET /batch-chat/{job_id}/results 下載 JSONL 結果 (執行中可下載已完成的部分)。
+    """
+    ensure_ready()
+    questions = [q.strip() for q in request.questions if q and q.strip()]
+    if not questions:
+        raise HTTPException(status_code=400, detail="沒有任何問題")
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"一次最多 {BATCH_MAX_QUESTIONS} 題")
+    request.questions = questions
+
+    job_id = uuid.uuid4().hex
+    job = BatchJob(job_id, len(questions), os.path.join(BATCH_OUTPUT_DIR, f"{job_id}.jsonl"), owner=current_user.username)
+    await run_blocking(job.save, state_store)
+    task = asyncio.create_task(run_batch_job(job, request))
+    batch_tasks[job_id] = task
+    task.add_done_callback(lambda _: batch_tasks.pop(job_id, None))
+    return {"job_id": job_id, "status": job.status, "total": job.total}
+
+def get_batch_job_or_404(job_id, current_user):
+    status_, progress = load_job_status(state_store, job_id)
+    if status_ is None:
+        raise HTTPException(status_code=404, detail="找不到此批次工作")
+    # 只有送出的人 (或管理員) 看得到
+    if progress.get("owner") not in (None, current_user.username) and current_user.role != "root":
+        raise HTTPException(status_code=404, detail="找不到此批次工作")
+    return status_, progress
+
+@app.get("/batch-chat/{job_id}")
+async def get_batch_chat_status(job_id: str, current_user: User = Depends(get_current_user)):
+    status_, progress = await run_blocking(get_batch_job_or_404, job_id, current_user)
+    return dict(progress, status=status_)
+
+@app.get("/batch-chat/{job_id}/results")
+async def get_batch_chat_results(job_id: str, current_user: User = Depends(get_current_user)):
+    _, progress = await run_blocking(get_batch_job_or_404, job_id, current_user)
+    output = progress.get("output")
+    if not output or not os.path.exists(output):
+        raise HTTPException(status_code=404, detail="結果檔不存在 (可能在其他主機上)")
+    return FileResponse(output, media_type="application/x-ndjson", filename=f"{job_id}.jsonl")
 
 @app.post("/stream-chat")
-async def stream_chat(request: ChatRequest):
+async def stream_chat(request: ChatRequest, http_request: Request):
+    # 模型與索引尚未載入完成時直接回 503，前端稍後重試
+    ensure_ready()
+
+    # 每位使用者的頻率限制 (token bucket)
+    limit_key = rate_limit_key(http_request)
+    if getattr(chat_rate_limiter, "blocking", False):
+        allowed, retry_after = await run_blocking(chat_rate_limiter.try_acquire, limit_key)
+    else:
+        allowed, retry_after = chat_rate_limiter.try_acquire(limit_key)
+    if not allowed:
+        record_chat_request("rate_limited")
+        raise HTTPException(status_code=429, detail="提問太頻繁，請稍候再試。",
+                            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))})
+
+    # 同時生成數已滿就排隊；佇列也滿了直接回 503，不讓請求在伺服器上無限堆積
+    ticket = chat_admission.try_enter()
+    if ticket is None:
+        print(f"[准入] 佇列已滿 ({chat_admission.max_queue})，拒絕請求")
+        record_chat_request("rejected")
+        raise HTTPException(status_code=503, detail="目前使用人數過多，請稍後再試。",
+                            headers={"Retry-After": str(CHAT_QUEUE_RETRY_AFTER)})
+
+    try:
+        return await _start_chat_stream(request, http_request, ticket)
+    except BaseException:
+        # 回應建立前的任何錯誤 (取鎖失敗、客戶端中斷取消) 都要歸還名額，否則准入名額會永久少一個
+        ticket.release()
+        raise
+
 
-    # 檢查是否有重複的 session_id 請求
-    if request.session_id and request.session_id in active_sessions:
+async def _start_chat_stream(request: ChatRequest, http_request: Request, ticket):
+    # 檢查是否有重複的 session_id 請求 (租約式的鎖，多個 worker 共用；行程當掉也會過期)
+    lock_owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+    if request.session_id:
+        acquired = await run_blocking(state_store.acquire_lock, request.session_id, lock_owner, SESSION_LOCK_TTL)
+        if not acquired:
+            record_chat_request("duplicate_session")
             print(f"[鎖定] Session {request.session_id} 重複請求，已阻擋。")
             raise HTTPException(status_code=429, detail="上一筆回答尚未完成，請稍候。")
 
-    # lock
-    if request.session_id:
-        active_sessions.add(request.session_id)
+    session_lock_held = [bool(request.session_id)]
+
+    async def release_session_lock():
+        # event_generator 結束或回應關閉時呼叫 (兩者都可能發生，只釋放一次)
+        if session_lock_held[0]:
+            session_lock_held[0] = False
+            await run_blocking(state_store.release_lock, request.session_id, lock_owner)
+            print(f"[解鎖] Session {request.session_id} 處理結束。")
+
+    async def close_response():
+        ticket.release()
+        await release_session_lock()
             
+    guard = DisconnectGuard(http_request.is_disconnected, poll_interval=DISCONNECT_POLL_INTERVAL)
+    # 這筆請求的各階段耗時 / 候選數 (慢查詢日誌)；設在 context 裡，之後的 task 與 run_blocking 都看得到
+    trace = RequestTrace(request.session_id, request.message)
+    current_trace.set(trace)
+    want_profile = should_profile(http_request)
+
+    def finish(outcome):
+        trace.info["outcome"] = outcome
+        record_chat_request(outcome)
+
     async def event_generator():
+        lock_refreshed_at = time.monotonic()
+        phase = "queue"
+        response_parts = []
+        sampler = None
         try:
-            query = request.message
-            print(f"\n[API] 收到問題: {query}")
-
             def send_progress(msg):
                             data = {
                                 "type": "progress",
@@ -409,118 +1363,61 @@ async def stream_chat(request: ChatRequest):
                                 "timestamp": str(time.time())
                             }
                             return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
-            
-
-            yield send_progress("正在分析您的問題...")
-            # === Step 0: 智慧提取關鍵字 ===
-            core_keywords = my_rag.get_keywords_via_llm(query)
-            expanded_keywords = my_rag.expand_keywords_by_intent(query, core_keywords)
-            expanded_keywords = expanded_keywords[:8]
-            
-            
-
-            # === Step 1: 向量搜尋 ===
-            
-            query_vec = embed_model.encode([query]).tolist()
-            vector_results = collection.query(
-                query_embeddings=query_vec,
-                n_results=150,
-                include=['documents', 'metadatas', 'distances']
-            )
-            
-            candidates_map = {}
-            if vector_results['documents']:
-                for i, doc_id in enumerate(vector_results['ids'][0]):
-                    candidates_map[doc_id] = {
-                        "doc": vector_results['documents'][0][i],
-                        "meta": vector_results['metadatas'][0][i],
-                        "distance": vector_results['distances'][0][i],
-                        "source": "vector"
-                    }
 
-            
+            # 等待生成名額，排隊期間回報目前位置
+            try:
+                async for position in ticket.wait(CHAT_QUEUE_TIMEOUT):
+                    yield send_progress(f"目前使用人數較多，排隊中 (前面還有 {position - 1} 位)...")
+            except asyncio.TimeoutError:
+                print(f"[准入] 排隊逾時 ({CHAT_QUEUE_TIMEOUT}s)")
+                finish("queue_timeout")
+                err_chunk = {"type": "error", "error": "目前使用人數過多，排隊逾時，請稍後再試。", "timestamp": str(time.time())}
+                yield f"data: {json.dumps(err_chunk, ensure_ascii=False)}\n\n"
+                return
+            observe_stage("queue", ticket.waited_ms / 1000)
+            if ticket.waited_ms:
+                print(f"[准入] 排隊 {ticket.waited_ms:.0f} ms 後開始處理")
+
+            phase = "retrieval"
+            # 其他 worker 更新過知識庫時先同步索引
+            await run_blocking(sync_knowledge_base)
+            query = request.message
+            print(f"\n[API] 收到問題: {query}")
 
-            # === Step 2: 關鍵字強制搜尋 ===
-            if expanded_keywords:
-                for kw in expanded_keywords:
-                    try:
-                        kw_results = collection.get(
-                            where_document={"$contains": kw},
-                            limit=50,
-                            include=['documents', 'metadatas']
-                        )
-                        
-                        if kw_results['ids']:
-                            for i, doc_id in enumerate(kw_results['ids']):
-                                if doc_id not in candidates_map:
-                                    candidates_map[doc_id] = {
-                                        "doc": kw_results['documents'][i],
-                                        "meta": kw_results['metadatas'][i],
-                                        "distance": None, 
-                                        "source": "keyword"
-                                    }
-                    except Exception as e:
-                        pass
-
-            combined_docs = [v["doc"] for v in candidates_map.values()]
-            combined_metas = [v["meta"] for v in candidates_map.values()]
-            combined_dists = [v["distance"] for v in candidates_map.values()]
-            
-            # === Step 3: 重排序 (Rerank) ===
-            reranked_results = my_rag.advanced_reranker(
-                query, combined_docs, combined_metas, combined_dists, 
-                top_n=60,
-                decay_rate=0.98,
-                keywords=core_keywords
+            chunk_encoder = ChunkFrameEncoder(request.session_id)
+            yield send_progress("正在分析您的問題...")
+            # 剖析範圍：檢索到 Context 打包 (同一時間只有一筆請求能取樣)
+            if want_profile:
+                sampler = start_profile(PROFILE_INTERVAL_MS)
+            # === Step 0 ~ 5.5: 檢索、重排序、合併、年份過濾、Cross-Encoder ===
+            core_keywords, candidates_map, reranked_results = await retrieve_and_rank(query)
+
+            # === Step 5.7 ~ 6: Context 壓縮、選擇 prompt 樣板、依 token 預算打包 Context ===
+            prompt_ctx = await build_prompt_context(query, core_keywords, reranked_results, request.max_tokens)
+            reranked_results = prompt_ctx["results"]
+            compression_info = prompt_ctx["compression_info"]
+            prompt_template = prompt_ctx["prompt_template"]
+            knowledge_context = prompt_ctx["knowledge_context"]
+            context_str = prompt_ctx["context_str"]
+            selected, used_tokens, context_budget = prompt_ctx["selected"], prompt_ctx["used_tokens"], prompt_ctx["context_budget"]
+            trace.counts.update(reranked=len(reranked_results), selected=len(selected))
+            trace.info.update(
+                keywords=core_keywords,
+                prompt_template=prompt_template.key,
+                context_chars=len(context_str),
+                context_tokens=used_tokens,
+                context_budget=context_budget,
+                compression=compression_info,
             )
-
-            # === Step 4: 拼圖重組 (Merge) ===
-            reranked_results = my_rag.group_and_merge_results(reranked_results)
-            
-            # === Step 5: Scope Guard (年份過濾) ===
-            year_match = re.search(r"\b(1[0-9]{2})\b", query)
-            if year_match and "報告" in query and ("中" in query or "依據" in query or "根據" in query):
-                y = year_match.group(1)
-                reranked_results = [
-                    r for r in reranked_results
-                    if y in ((r.get("meta", {}) or {}).get("source_doc", ""))
-                ]
-
-            # === Step 6: 構建 Context & 準備回傳前端所需的「搜尋結果」格式 ===
-            context_str = ""
-            current_char_count = 0
-            knowledge_context = [] # 收集給前端顯示用
+            if sampler is not None:
+                trace.info["profile"] = await run_blocking(finish_profile, sampler, PROFILE_DIR, request.session_id or "anonymous")
+                sampler = None
+                print(f"[剖析] 檢索階段堆疊取樣已寫入 {trace.info['profile']}")
 
             print("\n--- 參考資料來源 ---")
-            for i, res in enumerate(reranked_results):
-                meta = res['meta']
-                doc_content = res['doc']
-                doc_name = meta.get('source_doc', '未知')
-                node_type = meta.get('type', meta.get('label', '未知'))
-                
-
-                title = meta.get('title', doc_name)
-
-                knowledge_context.append({
-                    "title": title[:30],
-                    "content": doc_content[:100] + "...",
-                    "source": doc_name
-                })
-
-
-                # 檢查 Token 上限
-                if current_char_count + len(doc_content) > MAX_CONTEXT_CHARS:
-                    continue 
-
-                if i < 5:    
-                    print(f" {i+1}. {doc_name} (分數: {res['score']:.3f})")
-                
-                if node_type == 'MergedTable':
-                    context_str += f"{doc_content}\n\n"
-                else:
-                    context_str += f"【來源文件：{doc_name}】\n{doc_content}\n\n"
-                    
-                current_char_count += len(doc_content)
+            for i in selected[:5]:
+                print(f" {i+1}. {reranked_results[i]['meta'].get('source_doc', '未知')} (分數: {reranked_results[i]['score']:.3f})")
+            print(f"[Context] 選入 {len(selected)}/{prompt_ctx['block_count']} 段，{used_tokens}/{context_budget} tokens")
 
             search_result_chunk = {
                 "type": "search_results",
@@ -528,6 +1425,7 @@ async def stream_chat(request: ChatRequest):
                 "has_knowledge": len(knowledge_context) > 0,
                 "knowledge_count": len(knowledge_context),
                 "knowledge_context": knowledge_context,
+                "context_compression": compression_info,
                 "timestamp": str(time.time())
             }
             yield f"data: {json.dumps(search_result_chunk, ensure_ascii=False)}\n\n"
@@ -537,131 +1435,114 @@ async def stream_chat(request: ChatRequest):
                 print("未選入任何資料。")
                 context_str = "沒有找到相關資料。"
             
-            # === Step 7: 生成回應  ===
-            is_speech_request = any(kw in query for kw in ["演講", "致詞", "講稿", "致辭", "發言稿"])
-
-            if is_speech_request:
+            # === Step 7: 生成回應 (固定前綴在 system，context 與問題在最後，利於 vLLM prefix cache) ===
+            if prompt_template.intent == "speech":
                 print("偵測到演講稿需求...")
-                prompt = f"""
-    <role>
-    你現在是某政府機關或大型企業的「幕僚長」，正在為你的首長撰寫一篇公開場合的致詞稿。
-    </role>
-
-    <context>
-    {context_str}
-    </context>
-
-    <style_guide>
-    1. **語氣設定**：穩健、自信、大器。這是要「唸出來」的稿子，請使用口語連接詞（如「各位貴賓」、「我們看到」、「這代表著」），避免生硬的公文語句。
-    2. **數據轉化**：將冰冷的數據轉化為故事。例如不要說「成長20%」，要說「我們成功創造了兩成的顯著成長」。
-    3. **格式禁忌**：**絕對禁止**使用 Markdown 標題符號 (#) 或列點符號 (-/1.)。整篇稿子必須是純文字段落。
-    4. **篇幅控制**：約 800 字，適合 3-5 分鐘的演說。
-    </style_guide>
-
-    <structure>
-    1. **開場 (15%)**：向在場貴賓（依據問題情境推斷）致意，點出今日主題的重要性與願景。
-    2. **本文 (70%)**：
-    - 引用 <context> 中的具體成果（如廠商名、產值、獲獎紀錄）作為政績/業績證明。
-    - 將分散的數據串聯成一個推動產業發展的故事。
-    - **注意**：只能引用資料裡有的事實，不可捏造。
-    3. **結語 (15%)**：重申核心價值，並提出對未來的期許 (Call to Action)，以高昂的語氣結尾。
-    </structure>
-
-    <user_instruction>
-    演講主題：{query}
-    請依據上述架構，撰寫一份完整的逐字演講稿：
-    </user_instruction>
-    """
-
-            else:
-                # 一般 QA 模式
-                prompt = f"""
-    <role>
-    你是一位隸屬於高層決策單位的「首席情報分析師」。你的任務是基於檢索到的內部資料，提供精確、證據導向的分析報告。
-    </role>
-
-    <context>
-    {context_str}
-    </context>
-
-    <rules>
-    1. **絕對證據原則**：所有回答必須嚴格基於 <context> 內容。若資料中未提及，請直接回答「資料庫中無相關資訊」，禁止自行腦補或使用外部知識。
-    2. **數據精確性**：引用數據時（金額、人數、百分比），必須與原文完全一致，保留小數點與單位。
-    3. **實體完整性**：提到廠商、機構或專案名稱時，請列出全名，並在首次出現時使用 **粗體** 標示。
-    4. **排除無效資訊**：若表格數據為 "-" 或 "NA"，代表無數據，請勿將其視為 "0" 或納入統計。
-    5. **時間敏感度**：若資料包含多個年份（如 112年、113年），請務必在回答中標註年份。
-    6. **數據邏輯檢核**：若原文表格中包含「總計」或「合計」，請優先引用該數值。若你需要加總多個年份的數字，請務必先進行數學驗算；若驗算結果與原文總數不符，請回答「原文數據與總計有出入」，禁止自行修正或腦補。
-    </rules>
-
-    <output_format>
-    請直接回答使用者的問題，無需開場白（如"你好"、"根據資料"），並依照以下格式輸出：
-
-    ### 🎯 核心結論
-    (用 2-3 句話直接回答問題的重點結論)
-
-    ### 📊 詳細分析
-    * **[分類標題 1]**：具體說明，包含廠商名單與關鍵數據。
-    * **[分類標題 2]**：具體說明，包含廠商名單與關鍵數據。
-    (請根據內容自動分類，每個重點一段，條理分明)
-
-    ### 💡 綜合評估
-    (總結該議題的價值、趨勢或缺口)
-    </output_format>
-
-    <user_query>
-    {query}
-    </user_query>
-    """
-            full_response_log = ""
-
+            messages = prompt_template.build_messages(context_str, query)
+
+            # === Step 7.5: 語意回答快取 (只對 temperature=0 的確定性回答啟用) ===
+            use_answer_cache = ANSWER_CACHE_ENABLED and not request.temperature
+            if use_answer_cache:
+                cache_generation = answer_cache.generation
+                cache_variant = (prompt_template.key, request.max_tokens)
+                cache_chunk_ids = my_rag.collect_chunk_ids(reranked_results)
+                query_vec = await run_blocking(query_embed_cache.encode, query)
+                cached = answer_cache.lookup(query_vec, cache_chunk_ids, cache_variant)
+                record_cache_lookup("answer", cached is not None)
+                if cached:
+                    cached_answer, similarity = cached
+                    print(f"[回答快取] 命中 (相似度 {similarity:.3f})，直接重播")
+                    phase = "replay"
+                    for start in range(0, len(cached_answer), ANSWER_CACHE_REPLAY_CHARS):
+                        yield chunk_encoder.frame(cached_answer[start:start + ANSWER_CACHE_REPLAY_CHARS])
+                    yield f"data: [DONE]\n\n"
+                    finish("cache_replay")
+                    return
+
+            phase = "generation"
+            stream = None
             try:
                 # 使用串流 (Stream) 回傳給前端
+                llm_requested_at = time.perf_counter()
                 stream = await llm_client.chat.completions.create(
                     model=LLM_MODEL,
-                    messages=[{"role": "user", "content": prompt}],
+                    messages=messages,
                     temperature=request.temperature,
                     max_tokens=request.max_tokens,
                     stream=True 
                 )
 
-                async for chunk in stream:
-                    content = chunk.choices[0].delta.content
-                    if content:
-                        full_response_log += content
-                        # 包裝成前端要的格式 (Yellow highlight)
-                        resp_chunk = {
-                            "type": "chunk",
-                            "content": content,
-                            "session_id": request.session_id,
-                            "timestamp": str(time.time())
-                        }
-                        yield f"data: {json.dumps(resp_chunk, ensure_ascii=False)}\n\n"
-
+                # delta 依字數 / 時間門檻合併成較少的 frame (前端 chunk 格式不變)
+                # measure_llm_stream 量的是 vLLM 原始 delta (TTFT / token 間隔 / tokens/s)
+                async for content in coalesce_deltas(measure_llm_stream(stream, llm_requested_at), max_chars=SSE_COALESCE_CHARS, max_delay_ms=SSE_COALESCE_MS):
+                    trace.mark_first_token()
+                    response_parts.append(content)
+                    yield chunk_encoder.frame(content)
+                    # 長回答：定期延長 Session 鎖的租約
+                    if request.session_id and time.monotonic() - lock_refreshed_at > SESSION_LOCK_TTL / 3:
+                        lock_refreshed_at = time.monotonic()
+                        await run_blocking(state_store.refresh_lock, request.session_id, lock_owner, SESSION_LOCK_TTL)
+
+                full_response_log = "".join(response_parts)
                 print("\n" + "="*20 + " 完整回答紀錄 " + "="*20)
                 print(full_response_log)
                 print("="*50 + "\n")
+                if use_answer_cache:
+                    answer_cache.put(query, query_vec, cache_chunk_ids, cache_variant, full_response_log, cache_generation)
                 yield f"data: [DONE]\n\n"
+                finish("completed")
 
             except Exception as e:
                 print(f"LLM 生成失敗: {e}")
+                record_error("llm")
+                finish("error")
                 err_chunk = {
                     "type": "error", 
                     "error": str(e), 
                     "timestamp": str(time.time())
                 }
                 yield f"data: {json.dumps(err_chunk, ensure_ascii=False)}\n\n"
+            finally:
+                # 客戶端斷線時在這裡關閉上游連線，vLLM 隨即中止這筆生成、釋放 GPU 名額
+                if stream is not None:
+                    await stream.close()
         except Exception as general_error:
                 # 捕捉 RAG 流程(搜尋/重排序)本身的錯誤
                 print(f"RAG 流程錯誤: {general_error}")
+                record_error("pipeline")
+                finish("error")
                 err_chunk = {"type": "error", "error": f"系統內部錯誤: {str(general_error)}", "timestamp": str(time.time())}
                 yield f"data: {json.dumps(err_chunk, ensure_ascii=False)}\n\n"
         finally:
-                if request.session_id and request.session_id in active_sessions:
-                    active_sessions.remove(request.session_id)
-                    print(f"[解鎖] Session {request.session_id} 處理結束。")        
-
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+                ticket.release()
+                if guard.disconnected:
+                    record_chat_cancellation(phase, "".join(response_parts), request.max_tokens)
+                    trace.info["outcome"] = "cancelled"
+                if sampler is not None:
+                    # 檢索途中出錯或斷線：仍把已取樣的部分寫出
+                    trace.info["profile"] = await run_blocking(finish_profile, sampler, PROFILE_DIR, request.session_id or "anonymous")
+                if slow_query_log.is_slow(trace.elapsed_ms()):
+                    partial_answer = "".join(response_parts)
+                    record = trace.to_record(
+                        completion_tokens=token_counter.count(partial_answer) if token_counter and partial_answer else 0
+                    )
+                    await run_blocking(slow_query_log.write, record)
+                    print(f"[慢查詢] {record['total_ms']:.0f} ms，已記錄至 {SLOW_QUERY_LOG}")
+                await release_session_lock()
+
+    # body 從未被迭代 (送出 header 前客戶端就斷線) 時 event_generator 的 finally 不會執行，
+    # 回應結束時再歸還一次名額並釋放 Session 鎖，否則同一個 Session 要等 SESSION_LOCK_TTL 才能再問
+    return ReleasingStreamingResponse(guard.stream(event_generator()), on_close=close_response,
+                                      media_type="text/event-stream")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    if UVICORN_WORKERS > 1:
+        # 嵌入式 Chroma (PersistentClient) 不支援多個行程同時開啟同一個目錄：
+        # 其他 worker 看不到新寫入的向量，還可能寫壞資料庫，必須改連 Chroma 伺服器
+        if not db_builder.CHROMA_HOST:
+            raise SystemExit("UVICORN_WORKERS > 1 需設定 CHROMA_HOST (Chroma 伺服器)；嵌入式 Chroma 只能單一 worker 使用")
+        # 多 worker 需以字串指定 app；每個 worker 各自載入一份 Embedding 模型
+        uvicorn.run("rag_server:app", host="0.0.0.0", port=8001, workers=UVICORN_WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8001)
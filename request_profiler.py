@@ -0,0 +1,153 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+# ==========================================
+# 請求剖析 (取樣 profiler) 與慢查詢日誌
+# ==========================================
+# p95 飆高時，光看 /metrics 只知道「哪一段變慢」，不知道那筆請求實際在做什麼：
+#   - RequestTrace：單一請求的各階段耗時、候選數、關鍵字、context 大小與 token 數
+#     (metrics.stage_timer 會透過 ContextVar 自動把耗時記到目前請求的 trace)
+#   - StackSampler：背景執行緒每 N 毫秒以 sys._current_frames() 取樣所有執行緒的堆疊，
+#     輸出 collapsed stack 格式 (每行「執行緒;函式;函式 次數」)，可直接給 flamegraph.pl / speedscope
+#     同一時間只允許一個取樣 (全行程的堆疊，併發請求的檢索也會一起被取樣)
+#   - SlowQueryLog：總耗時超過門檻的請求寫一行 JSON 到 JSONL 檔
+
+# 停在這些函式的執行緒是閒置 (等待工作 / 等待 I/O)，不列入取樣
+IDLE_LEAVES = {("threading.py", "wait"), ("queue.py", "get"), ("selectors.py", "select"), ("thread.py", "_worker")}
+
+_profile_lock = threading.Lock()
+
+
+class RequestTrace:
+    def __init__(self, session_id=None, query=""):
+        self.session_id = session_id
+        self.query = query
+        self.started_at = time.perf_counter()
+        self.first_token_ms = None
+        self.stages = {}    # 階段 -> 毫秒 (同一階段多次呼叫時累加)
+        self.counts = {}    # 候選數等計數
+        self.info = {}      # 關鍵字、context 大小、token 數等
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = round(self.stages.get(stage, 0.0) + seconds * 1000, 2)
+
+    def mark_first_token(self):
+        if self.first_token_ms is None:
+            self.first_token_ms = self.elapsed_ms()
+
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self.started_at) * 1000, 2)
+
+    def to_record(self, **extra):
+        record = {
+            "timestamp": datetime.now().isoformat(timespec="milliseconds"),
+            "session_id": self.session_id,
+            "query": self.query,
+            "total_ms": self.elapsed_ms(),
+            "ttft_ms": self.first_token_ms,
+            "stages_ms": self.stages,
+            "counts": self.counts,
+        }
+        record.update(self.info)
+        record.update(extra)
+        return record
+
+
+class StackSampler:
+    def __init__(self, interval_ms=5):
+        self.interval = interval_ms / 1000
+        self.samples = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._started_at = None
+        self.duration_ms = 0.0
+
+    def start(self):
+        self._started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration_ms = round((time.perf_counter() - self._started_at) * 1000, 1)
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAVES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, f"thread-{thread_id}"))
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def write_collapsed(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+def start_profile(interval_ms=5):
+    """開始取樣；已經有其他請求在取樣時回傳 None (不排隊等待)"""
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    try:
+        return StackSampler(interval_ms).start()
+    except Exception:
+        _profile_lock.release()
+        raise
+
+
+def finish_profile(sampler, output_dir, name):
+    """停止取樣並寫出 collapsed stack 檔，回傳檔案路徑"""
+    try:
+        sampler.stop()
+    finally:
+        _profile_lock.release()
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in str(name))[:40]
+    return sampler.write_collapsed(os.path.join(output_dir, f"{stamp}_{safe_name}.collapsed"))
+
+
+class SlowQueryLog:
+    def __init__(self, path, threshold_ms):
+        """threshold_ms <= 0 表示關閉"""
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def enabled(self):
+        return self.threshold_ms > 0
+
+    def is_slow(self, elapsed_ms):
+        return self.enabled() and elapsed_ms >= self.threshold_ms
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.written += 1
@@ -0,0 +1,255 @@
+import random
+import threading
+import time
+
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, Text, case, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+# ==========================================
+# 可抽換的共享狀態 (Session 鎖 / 上傳進度 / 知識庫版本)
+# ==========================================
+# 原本 active_sessions 與 processing_status 是模組層級的 Python 物件，
+# 開多個 uvicorn worker 時各 worker 各有一份：429 防重複送出失效、/upload-status 查不到別的 worker 的進度。
+#   - InMemoryStateStore：單一行程 (預設，行為與原本相同)
+#   - SQLStateStore     ：存在 SQLAlchemy 資料庫 (MySQL / SQLite)，多個 worker 共用
+# Session 鎖是有期限的租約 (lease)：行程當掉沒釋放也會自動過期，長回答需定期 refresh。
+# 計數器 (counter) 用來讓各 worker 得知知識庫已被其他 worker 更新。
+# Token bucket (take_token) 讓每位使用者的提問頻率限制在所有 worker 之間共用一個桶子。
+
+
+class InMemoryStateStore:
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}     # key -> (owner, expires_at)
+        self._jobs = {}       # name -> {"status", "message"}
+        self._counters = {}
+        self._buckets = {}    # key -> (tokens, updated_at)
+
+    # --- Session 鎖 ---
+    def acquire_lock(self, key, owner, ttl):
+        now = time.time()
+        with self._lock:
+            current = self._leases.get(key)
+            if current and current[1] > now and current[0] != owner:
+                return False
+            self._leases[key] = (owner, now + ttl)
+            return True
+
+    def refresh_lock(self, key, owner, ttl):
+        with self._lock:
+            current = self._leases.get(key)
+            if not current or current[0] != owner:
+                return False
+            self._leases[key] = (owner, time.time() + ttl)
+            return True
+
+    def release_lock(self, key, owner):
+        with self._lock:
+            current = self._leases.get(key)
+            if current and current[0] == owner:
+                del self._leases[key]
+
+    # --- 上傳處理進度 ---
+    def set_job(self, name, status, message):
+        with self._lock:
+            self._jobs[name] = {"status": status, "message": message}
+
+    def get_job(self, name):
+        with self._lock:
+            job = self._jobs.get(name)
+            return dict(job) if job else None
+
+    def delete_job(self, name):
+        with self._lock:
+            self._jobs.pop(name, None)
+
+    def list_jobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+    # --- 計數器 ---
+    def get_counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def incr_counter(self, name):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+            return self._counters[name]
+
+    # --- Token bucket ---
+    def take_token(self, key, rate, burst):
+        """rate：每秒補充的 token 數；回傳 (是否允許, 建議等待秒數)"""
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return True, 0.0
+            return False, (1 - tokens) / rate
+
+
+class SQLStateStore:
+    name = "sql"
+
+    def __init__(self, engine, table_prefix="rag_"):
+        self.engine = engine
+        metadata = MetaData()
+        self.leases = Table(
+            f"{table_prefix}session_leases", metadata,
+            Column("key", String(191), primary_key=True),
+            Column("owner", String(64), nullable=False),
+            Column("expires_at", Float, nullable=False),
+        )
+        self.jobs = Table(
+            f"{table_prefix}jobs", metadata,
+            Column("name", String(191), primary_key=True),
+            Column("status", String(20), nullable=False),
+            Column("message", Text),
+            Column("updated_at", Float, nullable=False),
+        )
+        self.counters = Table(
+            f"{table_prefix}counters", metadata,
+            Column("name", String(64), primary_key=True),
+            Column("value", Integer, nullable=False, default=0),
+        )
+        self.buckets = Table(
+            f"{table_prefix}rate_buckets", metadata,
+            Column("key", String(191), primary_key=True),
+            Column("tokens", Float, nullable=False),
+            Column("updated_at", Float, nullable=False),
+        )
+        self.metadata = metadata
+
+    def create_tables(self):
+        self.metadata.create_all(bind=self.engine)
+
+    # --- Session 鎖 ---
+    def acquire_lock(self, key, owner, ttl, retries=1):
+        # MySQL (REPEATABLE READ) 下兩個 worker 同時「刪過期 + 插入」同一個 key 可能死結 (OperationalError 1213)，
+        # 被選為犧牲者的那一方重試一次；仍失敗就當成沒搶到 (回 429，而不是 500)
+        for attempt in range(retries + 1):
+            now = time.time()
+            try:
+                with self.engine.begin() as conn:
+                    # 先清掉已過期的租約，再靠主鍵唯一性保證只有一個 worker 能插入成功
+                    conn.execute(delete(self.leases).where(self.leases.c.key == key, self.leases.c.expires_at < now))
+                    conn.execute(insert(self.leases).values(key=key, owner=owner, expires_at=now + ttl))
+                return True
+            except IntegrityError:
+                return False
+            except OperationalError as e:
+                if attempt == retries:
+                    print(f"[StateStore] 取得 Session 鎖失敗 ({key})，視為忙碌: {e.orig if e.orig is not None else e}")
+                    return False
+                time.sleep(0.05 * (attempt + 1))
+
+    def refresh_lock(self, key, owner, ttl):
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                update(self.leases)
+                .where(self.leases.c.key == key, self.leases.c.owner == owner)
+                .values(expires_at=time.time() + ttl)
+            )
+            return result.rowcount > 0
+
+    def release_lock(self, key, owner):
+        with self.engine.begin() as conn:
+            conn.execute(delete(self.leases).where(self.leases.c.key == key, self.leases.c.owner == owner))
+
+    # --- 上傳處理進度 ---
+    def set_job(self, name, status, message):
+        values = {"status": status, "message": message, "updated_at": time.time()}
+        with self.engine.begin() as conn:
+            result = conn.execute(update(self.jobs).where(self.jobs.c.name == name).values(**values))
+            if result.rowcount == 0:
+                try:
+                    with conn.begin_nested():
+                        conn.execute(insert(self.jobs).values(name=name, **values))
+                except IntegrityError:
+                    conn.execute(update(self.jobs).where(self.jobs.c.name == name).values(**values))
+
+    def get_job(self, name):
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                select(self.jobs.c.status, self.jobs.c.message).where(self.jobs.c.name == name)
+            ).first()
+        return {"status": row.status, "message": row.message} if row else None
+
+    def delete_job(self, name):
+        with self.engine.begin() as conn:
+            conn.execute(delete(self.jobs).where(self.jobs.c.name == name))
+
+    def list_jobs(self):
+        with self.engine.connect() as conn:
+            return [r.name for r in conn.execute(select(self.jobs.c.name))]
+
+    # --- 計數器 ---
+    def get_counter(self, name):
+        with self.engine.connect() as conn:
+            value = conn.execute(select(self.counters.c.value).where(self.counters.c.name == name)).scalar()
+        return value or 0
+
+    def incr_counter(self, name):
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                update(self.counters).where(self.counters.c.name == name).values(value=self.counters.c.value + 1)
+            )
+            if result.rowcount == 0:
+                try:
+                    with conn.begin_nested():
+                        conn.execute(insert(self.counters).values(name=name, value=1))
+                except IntegrityError:
+                    conn.execute(
+                        update(self.counters).where(self.counters.c.name == name).values(value=self.counters.c.value + 1)
+                    )
+            return conn.execute(select(self.counters.c.value).where(self.counters.c.name == name)).scalar()
+
+    # --- Token bucket ---
+    def take_token(self, key, rate, burst):
+        """
+        rate：每秒補充的 token 數；回傳 (是否允許, 建議等待秒數)。
+        補充與扣除在同一個條件式 UPDATE 裡完成，多個 worker 同時扣同一個桶子也不會超發。
+        """
+        now = time.time()
+        c = self.buckets.c
+        refilled = c.tokens + (now - c.updated_at) * rate
+        available = case((refilled > burst, burst), else_=refilled)
+        with self.engine.begin() as conn:
+            # MySQL 依序套用 SET：tokens 必須在 updated_at 之前計算
+            result = conn.execute(
+                update(self.buckets).where(c.key == key, available >= 1)
+                .ordered_values((c.tokens, available - 1), (c.updated_at, now))
+            )
+            if result.rowcount:
+                return True, 0.0
+            row = conn.execute(select(c.tokens, c.updated_at).where(c.key == key)).first()
+            if row is None:
+                try:
+                    with conn.begin_nested():
+                        conn.execute(insert(self.buckets).values(key=key, tokens=burst - 1, updated_at=now))
+                    allowed, retry_after = True, 0.0
+                except IntegrityError:
+                    # 另一個 worker 剛建立同一個桶子：保守起見這次視為沒有 token
+                    allowed, retry_after = False, 1 / rate
+            else:
+                tokens = min(burst, row.tokens + (now - row.updated_at) * rate)
+                allowed, retry_after = False, (1 - tokens) / rate
+            if random.random() < 0.01:
+                # 已經補滿的桶子等同沒有紀錄，偶爾清一次
+                conn.execute(delete(self.buckets).where(c.updated_at < now - burst / rate))
+        return allowed, retry_after
+
+
+def create_state_store(backend, engine=None):
+    """backend: memory / sql (sql 需傳入 SQLAlchemy engine)"""
+    if backend == "memory":
+        return InMemoryStateStore()
+    if backend == "sql":
+        if engine is None:
+            raise ValueError("STATE_STORE=sql 需要資料庫連線 (DATABASE_URL / STATE_STORE_URL)")
+        return SQLStateStore(engine)
+    raise ValueError(f"不支援的 STATE_STORE: {backend} (可用: memory / sql)")
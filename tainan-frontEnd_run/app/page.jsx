@@ -320,7 +320,8 @@ export default function Home() {
     setStatus('請求中...');
 
     try {
-      const response = await fetch(`${API_BASE_URL}/stream-chat`, {
+      // 帶上 Token：後端依使用者 (JWT sub) 做頻率限制，否則所有人都算在同一個 IP 上
+      const response = await authFetch(`${API_BASE_URL}/stream-chat`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
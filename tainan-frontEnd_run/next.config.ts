@@ -13,6 +13,7 @@ const nextConfig: NextConfig = {
   // 3. API 轉發設定 - 使用環境變數
   async rewrites() {
     // Docker 環境中使用 backend 服務名稱，本機開發用 localhost
+    // rewrite 轉發時 Next.js 會附加 X-Forwarded-For (瀏覽器的 IP)，後端以 TRUSTED_PROXIES=frontend 採用
     const backendUrl = process.env.BACKEND_URL || 'http://backend:8001';
     
     return [
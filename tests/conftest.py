@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 專案的模組都放在根目錄 (非套件)，讓測試可以直接 import rag_server 等模組
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
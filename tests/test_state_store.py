@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+
+from admission import SharedTokenBucketLimiter
+from state_store import SQLStateStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'state.db'}")
+    store = SQLStateStore(engine)
+    store.create_tables()
+    return store
+
+
+def fail_lease_inserts(engine, times):
+    """模擬 MySQL 死結：前 times 次插入租約時拋出 OperationalError"""
+    failures = {"left": times}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def deadlock(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO rag_session_leases") and failures["left"] > 0:
+            failures["left"] -= 1
+            raise OperationalError(statement, parameters, Exception("(1213, 'Deadlock found when trying to get lock')"))
+
+    return failures
+
+
+def test_acquire_lock_retries_after_deadlock(store):
+    fail_lease_inserts(store.engine, times=1)
+    assert store.acquire_lock("s-1", "worker-a", ttl=10)
+    assert not store.acquire_lock("s-1", "worker-b", ttl=10)
+
+
+def test_acquire_lock_reports_busy_when_deadlock_persists(store):
+    fail_lease_inserts(store.engine, times=5)
+    assert store.acquire_lock("s-1", "worker-a", ttl=10) is False
+
+
+def test_rate_limit_bucket_shared_between_workers(store):
+    # 兩個 worker 各自建立 limiter，但共用同一個資料庫：額度合併計算
+    worker_a = SharedTokenBucketLimiter(store, rate_per_minute=1, burst=2)
+    worker_b = SharedTokenBucketLimiter(SQLStateStore(store.engine), rate_per_minute=1, burst=2)
+    assert worker_a.try_acquire("user:alice")[0]
+    assert worker_b.try_acquire("user:alice")[0]
+    allowed, retry_after = worker_a.try_acquire("user:alice")
+    assert not allowed and 0 < retry_after <= 60
+    assert not worker_b.try_acquire("user:alice")[0]
+    assert worker_b.try_acquire("user:bob")[0]
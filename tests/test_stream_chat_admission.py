@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("fastapi")
+rag_server = pytest.importorskip("rag_server")
+
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+from admission import AdmissionController, TokenBucketLimiter
+from state_store import InMemoryStateStore
+
+# 前端容器 (Next.js rewrite) 在 docker 網路裡的位址：所有瀏覽器的請求都從這裡進來
+PROXY_IP = "172.18.0.5"
+
+
+def make_scope(headers, client_ip=PROXY_IP):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/stream-chat",
+        "raw_path": b"/stream-chat",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        "client": (client_ip, 40000),
+        "server": ("backend", 8001),
+    }
+
+
+def make_request(headers, client_ip=PROXY_IP):
+    return Request(make_scope(headers, client_ip))
+
+
+@pytest.fixture
+def trust_proxy(monkeypatch):
+    monkeypatch.setattr(rag_server, "TRUSTED_PROXIES", [PROXY_IP])
+    monkeypatch.setitem(rag_server._trusted_proxy_cache, "resolved_at", None)
+
+
+def test_users_behind_same_proxy_get_separate_buckets(trust_proxy):
+    limiter = TokenBucketLimiter(rate_per_minute=1, burst=1)
+
+    alice = make_request({"Authorization": "Bearer " + rag_server.create_access_token({"sub": "alice"}),
+                          "X-Forwarded-For": "10.0.0.1"})
+    bob = make_request({"Authorization": "Bearer " + rag_server.create_access_token({"sub": "bob"}),
+                        "X-Forwarded-For": "10.0.0.1"})
+    assert rag_server.rate_limit_key(alice) != rag_server.rate_limit_key(bob)
+    assert limiter.try_acquire(rag_server.rate_limit_key(alice))[0]
+    assert limiter.try_acquire(rag_server.rate_limit_key(bob))[0]
+    assert not limiter.try_acquire(rag_server.rate_limit_key(alice))[0]
+
+    # 未登入：以代理附加的 X-Forwarded-For (最後一段) 區分，客戶端自己帶的前段不算
+    carol = make_request({"X-Forwarded-For": "10.0.0.2"})
+    dave = make_request({"X-Forwarded-For": "10.0.0.2, 10.0.0.3"})
+    assert rag_server.rate_limit_key(carol) == "ip:10.0.0.2"
+    assert rag_server.rate_limit_key(dave) == "ip:10.0.0.3"
+    assert limiter.try_acquire(rag_server.rate_limit_key(carol))[0]
+    assert limiter.try_acquire(rag_server.rate_limit_key(dave))[0]
+
+
+def test_admission_ticket_released_when_acquire_lock_raises(monkeypatch):
+    admission = AdmissionController(max_concurrent=1, max_queue=0)
+    monkeypatch.setattr(rag_server, "chat_admission", admission)
+    monkeypatch.setattr(rag_server, "chat_rate_limiter", TokenBucketLimiter(rate_per_minute=0))
+    monkeypatch.setattr(rag_server, "ensure_ready", lambda *names: None)
+
+    def broken_lock(*args, **kwargs):
+        raise RuntimeError("state store unavailable")
+
+    monkeypatch.setattr(rag_server.state_store, "acquire_lock", broken_lock)
+
+    client = TestClient(rag_server.app, raise_server_exceptions=False)
+    resp = client.post("/stream-chat", json={"message": "測試", "session_id": "s-1"})
+    assert resp.status_code == 500
+    assert admission.stats()["active"] == 0
+
+    # 名額已歸還：下一筆請求不會因為佇列已滿而被 503 拒絕
+    resp = client.post("/stream-chat", json={"message": "測試", "session_id": "s-2"})
+    assert resp.status_code == 500
+    assert admission.stats()["rejected"] == 0
+
+
+def test_forwarded_for_ignored_from_untrusted_peer(trust_proxy):
+    # 直接連到後端的客戶端自己帶 X-Forwarded-For：仍以連線來源計算，換標頭也拿不到新的桶子
+    direct = make_request({"X-Forwarded-For": "10.9.9.9"}, client_ip="203.0.113.7")
+    assert rag_server.rate_limit_key(direct) == "ip:203.0.113.7"
+
+
+def test_session_lock_released_when_body_never_iterated(monkeypatch):
+    admission = AdmissionController(max_concurrent=1, max_queue=0)
+    store = InMemoryStateStore()
+    monkeypatch.setattr(rag_server, "chat_admission", admission)
+    monkeypatch.setattr(rag_server, "chat_rate_limiter", TokenBucketLimiter(rate_per_minute=0))
+    monkeypatch.setattr(rag_server, "state_store", store)
+    monkeypatch.setattr(rag_server, "ensure_ready", lambda *names: None)
+
+    async def scenario():
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            # 客戶端在回應標頭送出前就斷線
+            raise OSError("client disconnected")
+
+        scope = make_scope({})
+        response = await rag_server.stream_chat(
+            rag_server.ChatRequest(message="測試", session_id="s-3"), Request(scope, receive)
+        )
+        assert not store.acquire_lock("s-3", "another-request", ttl=10)
+        with pytest.raises(Exception):
+            await response(scope, receive, send)
+
+    asyncio.run(scenario())
+    assert admission.stats()["active"] == 0
+    assert store.acquire_lock("s-3", "another-request", ttl=10)